@@ -0,0 +1,405 @@
+"""
+An asyncio Gmail client, for work that needs many requests in flight from a
+single thread, such as backfilling a large mailbox.
+
+Requests are described with the same googleapiclient service the rest of
+the app uses, so parameters, fields masks and response parsing match the
+synchronous code; only the sending differs. Each request runs on a
+keep-alive HTTP/1.1 connection opened with asyncio streams, one request
+per connection at a time. Up to `max_in_flight` requests run at once
+without a thread each. Sends have their own, tighter limit, because Gmail
+throttles sending far more than reading.
+
+Failed calls are retried the way bulk_send retries sends: rate limits,
+server errors and dropped connections back off exponentially with full
+jitter and honour Retry-After. A 401 is retried once after refreshing the
+token. Every call is reported to metrics.recorder, and takes its quota
+units from quota.scheduler.
+
+    async with AsyncGmail(credentials, max_in_flight=200) as gmail:
+        messages, errors = await gmail.get_many(message_ids, format='metadata')
+"""
+import asyncio
+import email.parser
+import email.policy
+import io
+import json
+import random
+import ssl
+import time
+import urllib.parse
+import uuid
+import zlib
+
+import httplib2
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload
+
+from bulk_send import is_retryable, retry_after
+from gmail_auth import API_ENDPOINT, build_service, discovery_document, refresh_request
+from gmail_fetch import LIST_FIELDS, SUMMARY_FIELDS, SUMMARY_HEADERS, chunked
+from http_pool import SharedCredentials
+from metrics import recorder
+from quota import is_rate_limited, scheduler, units_for
+
+# Requests in flight at once, across all calls
+MAX_IN_FLIGHT = 100
+
+# Sends in flight at once
+MAX_SENDS_IN_FLIGHT = 10
+
+# Seconds allowed for one HTTP exchange
+TIMEOUT = 60
+
+# Gmail rejects batches with more calls than this
+MAX_BATCH_SIZE = 100
+
+
+def _parse(request, response, content):
+    """
+    Parse a response to `request` without recording its size again: the
+    service's InstrumentedRequest would, and call() has already counted it.
+    """
+    return getattr(request, '_postproc', request.postproc)(response, content)
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP/1.1 connections, reused by later requests to the same
+    host.
+    """
+
+    def __init__(self):
+        self._idle = {}
+        self._ssl = None
+
+    async def request(self, method, url, headers, body=b''):
+        """
+        Send one request and return (status, headers, content), with header
+        names in lower case and the content decompressed.
+        """
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        target = parts.path + ('?' + parts.query if parts.query else '')
+        head = [f'{method} {target} HTTP/1.1', f'Host: {parts.netloc}']
+        head += [f'{name}: {value}' for name, value in headers.items() if name.lower() not in ('host', 'content-length')]
+        head.append(f'Content-Length: {len(body)}')
+        data = ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body
+
+        while True:
+            (reader, writer), reused = await self._connect(key)
+            try:
+                writer.write(data)
+                await writer.drain()
+                status, response_headers, content = await self._read_response(reader, method)
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                writer.close()
+                if reused:
+                    # The server closed the connection while it sat idle
+                    continue
+                raise ConnectionResetError(f"Connection to {parts.netloc} lost: {e}") from e
+            except BaseException:
+                # Also on cancellation: the rest of the response would be read by the next request
+                writer.close()
+                raise
+            if response_headers.get('connection', '').lower() == 'close':
+                writer.close()
+            else:
+                self._idle.setdefault(key, []).append((reader, writer))
+            return status, response_headers, content
+
+    async def close(self):
+        for connections in self._idle.values():
+            for _, writer in connections:
+                writer.close()
+        self._idle.clear()
+
+    async def _connect(self, key):
+        idle = self._idle.get(key)
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return (reader, writer), True
+            writer.close()
+        scheme, host, port = key
+        context = None
+        if scheme == 'https':
+            if self._ssl is None:
+                self._ssl = ssl.create_default_context()
+            context = self._ssl
+        return await asyncio.open_connection(host, port, ssl=context), False
+
+    @staticmethod
+    async def _read_response(reader, method):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed before the response")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if method == 'HEAD' or status in (204, 304) or status < 200:
+            content = b''
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if not size:
+                    # Skip any trailers
+                    while await reader.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            content = b''.join(chunks)
+        elif 'content-length' in headers:
+            content = await reader.readexactly(int(headers['content-length']))
+        else:
+            # Delimited by the server closing the connection
+            content = await reader.read()
+            headers['connection'] = 'close'
+
+        if headers.get('content-encoding') in ('gzip', 'deflate'):
+            # 32 + MAX_WBITS accepts both gzip and zlib streams
+            content = zlib.decompress(content, 32 + zlib.MAX_WBITS)
+            del headers['content-encoding']
+        return status, headers, content
+
+
+class AsyncGmail:
+    """
+    Coroutine versions of the Gmail calls the apps make.
+
+    Create and use it inside one event loop; `credentials` may be shared
+    with threads using the synchronous service.
+    """
+
+    def __init__(self, credentials, max_in_flight=MAX_IN_FLIGHT, max_sends=MAX_SENDS_IN_FLIGHT, api_endpoint=None,
+                 max_retries=5, base_delay=1.0, max_delay=32.0):
+        if not isinstance(credentials, SharedCredentials):
+            credentials = SharedCredentials(credentials)
+        self.credentials = credentials
+        api_endpoint = api_endpoint or API_ENDPOINT
+        # Only describes requests; it never sends any itself
+        self.service = build_service(credentials, api_endpoint)
+        # Each call to users() and below builds a new resource, which costs
+        # more than the request itself, so build them once
+        self.users = self.service.users()
+        self.messages = self.users.messages()
+        self.history = self.users.history()
+        document = json.loads(discovery_document(api_endpoint))
+        self.batch_uri = document['rootUrl'] + document.get('batchPath', 'batch')
+        self.connections = ConnectionPool()
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.sends = asyncio.Semaphore(max_sends)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.connections.close()
+
+    async def execute(self, request):
+        """
+        Send a googleapiclient HttpRequest and return its parsed response,
+        retrying transient failures. Raises HttpError like request.execute().
+        """
+        response, content = await self.call(request.methodId, request.method, request.uri, request.headers,
+                                            request.body)
+        return _parse(request, response, content)
+
+    async def call(self, method_id, method, uri, headers, body=None, units=None):
+        """
+        Send one authorized HTTP request, recorded as `method_id`, and return
+        (response, content). Error statuses raise HttpError once retries
+        run out. The call waits for its quota units (`units`, by default
+        those of `method_id`) like the synchronous ones.
+        """
+        units = units_for(method_id) if units is None else units
+        body = body or b''
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        attempt = 0
+        refreshed = False
+        while True:
+            request_headers = dict(headers)
+            token = await self._authorize(request_headers)
+            await scheduler.acquire_async(units)
+            start = time.perf_counter()
+            try:
+                async with self.in_flight:
+                    status, response_headers, content = await asyncio.wait_for(
+                        self.connections.request(method, uri, request_headers, body), TIMEOUT)
+            except OSError as e:
+                # Includes timeouts
+                recorder.record_call(method_id, time.perf_counter() - start, 'network_error', len(body))
+                error = e
+            else:
+                recorder.record_call(method_id, time.perf_counter() - start, status, len(body))
+                recorder.record_received(method_id, len(content))
+                response = httplib2.Response({'status': status, **response_headers})
+                if status < 300:
+                    scheduler.succeeded()
+                    return response, content
+                error = HttpError(response, content, uri=uri)
+                if status == 401 and not refreshed:
+                    refreshed = True
+                    await self._refresh(token)
+                    continue
+
+            if is_rate_limited(error):
+                scheduler.rate_limited(retry_after(error))
+            attempt += 1
+            if attempt > self.max_retries or not is_retryable(error):
+                raise error
+            delay = retry_after(error)
+            if delay is None:
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+            recorder.record_retry(method_id)
+            await asyncio.sleep(delay)
+
+    async def _authorize(self, headers):
+        if not self.credentials.valid:
+            # Refreshing blocks, so keep it off the event loop
+            await asyncio.to_thread(self.credentials.refresh, refresh_request())
+        token = self.credentials.token
+        self.credentials.apply(headers, token=token)
+        return token
+
+    async def _refresh(self, token):
+        # Requests rejected together all try this; only the first refreshes
+        if self.credentials.token == token:
+            await asyncio.to_thread(self.credentials.refresh, refresh_request())
+
+    async def list_message_ids(self, label_ids=('INBOX',), max_results=100, page_token=None):
+        """
+        List message ids for the given labels, returning (ids, next_page_token).
+        """
+        kwargs = {'userId': 'me', 'maxResults': max_results, 'labelIds': list(label_ids), 'fields': LIST_FIELDS}
+        if page_token:
+            kwargs['pageToken'] = page_token
+        results = await self.execute(self.messages.list(**kwargs))
+        return [message['id'] for message in results.get('messages', [])], results.get('nextPageToken')
+
+    async def get_message(self, message_id, format='full', **kwargs):
+        return await self.execute(
+            self.messages.get(userId='me', id=message_id, format=format, **kwargs))
+
+    async def get_many(self, message_ids, format='full', **kwargs):
+        """
+        Fetch the given messages concurrently.
+
+        Returns (messages, errors) like gmail_fetch.fetch_messages_batched:
+        one message failing never fails the others.
+        """
+        messages = {}
+        errors = {}
+
+        async def fetch(message_id):
+            try:
+                messages[message_id] = await self.get_message(message_id, format, **kwargs)
+            except (HttpError, OSError) as e:
+                errors[message_id] = e
+
+        await asyncio.gather(*(fetch(message_id) for message_id in dict.fromkeys(message_ids)))
+        return messages, errors
+
+    async def fetch_summaries(self, message_ids):
+        """
+        Fetch only what the inbox view needs for each message.
+        """
+        return await self.get_many(message_ids, format='metadata', metadataHeaders=SUMMARY_HEADERS,
+                                   fields=SUMMARY_FIELDS)
+
+    async def list_history(self, start_history_id, page_token=None, fields=None):
+        kwargs = {'userId': 'me', 'startHistoryId': start_history_id}
+        if page_token:
+            kwargs['pageToken'] = page_token
+        if fields:
+            kwargs['fields'] = fields
+        return await self.execute(self.history.list(**kwargs))
+
+    async def get_profile(self):
+        return await self.execute(self.users.getProfile(userId='me'))
+
+    async def send(self, raw):
+        """
+        Send a serialized message as a media upload.
+        """
+        media = MediaIoBaseUpload(io.BytesIO(raw), mimetype='message/rfc822')
+        async with self.sends:
+            return await self.execute(self.messages.send(userId='me', media_body=media))
+
+    async def batch(self, requests):
+        """
+        Send googleapiclient HttpRequests as batch HTTP requests of up to 100
+        calls, all batches at once. Returns a (response, error) pair per
+        request, in order. Failed calls are not retried.
+        """
+        results = []
+        batches = await asyncio.gather(*(self._batch(chunk) for chunk in chunked(list(requests), MAX_BATCH_SIZE)))
+        for batch in batches:
+            results.extend(batch)
+        return results
+
+    async def _batch(self, requests):
+        boundary = f'==============={uuid.uuid4().hex}=='
+        parts = []
+        for index, request in enumerate(requests):
+            url = urllib.parse.urlsplit(request.uri)
+            body = request.body or b''
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            head = [f'{request.method} {url.path}{"?" + url.query if url.query else ""} HTTP/1.1']
+            head += [f'{name}: {value}' for name, value in request.headers.items()]
+            if body:
+                head.append(f'Content-Length: {len(body)}')
+            parts.append(
+                f'--{boundary}\r\nContent-Type: application/http\r\nContent-Transfer-Encoding: binary\r\n'
+                f'Content-ID: <{index}>\r\n\r\n'.encode() + '\r\n'.join(head).encode() + b'\r\n\r\n' + body + b'\r\n'
+            )
+        parts.append(f'--{boundary}--\r\n'.encode())
+        # Charged per call inside the batch
+        units = sum(units_for(request.methodId) for request in requests)
+        response, content = await self.call('batch', 'POST', self.batch_uri,
+                                            {'Content-Type': f'multipart/mixed; boundary="{boundary}"'},
+                                            b''.join(parts), units=units)
+        return self._split_batch(requests, response['content-type'], content)
+
+    @staticmethod
+    def _split_batch(requests, content_type, content):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + content)
+        results = [(None, None)] * len(requests)
+        for part in message.iter_parts():
+            index = int(part['Content-ID'].strip('<>').rsplit('-', 1)[-1])
+            status_line, _, rest = part.get_payload(decode=True).partition(b'\r\n')
+            head, _, body = rest.partition(b'\r\n\r\n')
+            headers = {'status': int(status_line.split()[1])}
+            for line in head.decode('latin-1').split('\r\n'):
+                name, _, value = line.partition(':')
+                if name:
+                    headers[name.strip().lower()] = value.strip()
+            response = httplib2.Response(headers)
+            request = requests[index]
+            recorder.record_call(request.methodId, None, response.status)
+            recorder.record_received(request.methodId, len(body))
+            if response.status >= 300:
+                results[index] = (None, HttpError(response, body, uri=request.uri))
+            else:
+                try:
+                    results[index] = (_parse(request, response, body), None)
+                except HttpError as e:
+                    results[index] = (None, e)
+        return results
@@ -0,0 +1,310 @@
+"""
+Move attachments between disk and Gmail in bounded memory.
+
+Outgoing messages with attachments are written to a spool file part by part,
+base64-encoding each attachment a chunk at a time, and uploaded from that
+file through the media upload endpoint. Downloaded attachments are read
+and decoded a chunk at a time straight from the response into the
+destination file.
+"""
+import base64
+import io
+import mimetypes
+import os
+import tempfile
+import time
+import urllib.error
+import urllib.request
+import uuid
+import zlib
+from email import policy
+from email.utils import make_msgid
+
+from gmail_auth import refresh_request
+from metrics import ATTACHMENT_GET, recorder
+from quota import scheduler
+
+# A multiple of 57 bytes, so every chunk encodes to whole 76 character base64 lines
+ENCODE_CHUNK_SIZE = 57 * 16 * 1024
+
+# How much of an attachment download is read at a time
+DECODE_CHUNK_SIZE = 1024 * 1024
+
+# Resumable uploads must use a multiple of 256 KB
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+HEADER_POLICY = policy.default.clone(linesep='\n')
+
+
+def header(name, value):
+    """
+    Serialize one header, encoding non-ASCII names and filenames properly.
+    """
+    return HEADER_POLICY.fold_binary(*HEADER_POLICY.header_store_parse(name, value))
+
+
+class Attachment:
+    """
+    An attachment of a received message. Small attachments come inline in
+    `data`; larger ones have to be downloaded using `attachment_id`.
+    """
+
+    def __init__(self, message_id, filename, mime_type, size, attachment_id=None, data=None):
+        self.message_id = message_id
+        self.filename = filename
+        self.mime_type = mime_type
+        self.size = size
+        self.attachment_id = attachment_id
+        self.data = data
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + len(self.data or '')
+
+    def __repr__(self):
+        return f"Attachment({self.filename!r}, {self.mime_type!r}, {self.size})"
+
+
+class _StreamDecoder:
+    """
+    Decodes base64url text fed to it in arbitrary pieces into a file.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.pending = b''
+        self.written = 0
+
+    def feed(self, data):
+        data = self.pending + data
+        usable = len(data) - len(data) % 4
+        self.pending = data[usable:]
+        if usable:
+            self.written += self.f.write(base64.urlsafe_b64decode(data[:usable]))
+
+    def close(self):
+        # Gmail sometimes leaves out the padding
+        if self.pending:
+            self.written += self.f.write(base64.urlsafe_b64decode(self.pending + b'=' * (-len(self.pending) % 4)))
+            self.pending = b''
+        return self.written
+
+
+def _stream_data_field(response, decoder):
+    """
+    Feed the value of the "data" field of a JSON response to `decoder`,
+    reading the response a chunk at a time.
+    """
+    buffer = b''
+    # Skip ahead to the opening quote of the value
+    while True:
+        chunk = response.read(DECODE_CHUNK_SIZE)
+        if not chunk:
+            raise ValueError("Attachment response has no data")
+        buffer += chunk
+        key = buffer.find(b'"data"')
+        if key != -1:
+            quote = buffer.find(b'"', buffer.find(b':', key))
+            if quote != -1:
+                buffer = buffer[quote + 1:]
+                break
+    # Base64url never contains a quote, so the next one ends the value
+    while True:
+        end = buffer.find(b'"')
+        if end != -1:
+            decoder.feed(buffer[:end])
+            return decoder.close()
+        decoder.feed(buffer)
+        buffer = response.read(DECODE_CHUNK_SIZE)
+        if not buffer:
+            raise ValueError("Attachment response ended early")
+
+
+class _Decompressed:
+    """
+    A gzip (or zlib) encoded response, decompressed as it is read.
+    """
+
+    def __init__(self, response):
+        self.response = response
+        # 32 lets zlib tell gzip and zlib headers apart by itself
+        self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+
+    def read(self, size):
+        decompressor = self.decompressor
+        while True:
+            # At most `size` bytes come out at a time, however well the data compresses
+            if decompressor.unconsumed_tail:
+                data = decompressor.decompress(decompressor.unconsumed_tail, size)
+            else:
+                chunk = self.response.read(size)
+                if not chunk:
+                    return decompressor.flush()
+                data = decompressor.decompress(chunk, size)
+            # A chunk can hold nothing but gzip header; an empty read would look like the end
+            if data:
+                return data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.response.close()
+
+
+def _decompressed(response):
+    if response.headers.get('Content-Encoding', '').lower() in ('gzip', 'deflate'):
+        return _Decompressed(response)
+    return response
+
+
+def _open_attachment(service, attachment, credentials):
+    import httplib2
+    from googleapiclient.errors import HttpError
+
+    request = service.users().messages().attachments().get(
+        userId='me', messageId=attachment.message_id, id=attachment.attachment_id, fields='data'
+    )
+    headers = dict(request.headers)
+    if credentials is not None:
+        # Refreshes the access token if it has expired, then adds it
+        credentials.before_request(refresh_request(), 'GET', request.uri, headers)
+    with scheduler.call(ATTACHMENT_GET):
+        try:
+            # googleapiclient asks for gzip, which urllib leaves to us to undo
+            response = urllib.request.urlopen(urllib.request.Request(request.uri, headers=headers), timeout=60)
+        except urllib.error.HTTPError as e:
+            # Report it like any other API error, so callers can tell rate limits from bad ids
+            content = e.read()
+            if e.headers.get('Content-Encoding', '').lower() in ('gzip', 'deflate'):
+                content = zlib.decompress(content, 32 + zlib.MAX_WBITS)
+            raise HttpError(httplib2.Response({'status': e.code, **dict(e.headers)}), content, uri=request.uri)
+    return _decompressed(response)
+
+
+def save_attachment(service, attachment, path, credentials=None):
+    """
+    Write an attachment to `path` and return the number of bytes written.
+
+    The attachment endpoint returns the data base64url-encoded inside JSON.
+    Instead of reading the whole response, parsing it into a string and
+    decoding that, the response is read (and gunzipped) and decoded into
+    the file a chunk at a time, so memory use does not depend on the
+    attachment size.
+    `credentials` authorize the download; the service's own transport is
+    only used to build the request.
+    """
+    from googleapiclient.errors import HttpError
+
+    # Write to a temporary file first so a failed download never leaves half a file behind
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            decoder = _StreamDecoder(f)
+            if attachment.data is not None:
+                decoder.feed(attachment.data.encode('ascii'))
+                written = decoder.close()
+            else:
+                # Downloaded outside the service, so report the call here
+                start = time.perf_counter()
+                status = 200
+                try:
+                    with _open_attachment(service, attachment, credentials) as response:
+                        written = _stream_data_field(response, decoder)
+                except HttpError as e:
+                    status = e.resp.status
+                    raise
+                finally:
+                    recorder.record_call(ATTACHMENT_GET, time.perf_counter() - start, status)
+                recorder.record_received(ATTACHMENT_GET, written)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return written
+
+
+class SpooledMessage:
+    """
+    An outgoing message serialized to a file. Supports the parts of the
+    email.message API the outbox uses: header lookup and as_bytes().
+    """
+
+    def __init__(self, path, headers):
+        self.path = path
+        self.headers = headers
+
+    def __getitem__(self, name):
+        return self.headers.get(name.lower())
+
+    def as_bytes(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+
+def spool_message(directory, to, subject, body, attachments=(), sender=None):
+    """
+    Write a message with file attachments to a new file in `directory`.
+
+    Each attachment is read and base64-encoded in chunks, so memory use does
+    not depend on attachment size.
+    """
+    os.makedirs(directory, exist_ok=True)
+    boundary = f'=============={uuid.uuid4().hex}=='
+    message_id = make_msgid()
+    path = os.path.join(directory, f'{uuid.uuid4().hex}.eml')
+
+    with open(path, 'wb') as f:
+        f.write(header('MIME-Version', '1.0'))
+        f.write(header('Content-Type', f'multipart/mixed; boundary="{boundary}"'))
+        if sender:
+            f.write(header('From', sender))
+        f.write(header('To', to))
+        f.write(header('Subject', subject))
+        f.write(header('Message-ID', message_id))
+        f.write(b'\n')
+
+        f.write(f'--{boundary}\n'.encode())
+        f.write(header('Content-Type', 'text/plain; charset="utf-8"'))
+        f.write(header('Content-Transfer-Encoding', 'base64'))
+        f.write(b'\n')
+        f.write(base64.encodebytes(body.encode('utf-8')))
+
+        for attachment_path in attachments:
+            filename = os.path.basename(attachment_path)
+            mime_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            f.write(f'--{boundary}\n'.encode())
+            f.write(header('Content-Type', f'{mime_type}; name="{filename}"'))
+            f.write(header('Content-Disposition', f'attachment; filename="{filename}"'))
+            f.write(header('Content-Transfer-Encoding', 'base64'))
+            f.write(b'\n')
+            with open(attachment_path, 'rb') as source:
+                while True:
+                    chunk = source.read(ENCODE_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(base64.encodebytes(chunk))
+        f.write(f'--{boundary}--\n'.encode())
+
+    return SpooledMessage(path, {'to': to, 'subject': subject, 'message-id': message_id})
+
+
+def send_file(service, path):
+    """
+    Send the message in `path`, uploading it in chunks.
+    """
+    from googleapiclient.http import MediaFileUpload
+
+    media = MediaFileUpload(path, mimetype='message/rfc822', chunksize=UPLOAD_CHUNK_SIZE, resumable=True)
+    return service.users().messages().send(userId='me', media_body=media).execute()
+
+
+def send_bytes(service, raw):
+    """
+    Send a serialized message as a media upload, which skips the base64 and
+    JSON copies of the message that a `raw` request body needs.
+    """
+    from googleapiclient.http import MediaIoBaseUpload
+
+    media = MediaIoBaseUpload(io.BytesIO(raw), mimetype='message/rfc822')
+    return service.users().messages().send(userId='me', media_body=media).execute()
@@ -1,16 +1,43 @@
+import time
+# Taken before the other imports, so the startup timings include them
+STARTED = time.perf_counter()
 import tkinter as tk
-from tkinter import ttk, messagebox
-import pickle
+from tkinter import ttk, messagebox, filedialog
 import os.path
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from datetime import datetime
-import base64
-import email
+import sys
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
+# Shared Gmail helpers live in the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from message_store import MessageStore
+from mail_sync import (sync_mailbox, sync_threads, fetch_next_page_async, fetch_next_thread_page, has_more_pages,
+                       has_more_threads)
+from inbox_view import InboxView
+from background import BackgroundExecutor
+from body_cache import BodyCache, Prefetcher
+from gmail_fetch import fetch_messages_batched, find_message_by_rfc822_id
+from mime_parts import extract_content
+from attachments import spool_message, save_attachment
+from outbox import Outbox, send_item
+from gmail_auth import SCOPES, AuthError, load_credentials, refresh_credentials
+from mailbox_ops import (ACTIONS, FULL_SCOPE, BatchError, apply_locally, batch_delete, batch_modify, delete_locally,
+                         roll_back)
+from templates import welcome_template, merge, read_recipients
+from rules import RuleEngine, RuleError, load_rules
+from metrics import recorder
+from quota import BULK, INTERACTIVE, scheduler
+from stats_view import StatsWindow
+
+
+class StartupError(Exception):
+    """
+    Authentication failure raised on a worker thread and shown to the user before quitting.
+    """
+    def __init__(self, title, message):
+        super().__init__(message)
+        self.title = title
+
 class GmailApp:
     def __init__(self, root):
         self.root = root
@@ -18,13 +45,100 @@ class GmailApp:
         self.root.geometry("800x600")
         
         # Gmail API scope
-        self.SCOPES = ['https://www.googleapis.com/auth/gmail.readonly', 'https://www.googleapis.com/auth/gmail.send']
-        self.service = None
+        self.SCOPES = SCOPES
+        
+        # Gmail calls run on worker threads so the window stays responsive
+        self.executor = BackgroundExecutor(self.root)
+        self.refresh_task = None
+        self.page_task = None
+        
+        # Messages fetched per Gmail page; the view only keeps a window of rows in the widget
+        self.page_size = 100
+        
+        # Only download the headers shown in the inbox; set to False to compare with full fetches
+        self.summary_mode = True
+        
+        # Local copy of the inbox, shown immediately and refreshed incrementally
+        current_dir = os.path.dirname(os.path.abspath(__file__))
+        self.store = MessageStore(os.path.join(current_dir, 'messages.db'))
+        self.fresh_rows_shown = False
+        
+        # Saved login, renewed in the background before the access token expires
+        self.token_path = os.path.join(current_dir, 'token.pickle')
+        
+        # Recently opened and prefetched bodies, so opening them again is instant
+        self.body_cache = BodyCache()
+        self.prefetcher = Prefetcher(self.body_cache, self.fetch_bodies)
+        self.prefetch_job = None
+        self.search_job = None
+        
+        # Outgoing mail is queued on disk before it is sent, so a failed send
+        # or a crash mid-batch never loses a message or sends it twice
+        self.outbox = Outbox(os.path.join(current_dir, 'outbox.db'))
+        self.outbox_job = None
+        
+        # Compiled once and personalized per recipient
+        self.welcome_template = welcome_template()
+        
+        # Labeling, forwarding and auto-reply rules run on new mail after each sync
+        self.rules = self.load_rules(os.path.join(current_dir, 'rules.json'))
+        
+        # Gmail sending limits used for bulk welcome emails
+        self.send_rate = 10
+        self.daily_send_limit = 2000
+        
+        # API call and phase statistics window, opened from the Stats button
+        self.stats_window = None
         
         self.setup_gui()
+        self.inbox.reset()
+        if self.tree.get_children():
+            # Timed once Tk has drawn them
+            self.root.after_idle(self.record_startup, 'startup_cached_rows')
+        self.update_outbox()
         self.authenticate()
+
+    def load_rules(self, path):
+        """
+        Compile the rules file, if there is one. A broken file is reported
+        and no rules are run, rather than stopping the app.
+        """
+        try:
+            rules = load_rules(path)
+        except (OSError, RuleError) as e:
+            print(f"Failed to load rules: {e}")
+            messagebox.showerror("Error", f"Failed to load rules from {path}: {str(e)}")
+            return None
+        if rules is None:
+            return None
+        print(f"Loaded {len(rules.rules)} rules")
+        return RuleEngine(rules, self.outbox)
+
+    def record_startup(self, phase):
+        """
+        Record how long after launch the inbox first showed rows, either from
+        the local store or fresh from Gmail.
+        """
+        seconds = time.perf_counter() - STARTED
+        recorder.observe_phase(phase, seconds)
+        print(f"{phase}: {seconds * 1000:.0f} ms after launch")
         
     def setup_gui(self):
+        # Search box over the local index, filtering as you type
+        search_frame = ttk.Frame(self.root, padding=(10, 10, 10, 0))
+        search_frame.pack(fill=tk.X)
+        ttk.Label(search_frame, text="Search:").pack(side=tk.LEFT)
+        self.search_var = tk.StringVar()
+        self.search_var.trace_add('write', lambda *args: self.schedule_search())
+        search_entry = ttk.Entry(search_frame, textvariable=self.search_var)
+        search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        search_entry.bind('<Escape>', lambda event: self.search_var.set(""))
+
+        # Group reply chains into one expandable row per conversation
+        self.threaded_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(search_frame, text="Conversations", variable=self.threaded_var,
+                        command=self.toggle_threads).pack(side=tk.LEFT)
+        
         # Create main frame
         self.main_frame = ttk.Frame(self.root, padding="10")
         self.main_frame.pack(fill=tk.BOTH, expand=True)
@@ -42,7 +156,10 @@ class GmailApp:
         
         # Add scrollbar
         scrollbar = ttk.Scrollbar(self.main_frame, orient=tk.VERTICAL, command=self.tree.yview)
-        self.tree.configure(yscrollcommand=scrollbar.set)
+        
+        # Only a window of rows is kept in the widget; more are loaded while scrolling
+        self.inbox = InboxView(self.tree, scrollbar, self.store, on_need_more=self.load_more,
+                               on_window_change=self.update_range, on_viewport_change=self.schedule_prefetch)
         
         # Pack elements
         self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
@@ -56,8 +173,52 @@ class GmailApp:
         send_email_btn = ttk.Button(self.root, text="Send Email", command=self.open_email_composer)
         send_email_btn.pack(pady=5)
         
+        # Stats button: latency, traffic and quota per Gmail API call
+        stats_btn = ttk.Button(self.root, text="Stats", command=self.show_stats)
+        stats_btn.pack(pady=5)
+        
         # Bind double-click event
         self.tree.bind('<Double-1>', self.show_email_content)
+        
+        # Prefetch bodies around the selection cursor
+        self.tree.bind('<<TreeviewSelect>>', lambda event: self.schedule_prefetch())
+
+        # Right-click menu acting on every selected row at once; Delete trashes them
+        self.actions_menu = tk.Menu(self.root, tearoff=0)
+        for name in ACTIONS:
+            self.actions_menu.add_command(label=name, command=lambda name=name: self.run_action(name))
+        self.actions_menu.add_separator()
+        self.actions_menu.add_command(label="Delete forever", command=self.delete_forever)
+        self.tree.bind('<Button-3>', self.show_actions_menu)
+        self.tree.bind('<Delete>', lambda event: self.run_action("Trash"))
+        
+        # Progress indicator and cancel button for background requests
+        status_frame = ttk.Frame(self.root)
+        status_frame.pack(fill=tk.X, padx=10, pady=5)
+        self.range_label = ttk.Label(status_frame, text="")
+        self.range_label.pack(side=tk.LEFT)
+        self.status_label = ttk.Label(status_frame, text="")
+        self.status_label.pack(side=tk.LEFT, padx=10)
+        self.outbox_label = ttk.Label(status_frame, text="")
+        self.outbox_label.pack(side=tk.LEFT, padx=10)
+        self.cancel_btn = ttk.Button(status_frame, text="Cancel", command=self.executor.cancel_all, state=tk.DISABLED)
+        self.cancel_btn.pack(side=tk.RIGHT)
+        self.progress = ttk.Progressbar(status_frame, mode='indeterminate', length=150)
+        self.progress.pack(side=tk.RIGHT, padx=5)
+        self.executor.on_activity = self.update_activity
+
+    def update_activity(self, pending):
+        """
+        Show or hide the progress indicator as background tasks start and finish.
+        """
+        if pending:
+            self.progress.start(10)
+            self.status_label.config(text=f"Working... ({pending} pending)")
+            self.cancel_btn.config(state=tk.NORMAL)
+        else:
+            self.progress.stop()
+            self.status_label.config(text="")
+            self.cancel_btn.config(state=tk.DISABLED)
 
 
     def open_email_composer(self):
@@ -75,11 +236,16 @@ class GmailApp:
                 messagebox.showerror("Error", "All fields (To, Subject, Message) must be filled.")
                 return
             
-            # Call the send_email method
-            success = self.send_email(recipient, subject, body)
-            if success:
-                # Close the composer window on success
-                composer_window.destroy()
+            # Queue the email and close the composer straight away; it is sent in the background
+            self.send_email(recipient, subject, body, attachments)
+            composer_window.destroy()
+
+        def add_attachments():
+            # Files are only read when the message is written to the outbox
+            attachments.extend(filedialog.askopenfilenames(parent=composer_window))
+            attachments_label.config(text=", ".join(os.path.basename(path) for path in attachments))
+
+        attachments = []
 
         composer_window = tk.Toplevel(self.root)
         composer_window.title("Compose Email")
@@ -98,6 +264,12 @@ class GmailApp:
         body_text = tk.Text(composer_window, height=15)
         body_text.pack(fill=tk.BOTH, padx=10, pady=5, expand=True)
         
+        # Attachments
+        attach_btn = ttk.Button(composer_window, text="Attach Files", command=add_attachments)
+        attach_btn.pack(pady=5)
+        attachments_label = ttk.Label(composer_window, text="", wraplength=450)
+        attachments_label.pack(pady=5)
+        
         # Send button
         send_btn = ttk.Button(
             composer_window, 
@@ -109,38 +281,36 @@ class GmailApp:
         labeli = ttk.Label(composer_window, text="Note: Please enter the email address in the 'To' field")
         labeli.pack(pady=5)
 
-    def send_email(self, recipient, subject, body):
+    def send_item(self, item):
         """
-        Send an email using the Gmail API.
+        Send a message from the outbox. Runs on a worker thread.
+        
+        The message is uploaded as is through the media endpoint, so it is
+        never base64-encoded into a JSON body; messages with attachments are
+        streamed from their spool file in chunks.
         """
-        try:
-            # Create email structure
-            from email.mime.text import MIMEText
-            import base64
-
-            message = MIMEText(body)
-            message['to'] = recipient
-            message['subject'] = subject
-
-            raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
-            create_message = {'raw': raw_message}
-
-            # Use Gmail API to send the email
-            self.service.users().messages().send(userId="me", body=create_message).execute()
-
-            messagebox.showinfo("Success", "Email sent successfully!")
-            return True
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to send email: {e}")
-            return False
-
+        return send_item(self.executor.service(), item)
 
+    def find_sent(self, rfc822_id):
+        """
+        Gmail id of an already sent message with this Message-ID, if any. Runs on a worker thread.
+        """
+        return find_message_by_rfc822_id(self.executor.service(), rfc822_id)
 
-    def send_email(self, recipient, subject, message_body):
+    def send_email(self, recipient, subject, message_body, attachments=()):
         """
-        Send an email using the Gmail API.
+        Queue an email for sending through the Gmail API.
         """
         try:
+            if attachments:
+                # Write the message to disk a chunk at a time on a worker thread, so
+                # large attachments are never held in memory
+                return self.executor.submit(
+                    spool_message, self.outbox.spool_dir, recipient, subject, message_body, list(attachments),
+                    on_success=self.queue_message,
+                    on_error=lambda e: messagebox.showerror("Error", f"Failed to send email: {e}")
+                )
+            
             # Create the email content
             message = MIMEMultipart()
             message['to'] = recipient
@@ -150,126 +320,139 @@ class GmailApp:
             # Add the message body
             message.attach(MIMEText(message_body, 'plain'))
             
-            # Encode the email
-            raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
-            create_message = {'raw': raw_message}
-            
-            # Send the email
-            send_message = self.service.users().messages().send(userId="me", body=create_message).execute()
-            print(f"Email sent successfully to {recipient}")
-            messagebox.showinfo("Success", f"Email sent successfully to {recipient}")
+            self.queue_message(message)
         
         except Exception as e:
-            print(f"An error occurred while sending email: {e}")
+            print(f"An error occurred while queueing email: {e}")
             messagebox.showerror("Error", f"Failed to send email: {e}")
 
+    def queue_message(self, message):
+        """
+        Save a message in the outbox and start sending it.
+        """
+        outbox_id = self.outbox.enqueue(message)
+        print(f"Queued email to {message['to']} (outbox id {outbox_id})")
+        self.update_outbox()
+        self.drain_outbox()
+        return outbox_id
+
+    def drain_outbox(self):
+        """
+        Send everything that is due in the outbox on a worker thread.
+        """
+        if self.outbox_job is not None:
+            self.root.after_cancel(self.outbox_job)
+            self.outbox_job = None
+        
+        # Queued messages wait until we are signed in
+        if self.executor.credentials is None:
+            return
+        
+        self.executor.submit(
+            lambda: self.outbox.drain(self.send_item, self.find_sent),
+            on_success=self.show_sent,
+            on_error=lambda e: print(f"An error occurred while sending the outbox: {e}")
+        )
+
+    def show_sent(self, results):
+        """
+        Report the outcome of an outbox drain. Runs on the Tk thread.
+        """
+        sent = []
+        for item, error in results:
+            if error is None:
+                print(f"Email sent successfully to {item.recipient}")
+                sent.append(item)
+            elif self.outbox.status(item.id) == 'failed':
+                print(f"An error occurred while sending email: {error}")
+                messagebox.showerror("Error", f"Failed to send email to {item.recipient}: {error}")
+            else:
+                print(f"Sending email to {item.recipient} failed, will retry: {error}")
+        
+        if len(sent) == 1:
+            messagebox.showinfo("Success", f"Email sent successfully to {sent[0].recipient}")
+        elif sent:
+            messagebox.showinfo("Success", f"{len(sent)} emails sent successfully")
+        
+        self.update_outbox()
+        
+        # Try again once the next queued message is due
+        delay = self.outbox.next_retry_delay()
+        if delay is not None and self.outbox_job is None:
+            self.outbox_job = self.root.after(int(delay * 1000) + 100, self.drain_outbox)
+
+    def update_outbox(self):
+        """
+        Show how many messages are still waiting to be sent.
+        """
+        counts = self.outbox.counts()
+        queued = counts.get('pending', 0) + counts.get('sending', 0)
+        self.outbox_label.config(text=f"Outbox: {queued} queued" if queued else "")
+
     
     
     def authenticate(self):
-        creds = None
+        """
+        Load or create credentials on a worker thread, then fetch the inbox.
+        """
+        self.executor.submit(self.load_credentials, on_success=self.on_authenticated,
+                             on_error=self.on_authentication_error)
+
+    def load_credentials(self):
+        """
+        Runs on a worker thread. Returns the user's email address after a
+        first-time login, otherwise None.
+        """
+        user_email = None
         try:
             # Get the directory of the current script
             current_dir = os.path.dirname(os.path.abspath(__file__))
-            token_path = os.path.join(current_dir, 'token.pickle')
+            token_path = self.token_path
             credentials_path = os.path.join(current_dir, 'credentials.json')
 
             # Debug prints
             print(f"Looking for credentials at: {credentials_path}")
             print(f"Looking for token at: {token_path}")
             
-            # Check for token.pickle
-            if os.path.exists(token_path):
-                try:
-                    with open(token_path, 'rb') as token:
-                        creds = pickle.load(token)
-                    print("Loaded existing token.pickle")
-                except Exception as e:
-                    print(f"Error loading token.pickle: {e}")
-                    if os.path.exists(token_path):
-                        os.remove(token_path)
-                    creds = None
-
-            # If credentials are not valid or don't exist
-            if not creds or not creds.valid:
-                # Check for credentials.json first
-                if not os.path.exists(credentials_path):
-                    messagebox.showerror(
-                        "Error", 
-                        f"credentials.json not found at {credentials_path}!\n\n"
-                        "Please ensure the file exists and has proper permissions."
-                    )
-                    self.root.quit()
-                    return
-
-                if creds and creds.expired and creds.refresh_token:
-                    try:
-                        creds.refresh(Request())
-                        print("Refreshed expired credentials")
-                    except Exception as e:
-                        print(f"Error refreshing credentials: {e}")
-                        creds = None
-                
-                if not creds:
-                    try:
-                        print("Attempting to create new credentials flow...")
-                        flow = InstalledAppFlow.from_client_secrets_file(
-                            credentials_path, self.SCOPES)
-                        creds = flow.run_local_server(port=0)
-                        print("Successfully created new credentials")
-
-                        # Get user email from credentials
-                        try:
-                            self.service = build('gmail', 'v1', credentials=creds)
-                            profile = self.service.users().getProfile(userId='me').execute()
-                            user_email = profile['emailAddress']
-                            print(f"User email: {user_email}")
-                            
-                            # Send welcome email after new authentication
-                            self.send_welcome_email(user_email)
-                            
-                        except Exception as e:
-                            print(f"Error getting user profile: {e}")
-
-                    except Exception as e:
-                        error_msg = (
-                            f"Failed to authenticate: {str(e)}\n\n"
-                            f"Credentials path: {credentials_path}\n"
-                            "Please ensure:\n"
-                            "1. credentials.json exists in the same directory as this script\n"
-                            "2. The file has proper read permissions\n"
-                            "3. The file is valid and not corrupted"
-                        )
-                        messagebox.showerror("Authentication Error", error_msg)
-                        self.root.quit()
-                        return
-
-                # Save valid credentials
-                try:
-                    with open(token_path, 'wb') as token:
-                        pickle.dump(creds, token)
-                    print("Saved new token.pickle")
-                except Exception as e:
-                    print(f"Error saving token.pickle: {e}")
-
-            # Create Gmail API service
-            print("Creating Gmail API service...")
-            self.service = build('gmail', 'v1', credentials=creds)
-            
-            # Test the connection
+            # Load token.pickle, refresh it, or log in through the browser
             try:
-                self.service.users().getProfile(userId='me').execute()
-                print("Authentication successful!")
+                creds, new_login = load_credentials(token_path, credentials_path, self.SCOPES)
+            except AuthError as e:
+                raise StartupError(
+                    "Error", 
+                    f"{e}!\n\n"
+                    "Please ensure the file exists and has proper permissions."
+                )
             except Exception as e:
-                messagebox.showerror(
-                    "Connection Error",
-                    f"Failed to connect to Gmail API: {str(e)}"
+                error_msg = (
+                    f"Failed to authenticate: {str(e)}\n\n"
+                    f"Credentials path: {credentials_path}\n"
+                    "Please ensure:\n"
+                    "1. credentials.json exists in the same directory as this script\n"
+                    "2. The file has proper read permissions\n"
+                    "3. The file is valid and not corrupted"
                 )
-                self.root.quit()
-                return
+                raise StartupError("Authentication Error", error_msg)
 
-            # Fetch emails after successful authentication
-            self.fetch_emails()
+            # Services are built on each worker from the discovery document
+            # bundled with the client library, so this makes no request
+            self.executor.set_credentials(creds)
+            print("Authentication successful!")
+
+            if new_login:
+                print("Successfully created new credentials")
 
+                # Get user email from credentials
+                try:
+                    profile = self.executor.service().users().getProfile(
+                        userId='me', fields='emailAddress').execute()
+                    user_email = profile['emailAddress']
+                    print(f"User email: {user_email}")
+                except Exception as e:
+                    print(f"Error getting user profile: {e}")
+
+        except StartupError:
+            raise
         except Exception as e:
             error_msg = (
                 f"An unexpected error occurred: {str(e)}\n\n"
@@ -278,150 +461,399 @@ class GmailApp:
                 "2. File permissions\n"
                 "3. Validity of credentials.json"
             )
-            messagebox.showerror("Authentication Error", error_msg)
-            self.root.quit()
+            raise StartupError("Authentication Error", error_msg)
+
+        return user_email
+
+    def on_authenticated(self, user_email):
+        # Send welcome email after new authentication
+        if user_email:
+            self.send_welcome_email(user_email)
+
+        # Resume sending anything left in the outbox by the last session
+        self.drain_outbox()
+
+        # Fetch emails after successful authentication
+        self.fetch_emails()
+
+        # Keep the access token fresh so no request waits on a refresh
+        self.refresh_token()
+
+    def refresh_token(self):
+        """
+        Renew the access token on a worker thread shortly before it expires,
+        then schedule the next renewal.
+        """
+        def handle_error(e):
+            print(f"Token refresh failed: {e}")
+            self.schedule_token_refresh(60)
+
+        self.executor.submit(refresh_credentials, self.executor.credentials, self.token_path,
+                             on_success=self.schedule_token_refresh, on_error=handle_error)
+
+    def schedule_token_refresh(self, delay):
+        if delay is not None:
+            self.root.after(int(delay * 1000), self.refresh_token)
+
+    def on_authentication_error(self, error):
+        title = getattr(error, 'title', "Authentication Error")
+        messagebox.showerror(title, str(error))
+        self.root.quit()
+
+    def build_welcome_email(self, user_email, values=None):
+        """
+        Render the welcome email for a new user. `values` fills the template's
+        merge fields, such as "name".
+        """
+        return self.welcome_template.render(user_email, {'name': 'User', **(values or {})})
 
     def send_welcome_email(self, user_email):
         """
         Send an automated welcome email to new users.
         """
         try:
-            # Create message container
-            message = MIMEMultipart()
-            message['to'] = user_email
-            message['from'] = user_email  # Add from field
-            message['subject'] = 'Welcome to Our Platform!'
-
-            # Create the HTML version of your message
-            html_content = """
-            <html>
-              <body>
-                <h2>Welcome to Our Platform!</h2>
-                <p>Dear User,</p>
-                <p>Thank you for signing up! We're excited to have you on board.</p>
-                <p>Here are a few things you can do to get started:</p>
-                <ul>
-                  <li>Complete your profile</li>
-                  <li>Explore our features</li>
-                  <li>Connect with other users</li>
-                </ul>
-                <p>If you have any questions, feel free to reach out to our support team.</p>
-                <p>Best regards,<br>Vaishvi (231081074) , Zoher (231080077)</p>
-              </body>
-            </html>
-            """
-
-            # Convert the message to MIMEText
-            mime_text = MIMEText(html_content, 'html')
-            message.attach(mime_text)
-
-            # Encode the message
-            raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
-            
-            # Create the message body
-            create_message = {
-                'raw': raw_message
-            }
-
-            # Send the email
-            send_message = (self.service.users().messages()
-                          .send(userId="me", body=create_message).execute())
-            
-            print(f"Welcome email sent successfully to {user_email}")
-            messagebox.showinfo("Success", f"Welcome email sent to {user_email}")
-            return send_message
+            # Queued rather than sent inline, so first login never waits on it
+            return self.queue_message(self.build_welcome_email(user_email))
 
         except Exception as e:
-            print(f"An error occurred while sending welcome email: {e}")
+            print(f"An error occurred while queueing welcome email: {e}")
             messagebox.showerror("Error", f"Failed to send welcome email: {str(e)}")
             return None
         
     def fetch_emails(self):
-        try:
-        # Clear existing items
-            for item in self.tree.get_children():
-                self.tree.delete(item)
-
-            print("Fetching emails...")
-            results = self.service.users().messages().list(
-            userId='me', maxResults=10, labelIds=['INBOX']
-            ).execute()
-            messages = results.get('messages', [])
-
-            if not messages:
-                print("No emails found")
-                messagebox.showinfo("Info", "No emails found in the inbox.")
-                return
+        """
+        Refresh the inbox in the background, cancelling any refresh still in
+        flight, which stops at its next Gmail read.
+        """
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
 
-            for message in messages:
-                try:
-                    msg = self.service.users().messages().get(
-                    userId='me', id=message['id'], format='full'
-                    ).execute()
-                    headers = msg['payload']['headers']
-                    subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
-                    sender = next((h['value'] for h in headers if h['name'] == 'From'), 'No Sender')
-                    date = next((h['value'] for h in headers if h['name'] == 'Date'), 'No Date')
-
-                # Parse and format date
-                    try:
-                        parsed_date = email.utils.parsedate_to_datetime(date)
-                        formatted_date = parsed_date.strftime('%Y-%m-%d %H:%M')
-                    except:
-                        formatted_date = "Invalid Date"
-
-                    self.tree.insert('', tk.END, values=(sender, subject, formatted_date), iid=message['id'])
-                except Exception as e:
-                    print(f"Error processing message: {e}")
+        def handle_error(e):
+            print(f"Error fetching emails: {e}")
+            messagebox.showerror("Error", f"Could not fetch emails: {e}")
 
-                print("Emails fetched successfully")
-        except Exception as e:
-                print(f"Error fetching emails: {e}")
-                messagebox.showerror("Error", f"Could not fetch emails: {e}")
+        print("Fetching emails...")
+        self.refresh_task = self.executor.submit(self.load_summaries, self.inbox.threaded,
+                                                 on_success=self.show_summaries, on_error=handle_error)
 
-            
-    def show_email_content(self, event):
-        item_id = self.tree.selection()[0]
+    def load_summaries(self, threaded=False):
+        """
+        Sync the local store with Gmail. Runs on a worker thread.
+
+        In conversation view the newest threads are synced instead, so each
+        changed conversation costs one request however long it is, and
+        unchanged ones none.
+        """
+        with recorder.phase('sync'):
+            if threaded:
+                return sync_threads(self.executor.service(), self.store, max_results=self.page_size,
+                                    summary_mode=self.summary_mode)
+            return sync_mailbox(self.executor.service(), self.store, max_results=self.page_size,
+                                summary_mode=self.summary_mode, rules=self.rules)
+
+    def toggle_threads(self):
+        """
+        Switch the inbox between one row per message and one per conversation.
+        """
+        self.inbox.set_threaded(self.threaded_var.get())
+        if self.executor.credentials is not None:
+            self.fetch_emails()
+
+    def show_summaries(self, stats):
+        """
+        Redraw the inbox view after a sync. Runs on the Tk thread.
+        """
+        print(f"Emails fetched successfully ({stats['mode']} sync): {stats['added']} added, "
+              f"{stats['removed']} removed, {stats['relabelled']} relabelled, {stats['errors']} errors, "
+              f"{stats['payload_bytes']} payload bytes, {stats['parse_ms']:.1f} ms parse")
+        rules = stats.get('rules')
+        if rules:
+            print(f"Rules matched {rules['matched']} new emails: {rules['relabelled']} relabelled, "
+                  f"{rules['forwarded']} forwarded, {rules['replied']} replied, {rules['errors']} errors")
+            if rules['forwarded'] or rules['replied']:
+                # Forwards and replies were queued on the worker thread
+                self.update_outbox()
+                self.drain_outbox()
+        with recorder.phase('render_inbox'):
+            self.inbox.reload()
+
+        if not self.fresh_rows_shown:
+            self.fresh_rows_shown = True
+            self.root.after_idle(self.record_startup, 'startup_fresh_rows')
+
+        if not self.tree.get_children():
+            print("No emails found")
+            messagebox.showinfo("Info", "No emails found in the inbox.")
+
+    def show_stats(self):
+        """
+        Open the API stats window, or bring it to the front if it is already open.
+        """
+        if self.stats_window is not None and self.stats_window.window.winfo_exists():
+            self.stats_window.window.lift()
+        else:
+            self.stats_window = StatsWindow(self.root, recorder)
+
+    def schedule_search(self):
+        """
+        Search once typing pauses instead of on every keystroke.
+        """
+        if self.search_job is not None:
+            self.root.after_cancel(self.search_job)
+        self.search_job = self.root.after(150, self.search_emails)
+
+    def search_emails(self):
+        """
+        Show local search results, or the inbox again when the search box is empty.
+        """
+        self.search_job = None
+        self.inbox.search(self.search_var.get())
+
+    def load_more(self):
+        """
+        Page older messages in from Gmail once the user scrolls past the stored ones.
+        """
+        if self.page_task is not None and self.page_task.active:
+            return
+
+        def handle_loaded(added):
+            print(f"Loaded {added} more {'conversations' if self.inbox.threaded else 'emails'}")
+            if added:
+                self.inbox.extend()
+
+        if self.inbox.threaded:
+            if has_more_threads(self.store):
+                self.page_task = self.executor.submit(
+                    lambda: fetch_next_thread_page(self.executor.service(), self.store, max_results=self.page_size,
+                                                   summary_mode=self.summary_mode),
+                    on_success=handle_loaded,
+                    on_error=lambda e: print(f"Error loading more conversations: {e}")
+                )
+            return
+        if not has_more_pages(self.store):
+            return
+
+        # The page's messages are fetched concurrently on the asyncio loop
+        self.page_task = self.executor.submit_async(
+            lambda: fetch_next_page_async(self.executor.async_client(), self.store, max_results=self.page_size,
+                                          summary_mode=self.summary_mode),
+            on_success=handle_loaded,
+            on_error=lambda e: print(f"Error loading more emails: {e}")
+        )
+
+    def show_actions_menu(self, event):
+        """
+        Open the actions menu, selecting the row under the cursor unless it
+        is already part of the selection.
+        """
+        item = self.tree.identify_row(event.y)
+        if item and item not in self.tree.selection():
+            self.tree.selection_set(item)
+        self.actions_menu.tk_popup(event.x_root, event.y_root)
+
+    def run_action(self, name):
+        """
+        Apply one of mailbox_ops.ACTIONS to the selected messages.
+
+        The change shows in the inbox straight away; Gmail is then updated in
+        batchModify calls of up to 1000 messages each, and the messages it
+        did not accept get their old labels back.
+        """
+        message_ids = self.inbox.message_ids(self.tree.selection())
+        if not message_ids or self.executor.credentials is None:
+            return
+        add_labels, remove_labels = ACTIONS[name]
+        previous = apply_locally(self.store, message_ids, add_labels, remove_labels)
+        self.inbox.reload()
+        self.executor.submit(
+            lambda: batch_modify(self.executor.service(), message_ids, add_labels, remove_labels),
+            on_success=lambda count: print(f"{name}: {count} messages"),
+            on_error=lambda e: self.action_failed(name, previous, e)
+        )
+
+    def delete_forever(self):
+        """
+        Permanently delete the selected messages, after asking.
+        """
+        message_ids = self.inbox.message_ids(self.tree.selection())
+        if not message_ids or self.executor.credentials is None:
+            return
+        if not messagebox.askyesno("Delete forever", f"Permanently delete {len(message_ids)} messages? "
+                                                     "This cannot be undone."):
+            return
+        previous = delete_locally(self.store, message_ids)
+        self.inbox.reload()
+
+        def on_error(e):
+            self.action_failed("Delete forever", previous, e)
+
+        def submit_delete():
+            self.executor.submit(
+                self.delete_messages, message_ids,
+                on_success=lambda count: print(f"Deleted {count} messages"),
+                on_error=on_error
+            )
+
+        def on_upgraded(creds):
+            # Swapped on the Tk thread, so no worker replaces the pool under the others
+            self.executor.set_credentials(creds)
+            submit_delete()
+
+        # Permanent deletion needs full mail access, which is only asked for the first time it is used.
+        # The login can open a browser, so it runs as its own task, before the delete is submitted.
+        if self.executor.credentials.has_scopes([FULL_SCOPE]):
+            submit_delete()
+        else:
+            self.executor.submit(self.load_full_access, on_success=on_upgraded, on_error=on_error)
+
+    def load_full_access(self):
+        """
+        Load credentials that also grant full mail access, logging in again
+        if needed. Runs on a worker thread.
+        """
+        credentials_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'credentials.json')
+        creds, _ = load_credentials(self.token_path, credentials_path, self.SCOPES + [FULL_SCOPE])
+        return creds
+
+    def delete_messages(self, message_ids):
+        """
+        Delete messages in batchDelete calls. Runs on a worker thread.
+        """
         try:
-            # Fetch full message content
-            message = self.service.users().messages().get(
-                userId='me', id=item_id, format='full'
-            ).execute()
-            
-            # Extract message body
-            if 'parts' in message['payload']:
-                parts = message['payload']['parts']
-                body = ''
-                for part in parts:
-                    if part['mimeType'] == 'text/plain':
-                        if 'data' in part['body']:
-                            body = base64.urlsafe_b64decode(
-                                part['body']['data']
-                            ).decode('utf-8')
-                            break
-            else:
-                if 'data' in message['payload']['body']:
-                    body = base64.urlsafe_b64decode(
-                        message['payload']['body']['data']
-                    ).decode('utf-8')
-                else:
-                    body = "No text content available"
-            
-            # Create new window to display email content
-            content_window = tk.Toplevel(self.root)
-            content_window.title("Email Content")
-            content_window.geometry("600x400")
-            
-            # Add text widget
-            text_widget = tk.Text(content_window, wrap=tk.WORD, padx=10, pady=10)
-            text_widget.pack(fill=tk.BOTH, expand=True)
-            
-            # Insert email content
-            text_widget.insert(tk.END, body)
-            text_widget.config(state=tk.DISABLED)
-            
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to fetch email content: {str(e)}")
+            count = batch_delete(self.executor.service(), message_ids)
+        except BatchError as e:
+            # Whatever was deleted before the failure stays deleted
+            self.store.delete(e.done)
+            raise
+        self.store.delete(message_ids)
+        return count
+
+    def action_failed(self, name, previous, error):
+        """
+        Undo an action in the local store for the messages Gmail did not accept.
+        """
+        print(f"{name} failed: {error}")
+        roll_back(self.store, previous, error)
+        self.inbox.reload()
+        messagebox.showerror("Error", f"{name} failed: {str(error)}")
+
+    def update_range(self, first, last, total):
+        self.range_label.config(text=f"Showing {first}-{last} of {total}" if total else "")
+
+    def show_email_content(self, event):
+        # Double-clicking a conversation expands it rather than opening a message
+        item_id = self.inbox.message_id(self.tree.selection()[0])
+        if item_id is None:
+            return
+        
+        # Bodies we have already seen or prefetched open immediately
+        content = self.body_cache.get(item_id)
+        if content is not None:
+            self.open_content_window(content)
+            return
+
+        # The user is waiting, so this goes ahead of syncs and bulk sends in the Gmail quota
+        self.executor.submit(
+            self.load_email_body, item_id, on_success=self.open_content_window,
+            on_error=lambda e: messagebox.showerror("Error", f"Failed to fetch email content: {str(e)}"),
+            priority=INTERACTIVE
+        )
+
+    def load_email_body(self, item_id):
+        """
+        Fetch a message and extract its plain text body and attachments. Runs on a worker thread.
+        """
+        # Fetch full message content
+        message = self.executor.service().users().messages().get(
+            userId='me', id=item_id, format='full'
+        ).execute()
+        
+        with recorder.phase('extract_body'):
+            content = extract_content(message)
+        self.body_cache.put(item_id, content)
+        self.store.index_body(item_id, content.body)
+        return content
+
+    def schedule_prefetch(self):
+        """
+        Prefetch bodies once scrolling or cursor movement has settled.
+        """
+        if self.prefetch_job is not None:
+            self.root.after_cancel(self.prefetch_job)
+        self.prefetch_job = self.root.after(200, self.prefetch_bodies)
+
+    def prefetch_bodies(self):
+        self.prefetch_job = None
+        if self.executor.credentials is None:
+            return
+        
+        # The selected row and its neighbours first, then the rest of the visible rows
+        wanted = []
+        for item in self.tree.selection():
+            wanted += [item, self.tree.next(item), self.tree.prev(item)]
+        wanted += self.inbox.visible_rows()
+        wanted = [self.inbox.message_id(item) for item in wanted if item]
+        self.prefetcher.request([message_id for message_id in wanted if message_id])
+
+    def fetch_bodies(self, message_ids):
+        """
+        Fetch and decode several bodies in one batch. Runs on the prefetch thread.
+        """
+        # Speculative, so it gives way to everything else in the Gmail quota
+        with scheduler.priority(BULK):
+            fetched, _ = fetch_messages_batched(self.executor.service(), message_ids, format='full')
+        contents = {message_id: extract_content(message) for message_id, message in fetched.items()}
+        
+        # Make the downloaded bodies searchable
+        self.store.index_bodies({message_id: content.body for message_id, content in contents.items()})
+        return contents
+
+    def open_content_window(self, content):
+        # Create new window to display email content
+        content_window = tk.Toplevel(self.root)
+        content_window.title("Email Content")
+        content_window.geometry("600x400")
+        
+        # One button per attachment, saving it to disk when clicked
+        if content.attachments:
+            attachment_frame = ttk.Frame(content_window, padding=(10, 5))
+            attachment_frame.pack(side=tk.BOTTOM, fill=tk.X)
+            ttk.Label(attachment_frame, text="Attachments:").pack(side=tk.LEFT)
+            for attachment in content.attachments:
+                ttk.Button(
+                    attachment_frame,
+                    text=f"{attachment.filename} ({attachment.size // 1024} KB)",
+                    command=lambda a=attachment: self.download_attachment(a)
+                ).pack(side=tk.LEFT, padx=2)
+        
+        # Add text widget
+        text_widget = tk.Text(content_window, wrap=tk.WORD, padx=10, pady=10)
+        text_widget.pack(fill=tk.BOTH, expand=True)
+        
+        # Insert email content
+        with recorder.phase('render_email'):
+            text_widget.insert(tk.END, content.body)
+        text_widget.config(state=tk.DISABLED)
+
+    def download_attachment(self, attachment):
+        """
+        Ask where to save an attachment and download it in the background.
+        """
+        path = filedialog.asksaveasfilename(initialfile=attachment.filename)
+        if not path:
+            return
+        
+        def handle_saved(size):
+            print(f"Saved {attachment.filename} to {path} ({size} bytes)")
+            messagebox.showinfo("Saved", f"Saved {attachment.filename}")
+        
+        # Decoded straight to disk in chunks, so large attachments never sit in memory decoded
+        self.executor.submit(
+            lambda: save_attachment(self.executor.service(), attachment, path, self.executor.credentials),
+            on_success=handle_saved,
+            on_error=lambda e: messagebox.showerror("Error", f"Failed to save attachment: {str(e)}"),
+            priority=INTERACTIVE
+        )
             
     def process_new_user_signup(self, user_email):
         """
@@ -429,16 +861,71 @@ class GmailApp:
         Call this method when a new user signs up.
         """
         try:
-            # Send welcome email
+            # Send welcome email; it reports success or failure once sent
             self.send_welcome_email(user_email)
             
             # You can add additional new user processing here
-            messagebox.showinfo("Success", f"Welcome email sent to {user_email}")
             
         except Exception as e:
             messagebox.showerror("Error", f"Failed to process new user: {str(e)}")
 
+    def process_new_user_signups(self, signups, on_done=None):
+        """
+        Send welcome emails to a whole batch of new users.
+        
+        `signups` holds email addresses, or dicts of merge fields with an
+        "email" key (e.g. {"email": ..., "name": ...}) to personalize each
+        message.
+        
+        All the emails are saved in the outbox first, so a crash mid-batch
+        loses nothing and resumes without sending anyone a second copy. They
+        then go out concurrently but within the per-second and per-day
+        sending quotas; rate limited sends are retried. `on_done` is called
+        on the Tk thread with the BulkReport, which holds the outcome for
+        every recipient.
+        """
+        messages = merge(self.welcome_template, signups, defaults={'name': 'User'})
+
+        def handle_result(result):
+            # Called from the sending threads as each recipient finishes
+            if result.status != 'sent':
+                print(f"Welcome email to {result.recipient.recipient} {result.status}: {result.error}")
+
+        def handle_done(report):
+            summary = report.as_dict()
+            print(f"Bulk welcome emails finished: {summary}")
+            self.update_outbox()
+            if on_done:
+                on_done(report)
+            messagebox.showinfo(
+                "Bulk Send Complete",
+                f"Sent {summary['sent']} of {summary['recipients']} welcome emails "
+                f"({summary['failed']} failed, {summary['deferred']} deferred by the daily quota)."
+            )
+            # Anything left over is retried by the outbox
+            self.show_sent([])
+
+        return self.executor.submit(
+            lambda: self.outbox.send_bulk(messages, self.send_item, self.find_sent, on_result=handle_result,
+                                          per_second=self.send_rate, per_day=self.daily_send_limit),
+            on_success=handle_done,
+            on_error=lambda e: messagebox.showerror("Error", f"Failed to process new users: {str(e)}")
+        )
+
+    def process_signups_csv(self, path, on_done=None):
+        """
+        Send personalized welcome emails to every row of a CSV file.
+        The file needs an "email" column; other columns fill template fields.
+        """
+        try:
+            signups = list(read_recipients(path))
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to read {path}: {str(e)}")
+            return None
+        return self.process_new_user_signups(signups, on_done=on_done)
+
 if __name__ == "__main__":
     root = tk.Tk()
     app = GmailApp(root)
+    root.protocol("WM_DELETE_WINDOW", lambda: (app.prefetcher.stop(), app.executor.shutdown(), root.destroy()))
     root.mainloop()
\ No newline at end of file
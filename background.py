@@ -0,0 +1,215 @@
+"""
+Run blocking Gmail API calls on worker threads and hand the results back to
+the Tk event loop, so the window never freezes while a request is in flight.
+Coroutines using async_gmail run on a single asyncio loop thread and report
+back the same way.
+"""
+import asyncio
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from gmail_auth import build_service
+from quota import BACKGROUND, scheduler
+from single_flight import cancellable
+
+
+class Task:
+    """
+    Handle for a submitted job. Cancelling a task stops it from starting if it
+    is still queued and drops its result if it is already running; a running
+    job also stops at its next Gmail read (single_flight.Cancelled).
+    """
+
+    def __init__(self, func, args, on_success, on_error, priority=BACKGROUND):
+        self.func = func
+        self.args = args
+        self.priority = priority
+        self.on_success = on_success
+        self.on_error = on_error
+        self.cancelled = False
+        self.done = False
+        self.future = None
+
+    @property
+    def active(self):
+        return not (self.done or self.cancelled)
+
+    def cancel(self):
+        self.cancelled = True
+        if self.future is not None:
+            self.future.cancel()
+
+
+class BackgroundExecutor:
+    """
+    Thread pool whose results are delivered on the Tk thread.
+
+    Jobs run on worker threads; their return value (or exception) is put on a
+    queue that the Tk loop drains every `poll_interval` milliseconds via
+    `root.after`, and the matching callback is called there. Callbacks are
+    therefore free to touch widgets and show dialogs.
+    """
+
+    def __init__(self, root, max_workers=4, poll_interval=50):
+        self.root = root
+        self.poll_interval = poll_interval
+        self.credentials = None
+        self.pool = None
+        # Called on the Tk thread with the number of unfinished tasks
+        self.on_activity = None
+        self._generation = 0
+        self._local = threading.local()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='gmail-worker')
+        self._results = queue.Queue()
+        self._tasks = set()
+        self._loop = None
+        self._async_client = None
+        self._async_generation = None
+        self._poll_id = self.root.after(self.poll_interval, self._poll)
+
+    def set_credentials(self, credentials):
+        """
+        Use new credentials for every worker's next request.
+
+        Workers share a pool of connections and one copy of the credentials,
+        so `self.credentials` is the thread-safe wrapper around them.
+        """
+        # Imported here so that the app's window does not wait for the Google client to load
+        from http_pool import HttpPool
+
+        if self.pool is not None:
+            self.pool.close()
+        self.pool = HttpPool(credentials)
+        self.credentials = self.pool.credentials
+        self._generation += 1
+
+    def service(self):
+        """
+        Return the Gmail service for the calling worker thread.
+
+        Services are not thread-safe, so every worker builds its own; their
+        requests all run on connections from the shared pool.
+        """
+        local = self._local
+        if getattr(local, 'generation', None) != self._generation:
+            local.service = build_service(self.credentials, http=self.pool)
+            local.generation = self._generation
+        return local.service
+
+    def async_client(self):
+        """
+        Return the AsyncGmail for the loop thread, sharing the workers'
+        credentials. Must be called from a coroutine run by submit_async.
+        """
+        if self._async_generation != self._generation:
+            from async_gmail import AsyncGmail
+
+            if self._async_client is not None:
+                self._loop.create_task(self._async_client.close())
+            self._async_client = AsyncGmail(self.credentials)
+            self._async_generation = self._generation
+        return self._async_client
+
+    def submit_async(self, func, *args, on_success=None, on_error=None, priority=BACKGROUND):
+        """
+        Run the coroutine `func(*args)` on the asyncio loop thread, started
+        on first use. Must be called from the Tk thread; cancelling the task
+        cancels the coroutine. `priority` is the quota.scheduler priority
+        of its API calls.
+        """
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            threading.Thread(target=self._loop.run_forever, name='gmail-async', daemon=True).start()
+        task = Task(func, args, on_success, on_error, priority)
+        self._tasks.add(task)
+        task.future = asyncio.run_coroutine_threadsafe(self._run_async(task), self._loop)
+        self._notify()
+        return task
+
+    def submit(self, func, *args, on_success=None, on_error=None, priority=BACKGROUND):
+        """
+        Run `func(*args)` on a worker thread. Must be called from the Tk thread.
+        Its API calls run at quota.scheduler priority `priority`; pass
+        INTERACTIVE for what the user is waiting on.
+        """
+        task = Task(func, args, on_success, on_error, priority)
+        self._tasks.add(task)
+        task.future = self._pool.submit(self._run, task)
+        self._notify()
+        return task
+
+    def cancel_all(self):
+        for task in list(self._tasks):
+            task.cancel()
+
+    @property
+    def busy(self):
+        return bool(self._tasks)
+
+    def shutdown(self):
+        self.cancel_all()
+        self.root.after_cancel(self._poll_id)
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def _run(self, task):
+        if task.cancelled:
+            self._results.put((task, None, None))
+            return
+        try:
+            with scheduler.priority(task.priority), cancellable(lambda: task.cancelled):
+                result = task.func(*task.args)
+            self._results.put((task, result, None))
+        except Exception as e:
+            self._results.put((task, None, e))
+
+    async def _run_async(self, task):
+        try:
+            # Each coroutine runs in a task of its own, so this is its priority alone
+            with scheduler.priority(task.priority):
+                result = await task.func(*task.args)
+            self._results.put((task, result, None))
+        except asyncio.CancelledError:
+            self._results.put((task, None, None))
+            raise
+        except Exception as e:
+            self._results.put((task, None, e))
+
+    def _poll(self):
+        changed = False
+        while True:
+            try:
+                task, result, error = self._results.get_nowait()
+            except queue.Empty:
+                break
+            self._tasks.discard(task)
+            task.done = True
+            changed = True
+            if task.cancelled:
+                continue
+            try:
+                if error is not None:
+                    if task.on_error:
+                        task.on_error(error)
+                    else:
+                        print(f"Background task failed: {error}")
+                elif task.on_success:
+                    task.on_success(result)
+            except Exception as e:
+                print(f"Error in background task callback: {e}")
+
+        # Tasks cancelled before they started never reach a worker
+        for task in [task for task in self._tasks if task.future.cancelled()]:
+            self._tasks.discard(task)
+            task.done = True
+            changed = True
+
+        if changed:
+            self._notify()
+        self._poll_id = self.root.after(self.poll_interval, self._poll)
+
+    def _notify(self):
+        if self.on_activity:
+            self.on_activity(len(self._tasks))
@@ -0,0 +1,73 @@
+"""
+Benchmark bulk sending against a local fake Gmail send endpoint.
+
+Starts the fake Gmail server with a fixed latency, rejecting a share of
+sends with 429, then sends the same batch of messages one at a time and
+through bulk_send, and prints the sustained throughput of both as JSON.
+
+    python benchmarks/bench_bulk_send.py --messages 500 --rate 100 --latency-ms 50
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import threading
+from email.mime.text import MIMEText
+
+import httplib2
+from googleapiclient.discovery import build
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bulk_send import send_bulk
+from fake_gmail import FakeGmail, Mailbox
+
+
+def make_sender(endpoint):
+    """
+    Return a thread-safe send(message) function talking to `endpoint`.
+    """
+    local = threading.local()
+
+    def send(message):
+        if not hasattr(local, 'service'):
+            local.service = build('gmail', 'v1', http=httplib2.Http(), developerKey='benchmark',
+                                  client_options={'api_endpoint': endpoint}, cache_discovery=False)
+        raw = base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
+        return local.service.users().messages().send(userId='me', body={'raw': raw}).execute()
+
+    return send
+
+
+def build_message(recipient):
+    message = MIMEText(f"Hello {recipient}, welcome aboard!")
+    message['to'] = recipient
+    message['subject'] = 'Welcome to Our Platform!'
+    return message
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--rate', type=float, default=100, help="per-second quota")
+    parser.add_argument('--per-day', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--error-rate', type=float, default=0.05, help="share of sends rejected with 429")
+    args = parser.parse_args()
+
+    fake = FakeGmail(Mailbox(0), args.latency_ms / 1000, args.error_rate).start()
+    endpoint = fake.endpoint
+    recipients = [f'user{i}@example.com' for i in range(args.messages)]
+
+    results = {'messages': args.messages, 'latency_ms': args.latency_ms, 'error_rate': args.error_rate}
+    for name, workers in [('sequential', 1), ('bulk', args.workers)]:
+        report = send_bulk(recipients, build_message, make_sender(endpoint), per_second=args.rate,
+                           per_day=args.per_day, workers=workers, base_delay=0.05)
+        results[name] = report.as_dict()
+    fake.stop()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+"""
+Benchmark the fetch, open and send paths against the local fake Gmail server.
+
+For each mailbox size this times the work the app does on its worker
+threads when the user refreshes the inbox (`fetch_emails`: a cold full sync,
+an incremental sync after new mail arrives, a sync with nothing new and
+paging in older mail, and the same syncs in conversation view), acts on
+every stored message at once (`run_action`: mark as read), opens a message (`show_email_content`: fetching the
+full message and picking its body, opening it twice at once as a
+double-click does, downloading attachments, and prefetching a screenful of bodies)
+and sends mail (`send`: single messages through the outbox drain and a
+batch through the concurrent outbox send). The number of connections
+opened, HTTP requests and API calls each step made is recorded next to its
+timings, so a change that adds round trips or handshakes shows up even when
+the latency is low.
+
+The fake server enforces no quota by default, and the quota scheduler is
+turned off to match; --quota-per-second turns both on at that rate.
+--gzip has the server gzip its responses, as Gmail does.
+
+Results are printed as one JSON document, to be kept and compared across
+versions:
+
+    python benchmarks/bench_gmail.py --sizes 10,1000,100000 --latency-ms 20 > results.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from google.oauth2.credentials import Credentials
+from googleapiclient.errors import HttpError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from attachments import save_attachment
+from fake_gmail import FakeGmail, Mailbox
+from gmail_auth import build_service
+from gmail_fetch import fetch_messages_batched, find_message_by_rfc822_id
+from http_pool import HttpPool
+from mailbox_ops import ACTIONS, apply_locally, batch_modify
+from mail_sync import fetch_next_page, has_more_pages, sync_mailbox, sync_threads
+from message_store import MessageStore
+from mime_parts import extract_content
+from outbox import Outbox, send_item
+from quota import scheduler
+from templates import welcome_template
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def latency_stats(seconds):
+    ms = sorted(value * 1000 for value in seconds)
+    return {
+        'count': len(ms),
+        'mean_ms': round(statistics.mean(ms), 2),
+        'p50_ms': round(ms[len(ms) // 2], 2),
+        'p95_ms': round(ms[min(len(ms) - 1, int(len(ms) * 0.95))], 2),
+        'max_ms': round(ms[-1], 2),
+    }
+
+
+class Step:
+    """
+    Time a block and record the server traffic it caused.
+    """
+
+    def __init__(self, fake, results, name):
+        self.fake = fake
+        self.results = results
+        self.name = name
+
+    def __enter__(self):
+        self.before = self.fake.stats()
+        self.start = time.perf_counter()
+        self.result = {}
+        return self.result
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        after = self.fake.stats()
+        self.result['seconds'] = round(seconds, 4)
+        for key in ('connections', 'http_requests', 'api_calls', 'injected_errors', 'quota_errors', 'bytes_sent'):
+            self.result[key] = after[key] - self.before[key]
+        self.results[self.name] = self.result
+
+
+def bench_fetch(fake, service, store, args):
+    results = {}
+    with Step(fake, results, 'cold_sync') as result:
+        stats = sync_mailbox(service, store, max_results=args.page_size)
+        result.update(added=stats['added'], payload_bytes=stats['payload_bytes'])
+
+    fake.mailbox.deliver(args.new_messages)
+    with Step(fake, results, 'incremental_sync') as result:
+        stats = sync_mailbox(service, store, max_results=args.page_size)
+        result.update(added=stats['added'], payload_bytes=stats['payload_bytes'])
+
+    with Step(fake, results, 'noop_sync') as result:
+        sync_mailbox(service, store, max_results=args.page_size)
+
+    with Step(fake, results, 'page_in') as result:
+        paged = 0
+        while has_more_pages(store) and paged < args.max_paged:
+            paged += fetch_next_page(service, store, max_results=args.page_size)
+        result['messages'] = paged
+    if paged:
+        result['messages_per_second'] = round(paged / result['seconds'], 1)
+    return results
+
+
+def bench_threads(fake, service, store, args):
+    """
+    The fetch_emails syncs in conversation view, into a store of their own.
+    `rows` is what the view shows for the synced page: one per thread.
+    """
+    results = {}
+    with Step(fake, results, 'cold_sync') as result:
+        stats = sync_threads(service, store, max_results=args.page_size)
+        result.update(added=stats['added'], threads_fetched=stats['threads_fetched'],
+                      payload_bytes=stats['payload_bytes'], rows=store.count_threads())
+
+    fake.mailbox.deliver(args.new_messages)
+    with Step(fake, results, 'incremental_sync') as result:
+        stats = sync_threads(service, store, max_results=args.page_size)
+        result.update(added=stats['added'], threads_fetched=stats['threads_fetched'],
+                      payload_bytes=stats['payload_bytes'])
+
+    with Step(fake, results, 'noop_sync') as result:
+        sync_threads(service, store, max_results=args.page_size)
+    return results
+
+
+def bench_actions(fake, service, store, args):
+    results = {}
+    message_ids = [row[0] for row in store.list_label('INBOX')]
+    add_labels, remove_labels = ACTIONS["Mark as read"]
+    with Step(fake, results, 'mark_read') as result:
+        apply_locally(store, message_ids, add_labels, remove_labels)
+        result['messages'] = batch_modify(service, message_ids, add_labels, remove_labels)
+    return results
+
+
+def bench_open(fake, pool, service, store, args):
+    results = {}
+    message_ids = [row[0] for row in store.list_label('INBOX')]
+    rng = random.Random(0)
+    sample = rng.sample(message_ids, min(args.opens, len(message_ids)))
+
+    timings = []
+    failures = 0
+    with Step(fake, results, 'open') as result:
+        for message_id in sample:
+            start = time.perf_counter()
+            try:
+                message = service.users().messages().get(userId='me', id=message_id, format='full').execute()
+            except HttpError:
+                # The app shows an error for these rather than retrying
+                failures += 1
+                continue
+            extract_content(message)
+            timings.append(time.perf_counter() - start)
+    result.update(latency_stats(timings), errors=failures)
+
+    # A double-click opens the message twice at once; the second open shares the first one's call
+    services = [build_service(pool.credentials, api_endpoint=fake.endpoint, http=pool) for _ in range(2)]
+    timings = []
+    with Step(fake, results, 'open_twice') as result:
+        for message_id in sample[:args.visible_rows]:
+            start = time.perf_counter()
+            opens = [threading.Thread(target=lambda service=service: extract_content(service.users().messages().get(
+                userId='me', id=message_id, format='full').execute())) for service in services]
+            for thread in opens:
+                thread.start()
+            for thread in opens:
+                thread.join()
+            timings.append(time.perf_counter() - start)
+    result.update(latency_stats(timings))
+
+    # Attachments are streamed to disk outside the service, so they take the gzip path of their own
+    attachments = []
+    for message_id in message_ids:
+        if len(attachments) >= args.attachments:
+            break
+        message = service.users().messages().get(userId='me', id=message_id, format='full').execute()
+        attachments += extract_content(message).attachments
+    timings = []
+    with tempfile.TemporaryDirectory() as directory, Step(fake, results, 'download_attachment') as result:
+        written = 0
+        for number, attachment in enumerate(attachments[:args.attachments]):
+            start = time.perf_counter()
+            written += save_attachment(service, attachment, os.path.join(directory, str(number)))
+            timings.append(time.perf_counter() - start)
+        if timings:
+            result.update(latency_stats(timings), bytes_written=written)
+
+    visible = message_ids[:args.visible_rows]
+    with Step(fake, results, 'prefetch_visible') as result:
+        fetched, errors = fetch_messages_batched(service, visible, format='full')
+        for message in fetched.values():
+            extract_content(message)
+        result.update(messages=len(fetched), errors=len(errors))
+    return results
+
+
+def bench_send(fake, pool, outbox, size, args):
+    results = {}
+    local = threading.local()
+    template = welcome_template()
+
+    def service():
+        if not hasattr(local, 'service'):
+            local.service = build_service(pool.credentials, api_endpoint=fake.endpoint, http=pool)
+        return local.service
+
+    def send(item):
+        return send_item(service(), item)
+
+    def find_sent(rfc822_id):
+        return find_message_by_rfc822_id(service(), rfc822_id)
+
+    timings = []
+    with Step(fake, results, 'single') as result:
+        for i in range(min(size, args.single_sends)):
+            start = time.perf_counter()
+            outbox.enqueue(template.render(f'single{i}@example.com', {'name': f'User {i}'}))
+            outbox.drain(send, find_sent)
+            timings.append(time.perf_counter() - start)
+    result.update(latency_stats(timings))
+
+    count = min(size, args.max_sends)
+    messages = [template.render(f'user{i}@example.com', {'name': f'User {i}'}) for i in range(count)]
+    with Step(fake, results, 'bulk') as result:
+        # The single sends above count against the daily quota too
+        report = outbox.send_bulk(messages, send, find_sent, per_second=args.send_rate,
+                                  per_day=count + args.single_sends, workers=args.workers, base_delay=0.05)
+        result.update(report.as_dict())
+    return results
+
+
+def run(size, args):
+    fake = FakeGmail(Mailbox(size, thread_size=args.thread_size), args.latency_ms / 1000, args.error_rate,
+                     quota_per_second=args.quota_per_second, gzip=args.gzip).start()
+    pool = HttpPool(Credentials(token='benchmark'))
+    service = build_service(pool.credentials, api_endpoint=fake.endpoint, http=pool)
+    with tempfile.TemporaryDirectory() as directory:
+        store = MessageStore(os.path.join(directory, 'messages.db'))
+        thread_store = MessageStore(os.path.join(directory, 'threads.db'))
+        outbox = Outbox(os.path.join(directory, 'outbox.db'))
+        try:
+            return {
+                'fetch_emails': bench_fetch(fake, service, store, args),
+                'fetch_threads': bench_threads(fake, service, thread_store, args),
+                'show_email_content': bench_open(fake, pool, service, store, args),
+                'run_action': bench_actions(fake, service, store, args),
+                'send': bench_send(fake, pool, outbox, size, args),
+                'server': fake.stats(),
+            }
+        finally:
+            store.close()
+            thread_store.close()
+            outbox.close()
+            fake.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', default='10,1000,100000', help="comma-separated mailbox sizes")
+    parser.add_argument('--latency-ms', type=float, default=20, help="added to every HTTP request")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of API calls rejected with 429")
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--new-messages', type=int, default=10, help="delivered before the incremental sync")
+    parser.add_argument('--max-paged', type=int, default=2000, help="older messages to page in at most")
+    parser.add_argument('--thread-size', type=int, default=3, help="messages per conversation in the mailbox")
+    parser.add_argument('--opens', type=int, default=50, help="messages to open one at a time")
+    parser.add_argument('--visible-rows', type=int, default=30, help="bodies to prefetch in one go")
+    parser.add_argument('--attachments', type=int, default=10, help="attachments to download one at a time")
+    parser.add_argument('--gzip', action='store_true', help="have the server gzip its responses, as Gmail does")
+    parser.add_argument('--single-sends', type=int, default=10)
+    parser.add_argument('--max-sends', type=int, default=1000, help="messages in the bulk send at most")
+    parser.add_argument('--send-rate', type=float, default=250, help="per-second send quota")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--quota-per-second', type=float, default=0,
+                        help="quota units a second, enforced by the server and scheduled by the client")
+    args = parser.parse_args()
+    scheduler.configure(args.quota_per_second)
+
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'latency_ms': args.latency_ms,
+        'gzip': args.gzip,
+        'error_rate': args.error_rate,
+        'quota_per_second': args.quota_per_second,
+        'sizes': {},
+    }
+    for size in (int(size) for size in args.sizes.split(',')):
+        print(f"Mailbox of {size} messages...", file=sys.stderr)
+        results['sizes'][str(size)] = run(size, args)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Benchmark the memory a large mailbox takes once it is held in memory.
+
+Synthetic summary responses, as Gmail returns them for the inbox view's
+metadata fetches, are decoded and kept in three forms: the API response
+dicts themselves, the flat summary dicts the app used to keep per message,
+and gmail_fetch.MessageSummary records. For each form this reports the
+memory held (measured with tracemalloc) scaled to 100k messages, and the
+time taken to build it.
+
+Results are printed as one JSON document, to be kept and compared across
+versions:
+
+    python benchmarks/bench_memory.py --messages 100000 > memory.json
+"""
+import argparse
+import email.utils
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_gmail import git_revision
+from fake_gmail import Mailbox, apply_fields, parse_fields
+from gmail_fetch import SUMMARY_FIELDS, SUMMARY_HEADERS, parse_summary
+
+PER = 100_000
+
+
+def summary_dict(msg):
+    """
+    The flat dict kept per message before MessageSummary, built the way it
+    was: one scan of the headers per field, a formatted date string and the
+    label ids as a list.
+    """
+    headers = msg.get('payload', {}).get('headers', [])
+    sender = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown Sender')
+    subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
+    date = next((h['value'] for h in headers if h['name'] == 'Date'), 'No Date')
+    try:
+        formatted = email.utils.parsedate_to_datetime(date).strftime('%Y-%m-%d %H:%M')
+    except (TypeError, ValueError):
+        formatted = "Invalid Date"
+    return {
+        'id': msg['id'],
+        'thread_id': msg.get('threadId'),
+        'history_id': msg.get('historyId'),
+        'sender': sender,
+        'subject': subject,
+        'date': formatted,
+        'timestamp': int(msg['internalDate']) // 1000,
+        'label_ids': msg.get('labelIds', []),
+        'snippet': msg.get('snippet', ''),
+    }
+
+
+def responses(count):
+    """
+    Summary responses as JSON text, like the bodies of a batch response.
+    """
+    mailbox = Mailbox(count)
+    fields = parse_fields(SUMMARY_FIELDS)
+    return [json.dumps(apply_fields(mailbox.get(f'{index:016x}', 'metadata', SUMMARY_HEADERS), fields))
+            for index in range(count)]
+
+
+def measure(texts, build):
+    """
+    Decode every response and keep what `build` makes of it. Returns the
+    bytes still allocated afterwards and the seconds it took.
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    kept = [build(json.loads(text)) for text in texts]
+    seconds = time.perf_counter() - start
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return size, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=PER)
+    args = parser.parse_args()
+
+    texts = responses(args.messages)
+    forms = {
+        'api_responses': lambda msg: msg,
+        'summary_dicts': summary_dict,
+        'summary_records': parse_summary,
+    }
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'messages': args.messages,
+    }
+    for name, build in forms.items():
+        size, seconds = measure(texts, build)
+        results[name] = {
+            'mb_per_100k': round(size / args.messages * PER / 2 ** 20, 1),
+            'bytes_per_message': round(size / args.messages),
+            'build_us_per_message': round(seconds / args.messages * 1e6, 2),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
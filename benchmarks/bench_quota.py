@@ -0,0 +1,121 @@
+"""
+Benchmark opening messages while a bulk job spends the Gmail quota.
+
+The fake Gmail server enforces a per-user quota, as Gmail does. Worker
+threads fetch full messages in batches at bulk priority, as body
+prefetching does, while the main thread opens one message at a time at
+interactive priority. This runs once with quota.scheduler off, when the
+bulk job runs into 429s and opens fail with them, and once with it on at
+the server's rate. For each run it records how long opens took, how many
+failed, how many messages the bulk job fetched a second and how many calls
+the server rejected.
+
+Results are printed as one JSON document, to be kept and compared across
+versions:
+
+    python benchmarks/bench_quota.py --quota-per-second 250 --opens 40 > quota.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+from google.oauth2.credentials import Credentials
+from googleapiclient.errors import HttpError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_gmail import git_revision, latency_stats
+from fake_gmail import FakeGmail, Mailbox
+from gmail_auth import build_service
+from gmail_fetch import fetch_messages_batched
+from http_pool import HttpPool
+from quota import BULK, INTERACTIVE, scheduler
+
+
+def bulk_job(service, ids, batch_size, stop, counts, lock):
+    """
+    Fetch `ids` in batches, over and over, until `stop` is set.
+    """
+    with scheduler.priority(BULK):
+        position = 0
+        while not stop.is_set():
+            chunk = ids[position:position + batch_size] or ids[:batch_size]
+            position = (position + batch_size) % len(ids)
+            fetched, errors = fetch_messages_batched(service, chunk, batch_size=batch_size, retries=0)
+            with lock:
+                counts['fetched'] += len(fetched)
+                counts['failed'] += len(errors)
+
+
+def run(enabled, args):
+    scheduler.configure(args.quota_per_second if enabled else 0)
+    fake = FakeGmail(Mailbox(args.messages), args.latency_ms / 1000, quota_per_second=args.quota_per_second).start()
+    pool = HttpPool(Credentials(token='benchmark'))
+    service = build_service(pool.credentials, api_endpoint=fake.endpoint, http=pool)
+    ids = [message['id'] for message in fake.mailbox.list(max_results=args.messages)['messages']]
+
+    stop = threading.Event()
+    lock = threading.Lock()
+    counts = {'fetched': 0, 'failed': 0}
+    workers = [threading.Thread(target=bulk_job, args=(service, ids, args.batch_size, stop, counts, lock))
+               for _ in range(args.bulk_workers)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+
+    timings = []
+    failed_opens = 0
+    try:
+        with scheduler.priority(INTERACTIVE):
+            for number in range(args.opens):
+                time.sleep(args.open_interval)
+                opened = time.perf_counter()
+                try:
+                    service.users().messages().get(userId='me', id=ids[number * 7 % len(ids)], format='full').execute()
+                except HttpError:
+                    failed_opens += 1
+                timings.append(time.perf_counter() - opened)
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join()
+        seconds = time.perf_counter() - start
+        fake.stop()
+
+    return {
+        'opens': latency_stats(timings),
+        'failed_opens': failed_opens,
+        'bulk_fetched_per_second': round(counts['fetched'] / seconds, 1),
+        'bulk_failed': counts['failed'],
+        'quota_errors': fake.stats()['quota_errors'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=2000, help="size of the synthetic inbox")
+    parser.add_argument('--latency-ms', type=float, default=20, help="added to every HTTP request")
+    parser.add_argument('--quota-per-second', type=float, default=250, help="quota units a second the server allows")
+    parser.add_argument('--opens', type=int, default=40, help="messages to open one at a time")
+    parser.add_argument('--open-interval', type=float, default=0.1, help="seconds between opens")
+    parser.add_argument('--bulk-workers', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=50)
+    args = parser.parse_args()
+
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'latency_ms': args.latency_ms,
+        'quota_per_second': args.quota_per_second,
+    }
+    for name, enabled in [('unscheduled', False), ('scheduled', True)]:
+        print(f"Opening messages during a bulk job, scheduler {'on' if enabled else 'off'}...", file=sys.stderr)
+        results[name] = run(enabled, args)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
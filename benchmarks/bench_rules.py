@@ -0,0 +1,140 @@
+"""
+Benchmark matching new mail against a growing number of rules.
+
+Synthetic messages, as the rule-aware sync fetches them, are matched against
+rule sets of increasing size in two ways: rules.RuleSet, which compiles all
+the rules into one pass, and a loop testing each rule's conditions in turn.
+Most generated rules match nothing, as in a real rules file, and a few
+match many messages. Both ways must find the same matches.
+
+Results are printed as one JSON document, to be kept and compared across
+versions:
+
+    python benchmarks/bench_rules.py --messages 5000 --rules 10 100 500 > rules.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import sys
+import time
+from email.utils import parseaddr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_gmail import git_revision
+from fake_gmail import NAMES, WORDS, Mailbox, apply_fields, parse_fields
+from rules import RULE_FIELDS, Rule, RuleSet, has_attachment, message_headers
+
+
+def made_up_word(rng):
+    return ''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=rng.randint(5, 9)))
+
+
+def make_rules(count, seed=0):
+    """
+    Rule specs of the kinds people write: subject keywords, senders,
+    sender domains, sizes and attachments, alone or combined.
+    """
+    rng = random.Random(seed)
+    specs = []
+    for number in range(count):
+        # One rule in ten uses words the synthetic mail contains
+        real = number % 10 == 0
+        word = rng.choice(WORDS[:24]) if real else made_up_word(rng)
+        kind = number % 5
+        if kind == 0:
+            spec = {'subject': f'{word}|{made_up_word(rng)}'}
+        elif kind == 1:
+            spec = {'from': f'{rng.choice(NAMES) if real else made_up_word(rng)}@', 'subject': f'^{word}'}
+        elif kind == 2:
+            spec = {'from_domain': 'example.com' if real else f'{made_up_word(rng)}.com'}
+        elif kind == 3:
+            spec = {'subject': rf'\b{word}\b', 'larger_than': rng.randint(2000, 8000)}
+        else:
+            spec = {'has_attachment': True, 'to': f'{word}@' if not real else 'me@'}
+        specs.append({'name': f'rule {number}', **spec, 'add_labels': [f'Label {number % 20}']})
+    return specs
+
+
+def compile_naive(rules):
+    """
+    Each rule with its patterns compiled, for naive_match.
+    """
+    return [(rule, {key: re.compile(rule.spec[key], re.IGNORECASE)
+                    for key in ('from', 'subject', 'to') if key in rule.spec})
+            for rule in rules]
+
+
+def naive_match(compiled, message):
+    """
+    Test every rule in turn, the way a rules loop is usually first written.
+    """
+    headers = message_headers(message)
+    values = {'from': headers.get('from'), 'subject': headers.get('subject'),
+              'to': f"{headers.get('to', '')}, {headers.get('cc', '')}"}
+    matched = []
+    for rule, patterns in compiled:
+        spec = rule.spec
+        if any(values[key] is None or not pattern.search(values[key]) for key, pattern in patterns.items()):
+            continue
+        if spec.get('from_domain'):
+            domain = parseaddr(headers.get('from', ''))[1].rpartition('@')[2].lower()
+            if domain != spec['from_domain'] and not domain.endswith('.' + spec['from_domain']):
+                continue
+        size = int(message.get('sizeEstimate', 0))
+        if 'larger_than' in spec and not size > spec['larger_than']:
+            continue
+        if 'has_attachment' in spec and has_attachment(message) != spec['has_attachment']:
+            continue
+        matched.append(rule)
+    return matched
+
+
+def time_matching(match, messages):
+    start = time.perf_counter()
+    results = [match(message) for message in messages]
+    return time.perf_counter() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--rules', type=int, nargs='+', default=[10, 100, 500])
+    args = parser.parse_args()
+
+    mailbox = Mailbox(args.messages)
+    fields = parse_fields(RULE_FIELDS)
+    headers = ['From', 'Subject', 'Date', 'To', 'Cc']
+    messages = [apply_fields(mailbox.get(f'{index:016x}', 'metadata', headers), fields)
+                for index in range(args.messages)]
+
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'messages': args.messages,
+        'rule_sets': [],
+    }
+    for count in args.rules:
+        rules = [Rule(spec, position) for position, spec in enumerate(make_rules(count))]
+        start = time.perf_counter()
+        ruleset = RuleSet(rules)
+        compile_seconds = time.perf_counter() - start
+        compiled_seconds, compiled = time_matching(ruleset.match, messages)
+        naive_rules = compile_naive(rules)
+        naive_seconds, naive = time_matching(lambda message: naive_match(naive_rules, message), messages)
+        if compiled != naive:
+            raise SystemExit(f"Compiled and naive matching disagree with {count} rules")
+        results['rule_sets'].append({
+            'rules': count,
+            'matches': sum(map(len, compiled)),
+            'compile_ms': round(compile_seconds * 1000, 1),
+            'compiled_us_per_message': round(compiled_seconds / args.messages * 1e6, 1),
+            'naive_us_per_message': round(naive_seconds / args.messages * 1e6, 1),
+        })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
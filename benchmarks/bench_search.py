@@ -0,0 +1,113 @@
+"""
+Benchmark building and querying the local full-text search index.
+
+Generates a synthetic mailbox, times how long it takes to store the
+summaries and index the bodies, then times a set of typical queries.
+Results are printed as JSON.
+
+    python benchmarks/bench_search.py --messages 50000
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gmail_fetch import MessageSummary, label_mask
+from message_store import MessageStore, fts_query
+
+# Common words appear in most messages, the rest follow a Zipf-like tail
+COMMON_WORDS = (
+    "invoice meeting report budget lunch project deadline review contract update "
+    "schedule release customer support ticket refund shipping order payment account"
+).split()
+
+QUERIES = ["invoice", "quarterly report", "refund ship", "alice", "security alert password", "wordx123", "zzz"]
+
+
+def vocabulary(size=20000):
+    words = COMMON_WORDS + "quarterly security alert password".split()
+    words += [f'word{chr(97 + i % 26)}{i}' for i in range(size - len(words))]
+    weights = itertools.accumulate(1 / (rank + 1) for rank in range(len(words)))
+    return words, list(weights)
+
+
+def synthetic_summaries(count, seed=0):
+    rng = random.Random(seed)
+    words, cum_weights = vocabulary()
+    for i in range(count):
+        name = rng.choice(["alice", "bob", "carol", "dave", "erin", "frank"])
+        yield MessageSummary(
+            f'{i:016x}', f'{i // 3:016x}', str(i),
+            f'{name.title()} <{name}{i % 97}@example.com>',
+            ' '.join(rng.choices(words, cum_weights=cum_weights, k=6)),
+            1700000000 + i, label_mask(['INBOX']),
+            snippet=' '.join(rng.choices(words, cum_weights=cum_weights, k=20)),
+        )
+
+
+def synthetic_bodies(count, seed=1):
+    rng = random.Random(seed)
+    words, cum_weights = vocabulary()
+    for i in range(count):
+        yield f'{i:016x}', ' '.join(rng.choices(words, cum_weights=cum_weights, k=200))
+
+
+def count_matches(store, query):
+    return store.conn.execute(
+        "SELECT COUNT(*) FROM messages_fts WHERE messages_fts MATCH ?", (fts_query(query),)
+    ).fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=20, help="runs per query")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = MessageStore(os.path.join(directory, 'bench.db'))
+
+        summaries = list(synthetic_summaries(args.messages))
+        start = time.perf_counter()
+        store.upsert(summaries)
+        summaries_seconds = time.perf_counter() - start
+
+        # Bodies arrive in prefetch-sized batches
+        bodies = list(synthetic_bodies(args.messages))
+        start = time.perf_counter()
+        for batch_start in range(0, len(bodies), 20):
+            store.index_bodies(dict(bodies[batch_start:batch_start + 20]))
+        bodies_seconds = time.perf_counter() - start
+
+        queries = {}
+        for query in QUERIES:
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                results = store.search(query)
+                timings.append((time.perf_counter() - start) * 1000)
+            queries[query] = {
+                'matches': count_matches(store, query),
+                'results': len(results),
+                'median_ms': round(statistics.median(timings), 3),
+                'max_ms': round(max(timings), 3),
+            }
+        store.close()
+
+    print(json.dumps({
+        'benchmark': 'search',
+        'messages': args.messages,
+        'index_summaries_seconds': round(summaries_seconds, 3),
+        'index_bodies_seconds': round(bodies_seconds, 3),
+        'queries': queries,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
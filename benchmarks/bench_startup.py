@@ -0,0 +1,146 @@
+"""
+Benchmark app startup: how long until the inbox shows rows.
+
+Each run starts a fresh interpreter, as launching the app does, and times
+the steps between launch and the first rows: importing everything the app
+imports before its window opens, reading the first screenful of rows from
+the local store (the cached rows), and then loading and refreshing the
+saved token, building the Gmail service and syncing against the local fake
+Gmail server (the fresh rows). The token starts out expired, as it is when
+the app was last used more than an hour ago.
+
+Results are printed as one JSON document, to be kept and compared across
+versions:
+
+    python benchmarks/bench_startup.py --runs 10 --latency-ms 50 > startup.json
+"""
+import argparse
+import json
+import os
+import pickle
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Rows the inbox view materializes on its first render
+WINDOW_SIZE = 300
+
+
+def child(store_path, token_path, page_size):
+    """
+    One launch, run in its own interpreter. Prints the time of each step,
+    counted from before the first import.
+    """
+    start = time.perf_counter()
+    marks = {}
+    import index  # noqa: F401 -- everything the apps import before their window opens
+    marks['imports'] = time.perf_counter()
+
+    from message_store import MessageStore
+    rows = MessageStore(store_path).list_label('INBOX', limit=WINDOW_SIZE)
+    marks['cached_rows'] = time.perf_counter()
+
+    from gmail_auth import build_service, load_credentials
+    from mail_sync import sync_mailbox
+    credentials, _ = load_credentials(token_path, os.devnull, interactive=False)
+    marks['auth'] = time.perf_counter()
+    service = build_service(credentials)
+    marks['service'] = time.perf_counter()
+    stats = sync_mailbox(service, MessageStore(store_path), max_results=page_size)
+    marks['fresh_rows'] = time.perf_counter()
+
+    print(json.dumps({'cached_row_count': len(rows), 'sync_mode': stats['mode'],
+                      **{name: mark - start for name, mark in marks.items()}}))
+
+
+def write_token(path, endpoint):
+    from google.oauth2.credentials import Credentials
+
+    credentials = Credentials(
+        token='expired', refresh_token='benchmark', token_uri=f'{endpoint}/token',
+        client_id='benchmark', client_secret='benchmark', expiry=datetime.utcnow() - timedelta(minutes=5),
+    )
+    with open(path, 'wb') as token:
+        pickle.dump(credentials, token)
+
+
+def summarize(runs, name):
+    ms = sorted(run[name] * 1000 for run in runs)
+    return {'median_ms': round(statistics.median(ms), 1), 'min_ms': round(ms[0], 1), 'max_ms': round(ms[-1], 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=10000, help="mailbox size")
+    parser.add_argument('--cached', type=int, default=1000, help="messages already in the local store")
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--latency-ms', type=float, default=50, help="added to every HTTP request")
+    parser.add_argument('--child', nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        store_path, token_path, page_size = args.child
+        child(store_path, token_path, int(page_size))
+        return
+
+    # Imported only here, so child runs start from a bare interpreter
+    from google.oauth2.credentials import Credentials
+
+    from bench_gmail import git_revision
+    from fake_gmail import FakeGmail, Mailbox
+    from gmail_auth import build_service
+    from mail_sync import full_sync
+    from message_store import MessageStore
+
+    directory = tempfile.mkdtemp()
+    mailbox = Mailbox(args.messages)
+    with FakeGmail(mailbox, args.latency_ms / 1000) as fake:
+        # A store as the last session left it, with a few messages arrived since
+        seed_path = os.path.join(directory, 'seed.db')
+        full_sync(build_service(Credentials(token='benchmark'), fake.endpoint), MessageStore(seed_path),
+                  max_results=args.cached)
+        mailbox.deliver(5)
+
+        runs = []
+        env = dict(os.environ, GMAIL_API_ENDPOINT=fake.endpoint)
+        for run in range(args.runs):
+            store_path = os.path.join(directory, f'run{run}.db')
+            token_path = os.path.join(directory, f'run{run}.pickle')
+            shutil.copyfile(seed_path, store_path)
+            write_token(token_path, fake.endpoint)
+            before = fake.stats()
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--child', store_path, token_path, str(args.page_size)],
+                env=env, cwd=ROOT, capture_output=True, text=True, check=True,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            after = fake.stats()
+            result['http_requests'] = after['http_requests'] - before['http_requests']
+            runs.append(result)
+    shutil.rmtree(directory)
+
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'latency_ms': args.latency_ms,
+        'messages': args.messages,
+        'cached': args.cached,
+        'runs': args.runs,
+        'sync_mode': runs[0]['sync_mode'],
+        'http_requests': runs[0]['http_requests'],
+    }
+    for name in ('imports', 'cached_rows', 'auth', 'service', 'fresh_rows'):
+        results[name] = summarize(runs, name)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
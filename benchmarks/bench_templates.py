@@ -0,0 +1,85 @@
+"""
+Benchmark building personalized welcome emails.
+
+Builds the same set of personalized messages by constructing a MIMEMultipart
+tree per recipient (the old way) and by rendering a precompiled template,
+and prints the per-message cost of each as JSON.
+
+    python benchmarks/bench_templates.py --messages 10000
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+import tracemalloc
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import make_msgid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from templates import WELCOME_HTML, WELCOME_SUBJECT, WELCOME_TEXT, EmailTemplate, TextTemplate, merge
+
+
+def recipients(count):
+    return [{'email': f'user{i}@example.com', 'name': f'User {i}'} for i in range(count)]
+
+
+def build_mime(rows):
+    """
+    Build each message from scratch, as send_welcome_email used to.
+    """
+    html = TextTemplate(WELCOME_HTML, escape=True)
+    text = TextTemplate(WELCOME_TEXT)
+    for row in rows:
+        message = MIMEMultipart('alternative')
+        message['to'] = row['email']
+        message['subject'] = WELCOME_SUBJECT
+        message['Message-ID'] = make_msgid()
+        message.attach(MIMEText(text.render(row), 'plain'))
+        message.attach(MIMEText(html.render(row), 'html'))
+        yield base64.urlsafe_b64encode(message.as_bytes())
+
+
+def build_template(rows):
+    template = EmailTemplate(WELCOME_SUBJECT, text=WELCOME_TEXT, html=WELCOME_HTML)
+    for message in merge(template, rows):
+        yield base64.urlsafe_b64encode(message.as_bytes())
+
+
+def measure(build, rows):
+    start = time.perf_counter()
+    size = sum(len(raw) for raw in build(rows))
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    for _ in build(rows[:1000]):
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'seconds': round(seconds, 3),
+        'us_per_message': round(seconds / len(rows) * 1e6, 1),
+        'avg_raw_bytes': size // len(rows),
+        'peak_traced_kb_per_1000': peak // 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=10000)
+    args = parser.parse_args()
+
+    rows = recipients(args.messages)
+    results = {'messages': args.messages}
+    for name, build in [('mime_per_message', build_mime), ('compiled_template', build_template)]:
+        results[name] = measure(build, rows)
+    results['speedup'] = round(
+        results['mime_per_message']['us_per_message'] / results['compiled_template']['us_per_message'], 1
+    )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
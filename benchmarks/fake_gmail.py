@@ -0,0 +1,755 @@
+"""
+A local stand-in for the Gmail API, for benchmarks and manual testing.
+
+Serves the calls the apps make -- messages list/get/send (simple, multipart
+and resumable uploads), batchModify/batchDelete, attachments, threads
+list/get, labels list/create, history, profile and batch requests --
+over plain HTTP for a synthetic mailbox of any size. Messages are generated
+from their index when they are asked for, so a 100k message mailbox takes
+no more memory than a small one. Every API call can be delayed and a share
+of them rejected, to exercise the retry paths, and a per-user quota can be
+enforced the way Gmail does, answering 429 once a second's units run out.
+With --gzip, responses are gzipped for clients that accept it, as Gmail's
+are.
+
+    python benchmarks/fake_gmail.py --messages 100000 --latency-ms 50 --port 8025
+    GMAIL_API_ENDPOINT=http://127.0.0.1:8025 python gmail_cli.py sync
+
+Any access token is accepted, and POST /token hands out new ones to
+credentials refreshing against it (token_uri). Search queries other than
+`rfc822msgid:` are ignored.
+"""
+import argparse
+import base64
+import email.parser
+import email.utils
+import gzip
+import http.client
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FIRST_HISTORY_ID = 1000
+BASE_TIME = 1_700_000_000
+
+# Gmail rejects batches with more calls than this
+MAX_BATCH_SIZE = 100
+# and batchModify/batchDelete calls with more ids than this
+MAX_BATCH_IDS = 1000
+
+NAMES = ["alice", "bob", "carol", "dave", "erin", "frank", "grace", "heidi"]
+WORDS = (
+    "invoice meeting report budget lunch project deadline review contract update schedule release "
+    "customer support ticket refund shipping order payment account quarterly security alert password "
+    "the a to of and for with on at from by about as into like through after over between out against"
+).split()
+
+# Reason and message Gmail gives for the errors that can be injected
+ERRORS = {
+    429: ('rateLimitExceeded', 'Rate limit exceeded'),
+    500: ('backendError', 'Backend Error'),
+    503: ('backendError', 'The service is currently unavailable.'),
+}
+
+FIELD_PATH = re.compile(r'[\w/]+')
+
+# Quota units Gmail charges, by method and the end of the path; anything
+# else costs DEFAULT_QUOTA_COST
+QUOTA_COSTS = [
+    ('POST', re.compile(r'/send$'), 100),
+    ('POST', re.compile(r'/messages/batch(Modify|Delete)$'), 50),
+    ('GET', re.compile(r'/threads(/[^/]+)?$'), 10),
+    ('GET', re.compile(r'/history$'), 2),
+    ('GET', re.compile(r'/(labels|profile)$'), 1),
+]
+DEFAULT_QUOTA_COST = 5
+
+
+def quota_cost(method, path):
+    for cost_method, pattern, cost in QUOTA_COSTS:
+        if method == cost_method and pattern.search(path):
+            return cost
+    return DEFAULT_QUOTA_COST
+
+
+def b64(data):
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def split_head(data):
+    """
+    Split a header block from the body that follows its blank line.
+    """
+    head, _, body = data.replace(b'\r\n', b'\n').partition(b'\n\n')
+    return head.decode(), body
+
+
+def parse_fields(fields):
+    """
+    Parse a partial response mask such as 'messages/id,nextPageToken' or
+    'history(messagesAdded/message(id,labelIds))' into nested dicts, where
+    None selects a whole value.
+    """
+    tree, _ = _parse_fields(fields.replace(' ', ''), 0)
+    return tree
+
+
+def _parse_fields(text, pos):
+    tree = {}
+    while pos < len(text):
+        match = FIELD_PATH.match(text, pos)
+        if not match:
+            raise ValueError(f"Invalid fields mask: {text!r}")
+        *parents, leaf = match.group().split('/')
+        pos = match.end()
+        node = tree
+        for name in parents:
+            # A parent selected whole stays whole
+            node = node.setdefault(name, {}) if node.get(name, {}) is not None else {}
+        selection = None
+        if pos < len(text) and text[pos] == '(':
+            selection, pos = _parse_fields(text, pos + 1)
+            pos += 1
+        node[leaf] = selection
+        if pos < len(text) and text[pos] == ',':
+            pos += 1
+        elif pos < len(text) and text[pos] == ')':
+            break
+    return tree, pos
+
+
+def apply_fields(value, tree):
+    """
+    Cut a response down to the fields selected by `parse_fields`.
+    """
+    if tree is None:
+        return value
+    if isinstance(value, list):
+        return [apply_fields(item, tree) for item in value]
+    if isinstance(value, dict):
+        return {key: apply_fields(value[key], selection) for key, selection in tree.items() if key in value}
+    return value
+
+
+class ApiError(Exception):
+    def __init__(self, status, message, reason='invalid'):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+
+
+def error_response(error):
+    body = {'error': {'code': error.status, 'message': str(error),
+                      'errors': [{'domain': 'global', 'reason': error.reason, 'message': str(error)}]}}
+    return error.status, {'Content-Type': 'application/json; charset=UTF-8'}, json.dumps(body).encode()
+
+
+class Mailbox:
+    """
+    A synthetic inbox of `size` messages plus everything delivered or sent
+    since. Message ids are the message's index in hex, newest highest.
+    """
+
+    def __init__(self, size, seed=0, attachment_every=10, paragraphs=4, thread_size=3):
+        self.seed = seed
+        # Consecutive messages form threads of this many
+        self.thread_size = thread_size
+        self.attachment_every = attachment_every
+        self.paragraphs = paragraphs
+        self.lock = threading.Lock()
+        self.count = size
+        self.history_id = FIRST_HISTORY_ID
+        self.history = []
+        # Message index -> history id, for messages delivered after startup
+        self.added_at = {}
+        self.deleted = set()
+        # Message index -> labels, for messages relabelled through the API
+        self.relabelled = {}
+        # Message index -> resource, for messages sent through the API
+        self.sent = {}
+        self.sent_by_message_id = {}
+        # Label name -> id, for user labels created through the API
+        self.user_labels = {}
+
+    # Changes, as a real mailbox would see them
+
+    def deliver(self, count=1):
+        """
+        Add `count` new inbox messages and return their ids.
+        """
+        ids = []
+        with self.lock:
+            for _ in range(count):
+                index = self.count
+                self.count += 1
+                self.history_id += 1
+                self.added_at[index] = self.history_id
+                ids.append(self._id(index))
+                self.history.append({'id': str(self.history_id), 'messagesAdded': [
+                    {'message': {'id': ids[-1], 'threadId': self._id(self._thread_of(index)),
+                                 'labelIds': self._labels(index)}}
+                ]})
+        return ids
+
+    def delete(self, message_ids):
+        with self.lock:
+            for message_id in message_ids:
+                self.deleted.add(int(message_id, 16))
+                self.history_id += 1
+                self.history.append({'id': str(self.history_id), 'messagesDeleted': [{'message': {'id': message_id}}]})
+
+    def batch_modify(self, message_ids, add_labels=(), remove_labels=()):
+        if len(message_ids) > MAX_BATCH_IDS:
+            raise ApiError(400, f"Too many ids: at most {MAX_BATCH_IDS} are allowed")
+        # An unknown id fails the whole call before anything changes
+        indexes = [self._index(message_id) for message_id in message_ids]
+        with self.lock:
+            for message_id, index in zip(message_ids, indexes):
+                labels = [label for label in self._labels(index) if label not in remove_labels]
+                labels += [label for label in add_labels if label not in labels]
+                if index in self.sent:
+                    self.sent[index]['labelIds'] = labels
+                else:
+                    self.relabelled[index] = labels
+                self.history_id += 1
+                record = {'id': str(self.history_id)}
+                if add_labels:
+                    record['labelsAdded'] = [{'message': {'id': message_id}, 'labelIds': list(add_labels)}]
+                if remove_labels:
+                    record['labelsRemoved'] = [{'message': {'id': message_id}, 'labelIds': list(remove_labels)}]
+                self.history.append(record)
+
+    def batch_delete(self, message_ids):
+        if len(message_ids) > MAX_BATCH_IDS:
+            raise ApiError(400, f"Too many ids: at most {MAX_BATCH_IDS} are allowed")
+        for message_id in message_ids:
+            self._index(message_id)
+        self.delete(message_ids)
+
+    def add_sent(self, head, size):
+        """
+        Store a message sent through the API. `head` is the start of the
+        raw message, enough to read its headers.
+        """
+        headers = email.parser.BytesHeaderParser().parsebytes(head)
+        with self.lock:
+            index = self.count
+            self.count += 1
+            self.history_id += 1
+            message_id = self._id(index)
+            resource = {
+                'id': message_id, 'threadId': message_id, 'labelIds': ['SENT'], 'snippet': '',
+                'historyId': str(self.history_id), 'internalDate': str(int(time.time() * 1000)),
+                'sizeEstimate': size,
+                'payload': {'mimeType': headers.get_content_type(),
+                            'headers': [{'name': name, 'value': str(value)} for name, value in headers.items()]},
+            }
+            self.sent[index] = resource
+            if headers['Message-ID']:
+                self.sent_by_message_id[headers['Message-ID'].strip().strip('<>')] = index
+            self.history.append({'id': str(self.history_id), 'messagesAdded': [
+                {'message': {'id': message_id, 'threadId': message_id, 'labelIds': ['SENT']}}
+            ]})
+        return resource
+
+    # Reading
+
+    @staticmethod
+    def _id(index):
+        return f'{index:016x}'
+
+    def _index(self, message_id):
+        try:
+            index = int(message_id, 16)
+        except ValueError:
+            raise ApiError(400, f"Invalid id value: {message_id}")
+        if index >= self.count or index in self.deleted:
+            raise ApiError(404, "Requested entity was not found.", 'notFound')
+        return index
+
+    def _thread_of(self, index):
+        return index - index % self.thread_size
+
+    def _labels(self, index):
+        if index in self.sent:
+            return self.sent[index]['labelIds']
+        if index in self.relabelled:
+            return self.relabelled[index]
+        return ['UNREAD', 'INBOX'] if index % 3 == 0 else ['INBOX']
+
+    def list(self, label_ids=(), max_results=100, page_token=None, rfc822_id=None):
+        if rfc822_id is not None:
+            index = self.sent_by_message_id.get(rfc822_id.strip('<>'))
+            found = [] if index is None or index in self.deleted else [index]
+            return {'messages': [{'id': self._id(i), 'threadId': self._id(i)} for i in found],
+                    'resultSizeEstimate': len(found)}
+        start = int(page_token) if page_token else self.count - 1
+        messages = []
+        index = start
+        while index >= 0 and len(messages) < max_results:
+            if index not in self.deleted and all(label in self._labels(index) for label in label_ids):
+                messages.append({'id': self._id(index), 'threadId': self._id(self._thread_of(index))})
+            index -= 1
+        response = {'resultSizeEstimate': len(messages)}
+        if messages:
+            response['messages'] = messages
+        if index >= 0:
+            response['nextPageToken'] = str(index)
+        return response
+
+    def get(self, message_id, format='full', metadata_headers=()):
+        index = self._index(message_id)
+        if index in self.sent:
+            return self.sent[index]
+        message = self._synthetic(index)
+        if format == 'minimal':
+            del message['payload']
+        elif format == 'metadata':
+            wanted = {name.lower() for name in metadata_headers}
+            headers = message['payload']['headers']
+            message['payload'] = {'mimeType': message['payload']['mimeType'], 'headers': [
+                header for header in headers if not wanted or header['name'].lower() in wanted
+            ]}
+        elif format == 'raw':
+            raise ApiError(400, "format=raw is not supported by the fake server")
+        return message
+
+    def _thread_members(self, start):
+        # Messages sent through the API start threads of their own
+        return [index for index in range(start, min(start + self.thread_size, self.count))
+                if index not in self.deleted and (index == start or index not in self.sent)]
+
+    def list_threads(self, label_ids=(), max_results=100, page_token=None):
+        start = int(page_token) if page_token else self._thread_of(self.count - 1)
+        threads = []
+        thread = start
+        while thread >= 0 and len(threads) < max_results:
+            members = self._thread_members(thread)
+            if members and all(any(label in self._labels(index) for index in members) for label in label_ids):
+                threads.append({'id': self._id(thread), 'historyId': str(max(
+                    int(self.added_at.get(index, FIRST_HISTORY_ID)) for index in members))})
+            thread -= self.thread_size
+        response = {'resultSizeEstimate': len(threads)}
+        if threads:
+            response['threads'] = threads
+        if thread >= 0:
+            response['nextPageToken'] = str(thread)
+        return response
+
+    def get_thread(self, thread_id, format='full', metadata_headers=()):
+        try:
+            index = int(thread_id, 16)
+        except ValueError:
+            raise ApiError(400, f"Invalid id value: {thread_id}")
+        if index % self.thread_size == 0 and index < self.count:
+            members = self._thread_members(index)
+        elif index in self.sent and index not in self.deleted:
+            members = [index]
+        else:
+            members = []
+        if not members:
+            raise ApiError(404, "Requested entity was not found.", 'notFound')
+        messages = [self.get(self._id(member), format, metadata_headers) for member in members]
+        return {'id': thread_id, 'historyId': str(max(int(message['historyId']) for message in messages)),
+                'messages': messages}
+
+    def attachment(self, message_id, attachment_id):
+        index = self._index(message_id)
+        rng = random.Random(f'{self.seed}:attachment:{index}')
+        if attachment_id != f'att{index}' or index % self.attachment_every:
+            raise ApiError(404, "Requested entity was not found.", 'notFound')
+        size = rng.randint(10_000, 200_000)
+        return {'size': size, 'data': b64(rng.randbytes(size))}
+
+    def list_history(self, start_history_id, max_results=100, page_token=None):
+        start = int(start_history_id)
+        if start < FIRST_HISTORY_ID:
+            raise ApiError(404, "Requested entity was not found.", 'notFound')
+        with self.lock:
+            records = [record for record in self.history if int(record['id']) > start]
+            history_id = self.history_id
+        offset = int(page_token) if page_token else 0
+        response = {'historyId': str(history_id)}
+        if records[offset:offset + max_results]:
+            response['history'] = records[offset:offset + max_results]
+        if offset + max_results < len(records):
+            response['nextPageToken'] = str(offset + max_results)
+        return response
+
+    def list_labels(self):
+        system = ['INBOX', 'UNREAD', 'STARRED', 'IMPORTANT', 'SENT', 'DRAFT', 'SPAM', 'TRASH']
+        with self.lock:
+            user = [{'id': label_id, 'name': name, 'type': 'user'} for name, label_id in self.user_labels.items()]
+        return {'labels': [{'id': name, 'name': name, 'type': 'system'} for name in system] + user}
+
+    def create_label(self, name):
+        with self.lock:
+            if name in self.user_labels:
+                raise ApiError(409, "Label name exists or conflicts", 'alreadyExists')
+            self.user_labels[name] = f'Label_{len(self.user_labels) + 1}'
+            return {'id': self.user_labels[name], 'name': name, 'type': 'user'}
+
+    def profile(self):
+        total = self.count - len(self.deleted)
+        return {'emailAddress': 'me@example.com', 'messagesTotal': total,
+                'threadsTotal': -(-total // self.thread_size), 'historyId': str(self.history_id)}
+
+    def _synthetic(self, index):
+        rng = random.Random(f'{self.seed}:{index}')
+        name = rng.choice(NAMES)
+        subject = ' '.join(rng.choices(WORDS, k=rng.randint(3, 8))).capitalize()
+        paragraphs = [' '.join(rng.choices(WORDS, k=rng.randint(30, 80))).capitalize() + '.'
+                      for _ in range(self.paragraphs)]
+        text = '\n\n'.join(paragraphs)
+        html = '<html><body>' + ''.join(f'<p>{paragraph}</p>' for paragraph in paragraphs) + '</body></html>'
+        timestamp = BASE_TIME + index * 60
+        message_id = self._id(index)
+        headers = [
+            {'name': 'From', 'value': f'{name.title()} <{name}@example.com>'},
+            {'name': 'To', 'value': 'me@example.com'},
+            {'name': 'Subject', 'value': subject},
+            {'name': 'Date', 'value': email.utils.formatdate(timestamp)},
+            {'name': 'Message-ID', 'value': f'<{message_id}@example.com>'},
+        ]
+
+        def leaf(part_id, mime_type, data):
+            encoded = data.encode('utf-8')
+            return {'partId': part_id, 'mimeType': mime_type, 'filename': '',
+                    'headers': [{'name': 'Content-Type', 'value': f'{mime_type}; charset="UTF-8"'}],
+                    'body': {'size': len(encoded), 'data': b64(encoded)}}
+
+        alternative = {'partId': '', 'mimeType': 'multipart/alternative', 'filename': '', 'headers': headers,
+                       'body': {'size': 0}, 'parts': [leaf('0', 'text/plain', text), leaf('1', 'text/html', html)]}
+        payload = alternative
+        if index % self.attachment_every == 0:
+            size = random.Random(f'{self.seed}:attachment:{index}').randint(10_000, 200_000)
+            alternative = {**alternative, 'partId': '0', 'headers': [],
+                           'parts': [{**part, 'partId': f'0.{part["partId"]}'} for part in alternative['parts']]}
+            attachment = {'partId': '1', 'mimeType': 'application/pdf', 'filename': f'report-{index}.pdf',
+                          'headers': [{'name': 'Content-Disposition', 'value': 'attachment'}],
+                          'body': {'size': size, 'attachmentId': f'att{index}'}}
+            payload = {'partId': '', 'mimeType': 'multipart/mixed', 'filename': '', 'headers': headers,
+                       'body': {'size': 0}, 'parts': [alternative, attachment]}
+        return {
+            'id': message_id,
+            'threadId': self._id(self._thread_of(index)),
+            'labelIds': self._labels(index),
+            'snippet': text[:100],
+            'historyId': str(self.added_at.get(index, FIRST_HISTORY_ID)),
+            'internalDate': str(timestamp * 1000),
+            'sizeEstimate': len(text) + len(html) + 500,
+            'payload': payload,
+        }
+
+
+class _Server(ThreadingHTTPServer):
+    # Let hundreds of clients connect at once without their SYNs being dropped
+    request_queue_size = 1024
+
+
+class FakeGmail:
+    """
+    Serve a Mailbox over HTTP on a background thread.
+
+        with FakeGmail(Mailbox(1000), latency=0.05) as fake:
+            service = build_service(credentials, api_endpoint=fake.endpoint)
+
+    `latency` seconds are added to every HTTP request (a batch counts once)
+    and `error_rate` of the API calls, including calls inside a batch, fail
+    with a status picked from `error_statuses`. With `quota_per_second`,
+    calls fail with 429 rateLimitExceeded once they spend units faster than
+    that; like Gmail's moving average, a second's worth can be spent at once.
+    With `gzip`, responses are gzipped when the request accepts it.
+    """
+
+    def __init__(self, mailbox, latency=0.0, error_rate=0.0, error_statuses=(429,), host='127.0.0.1', port=0,
+                 seed=0, quota_per_second=0, gzip=False):
+        self.mailbox = mailbox
+        self.gzip = gzip
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses
+        self.quota_per_second = quota_per_second
+        self.quota_left = quota_per_second
+        self.quota_updated = time.monotonic()
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(
+            ('connections', 'http_requests', 'api_calls', 'batch_requests', 'injected_errors', 'quota_errors',
+             'token_refreshes', 'bytes_received', 'bytes_sent'), 0)
+        self.uploads = {}
+        self.upload_ids = itertools.count(1)
+        self.server = _Server((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def count(self, **amounts):
+        with self.lock:
+            for name, amount in amounts.items():
+                self.counters[name] += amount
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep connections open, as Gmail does, and send small replies
+            # straight away instead of waiting on the client's delayed ACK
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                fake.count(connections=1)
+
+            def handle_one(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                fake.count(http_requests=1, bytes_received=len(body))
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if self.path.split('?')[0] == '/batch':
+                    status, headers, data = fake.batch(self.headers.get('Content-Type', ''), body)
+                else:
+                    status, headers, data = fake.call(self.command, self.path, self.headers, body)
+                if fake.gzip and data and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    data = gzip.compress(data, compresslevel=1)
+                    headers = {**headers, 'Content-Encoding': 'gzip'}
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                fake.count(bytes_sent=len(data))
+
+            do_GET = do_POST = do_PUT = handle_one
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def call(self, method, uri, headers, body):
+        """
+        Answer one API call and return (status, headers, body bytes).
+        """
+        url = urllib.parse.urlsplit(uri)
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            if method == 'PUT' and url.path.startswith('/upload-session/'):
+                # Chunks of a resumable upload are not API calls of their own
+                return self.upload_chunk(url.path.rsplit('/', 1)[1], headers, body)
+            if method == 'POST' and url.path == '/token':
+                return self.token()
+            self.count(api_calls=1)
+            if self.error_rate:
+                with self.lock:
+                    failed = self.rng.random() < self.error_rate
+                    status = self.rng.choice(self.error_statuses)
+                if failed:
+                    self.count(injected_errors=1)
+                    reason, message = ERRORS.get(status, ERRORS[500])
+                    raise ApiError(status, message, reason)
+            if self.quota_per_second and not self.spend(quota_cost(method, url.path)):
+                self.count(quota_errors=1)
+                reason, message = ERRORS[429]
+                raise ApiError(429, message, reason)
+            response = self.route(method, url.path, query, headers, body)
+            if isinstance(response, tuple):
+                return response
+            if 'fields' in query:
+                response = apply_fields(response, parse_fields(query['fields'][0]))
+            return 200, {'Content-Type': 'application/json; charset=UTF-8'}, json.dumps(response).encode()
+        except ApiError as e:
+            return error_response(e)
+
+    def spend(self, units):
+        """
+        Charge `units` to the quota, unless too little of it is left.
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.quota_left = min(self.quota_per_second,
+                                  self.quota_left + (now - self.quota_updated) * self.quota_per_second)
+            self.quota_updated = now
+            if units > self.quota_left:
+                return False
+            self.quota_left -= units
+            return True
+
+    def route(self, method, path, query, headers, body):
+        mailbox = self.mailbox
+        parts = path.strip('/').split('/')
+        if parts[:4] == ['resumable', 'upload', 'gmail', 'v1'] or parts[:3] == ['upload', 'gmail', 'v1']:
+            if method == 'POST' and parts[-2:] == ['messages', 'send']:
+                return self.upload(query, headers, body)
+        elif parts[:2] == ['gmail', 'v1'] and len(parts) >= 5 and parts[2] == 'users':
+            resource, rest = parts[4], parts[5:]
+            if resource == 'profile' and method == 'GET':
+                return mailbox.profile()
+            if resource == 'history' and method == 'GET' and not rest:
+                return mailbox.list_history(query['startHistoryId'][0], int(query.get('maxResults', ['100'])[0]),
+                                            query.get('pageToken', [None])[0])
+            if resource == 'labels' and not rest:
+                if method == 'GET':
+                    return mailbox.list_labels()
+                if method == 'POST':
+                    return mailbox.create_label(json.loads(body)['name'])
+            if resource == 'threads' and method == 'GET':
+                if not rest:
+                    return mailbox.list_threads(query.get('labelIds', []), int(query.get('maxResults', ['100'])[0]),
+                                                query.get('pageToken', [None])[0])
+                if len(rest) == 1:
+                    return mailbox.get_thread(rest[0], query.get('format', ['full'])[0],
+                                              query.get('metadataHeaders', []))
+            if resource == 'messages':
+                if not rest and method == 'GET':
+                    match = re.match(r'rfc822msgid:(\S+)', query.get('q', [''])[0])
+                    return mailbox.list(query.get('labelIds', []), int(query.get('maxResults', ['100'])[0]),
+                                        query.get('pageToken', [None])[0], match.group(1) if match else None)
+                if rest == ['batchModify'] and method == 'POST':
+                    request = json.loads(body)
+                    mailbox.batch_modify(request['ids'], request.get('addLabelIds', ()),
+                                         request.get('removeLabelIds', ()))
+                    return 204, {}, b''
+                if rest == ['batchDelete'] and method == 'POST':
+                    mailbox.batch_delete(json.loads(body)['ids'])
+                    return 204, {}, b''
+                if rest == ['send'] and method == 'POST':
+                    raw = json.loads(body)['raw']
+                    data = base64.urlsafe_b64decode(raw + '=' * (-len(raw) % 4))
+                    return mailbox.add_sent(data, len(data))
+                if len(rest) == 1 and method == 'GET':
+                    return mailbox.get(rest[0], query.get('format', ['full'])[0], query.get('metadataHeaders', []))
+                if len(rest) == 3 and rest[1] == 'attachments' and method == 'GET':
+                    return mailbox.attachment(rest[0], rest[2])
+        raise ApiError(404, f"Not found: {method} {path}", 'notFound')
+
+    def token(self, expires_in=3600):
+        """
+        Answer an OAuth token refresh with a new access token.
+        """
+        self.count(token_refreshes=1)
+        response = {'access_token': f'fake-{uuid.uuid4().hex}', 'expires_in': expires_in, 'token_type': 'Bearer'}
+        return 200, {'Content-Type': 'application/json'}, json.dumps(response).encode()
+
+    def upload(self, query, headers, body):
+        upload_type = query.get('uploadType', ['media'])[0]
+        if upload_type == 'resumable':
+            upload_id = next(self.upload_ids)
+            with self.lock:
+                self.uploads[str(upload_id)] = {'received': 0, 'head': b''}
+            location = f'http://{headers["Host"]}/upload-session/{upload_id}'
+            return 200, {'Location': location}, b''
+        if upload_type == 'multipart':
+            # multipart/related: JSON metadata, then the message itself
+            boundary = re.search(r'boundary="?([^";]+)"?', headers['Content-Type']).group(1).encode()
+            body = split_head(body.split(b'--' + boundary)[2].lstrip(b'\r\n'))[1].rstrip(b'\n')
+        return self.mailbox.add_sent(body[:65536], len(body))
+
+    def upload_chunk(self, upload_id, headers, body):
+        with self.lock:
+            upload = self.uploads.get(upload_id)
+        if upload is None:
+            raise ApiError(404, "Unknown upload session", 'notFound')
+        match = re.match(r'bytes (\*|\d+-\d+)/(\d+|\*)', headers.get('Content-Range', ''))
+        if match and match.group(1) != '*':
+            upload['received'] += len(body)
+            if len(upload['head']) < 65536:
+                upload['head'] += body[:65536 - len(upload['head'])]
+        total = match.group(2) if match else '*'
+        if total != '*' and upload['received'] >= int(total):
+            with self.lock:
+                del self.uploads[upload_id]
+            resource = self.mailbox.add_sent(upload['head'], upload['received'])
+            return 200, {'Content-Type': 'application/json; charset=UTF-8'}, json.dumps(resource).encode()
+        headers = {'Range': f'bytes=0-{upload["received"] - 1}'} if upload['received'] else {}
+        return 308, headers, b''
+
+    def batch(self, content_type, body):
+        """
+        Answer a multipart/mixed batch of API calls with a multipart/mixed
+        batch of responses, matched up by Content-ID.
+        """
+        self.count(batch_requests=1)
+        boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1).encode()
+        parts = body.split(b'--' + boundary)[1:-1]
+        if len(parts) > MAX_BATCH_SIZE:
+            return error_response(ApiError(400, f"Too many requests in batch; max is {MAX_BATCH_SIZE}"))
+
+        reply_boundary = f'batch_{uuid.uuid4().hex}'
+        out = []
+        for part in parts:
+            part_headers, request = split_head(part.lstrip(b'\r\n'))
+            content_id = re.search(r'Content-ID:\s*<([^>]*)>', part_headers, re.IGNORECASE).group(1)
+            request_head, request_body = split_head(request)
+            lines = request_head.splitlines()
+            method, uri, _ = lines[0].split(' ', 2)
+            request_headers = dict(line.split(': ', 1) for line in lines[1:] if ': ' in line)
+            status, headers, data = self.call(method, uri, request_headers, request_body.rstrip(b'\n'))
+            header_lines = ''.join(f'{name}: {value}\r\n' for name, value in headers.items())
+            out.append(
+                f'--{reply_boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n'
+                f'HTTP/1.1 {status} {http.client.responses.get(status, "")}\r\n{header_lines}'
+                f'Content-Length: {len(data)}\r\n\r\n'.encode() + data + b'\r\n'
+            )
+        out.append(f'--{reply_boundary}--\r\n'.encode())
+        return 200, {'Content-Type': f'multipart/mixed; boundary={reply_boundary}'}, b''.join(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=1000, help="size of the synthetic inbox")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0, help="share of API calls that fail")
+    parser.add_argument('--error-status', type=int, nargs='+', default=[429])
+    parser.add_argument('--gzip', action='store_true', help="gzip responses for clients that accept it")
+    parser.add_argument('--quota-per-second', type=float, default=0,
+                        help="quota units a second before answering 429 (Gmail allows 250), 0 for no limit")
+    parser.add_argument('--thread-size', type=int, default=3, help="messages per conversation")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    fake = FakeGmail(Mailbox(args.messages, seed=args.seed, thread_size=args.thread_size), args.latency_ms / 1000, args.error_rate,
+                     tuple(args.error_status), args.host, args.port, args.seed, args.quota_per_second, args.gzip)
+    print(f"Serving a fake Gmail API with {args.messages} messages at {fake.endpoint}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(fake.stats()))
+
+
+if __name__ == '__main__':
+    main()
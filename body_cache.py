@@ -0,0 +1,110 @@
+"""
+Size-bounded cache of decoded message bodies, plus a background prefetcher
+that warms it for the rows the user is likely to open next.
+"""
+import sys
+import threading
+from collections import OrderedDict
+
+
+class BodyCache:
+    """
+    Least-recently-used cache of message bodies, bounded by the memory the
+    bodies take up rather than by how many there are.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, message_id):
+        with self._lock:
+            return message_id in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, message_id):
+        with self._lock:
+            entry = self._entries.get(message_id)
+            if entry is None:
+                return None
+            self._entries.move_to_end(message_id)
+            return entry[0]
+
+    def put(self, message_id, body):
+        cost = sys.getsizeof(body)
+        if cost > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(message_id, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[message_id] = (body, cost)
+            self.size += cost
+            while self.size > self.max_bytes:
+                _, (_, evicted_cost) = self._entries.popitem(last=False)
+                self.size -= evicted_cost
+
+
+class Prefetcher:
+    """
+    Fetches bodies ahead of time on a single background thread.
+
+    Only the most recent request matters: asking for a new set of rows (for
+    example after scrolling) replaces whatever was still waiting, so the
+    prefetcher follows the viewport instead of working through a backlog.
+    Having its own thread keeps it from taking workers away from requests
+    the user is waiting on.
+
+    `fetch_bodies(message_ids)` must return a dict of message id to body.
+    """
+
+    def __init__(self, cache, fetch_bodies, batch_size=20):
+        self.cache = cache
+        self.fetch_bodies = fetch_bodies
+        self.batch_size = batch_size
+        self._pending = []
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='gmail-prefetch', daemon=True)
+        self._thread.start()
+
+    def request(self, message_ids):
+        """
+        Replace the pending work with the given rows, most important first.
+        """
+        wanted = [message_id for message_id in dict.fromkeys(message_ids) if message_id not in self.cache]
+        with self._condition:
+            self._pending = wanted
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._pending = []
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                batch = self._pending[:self.batch_size]
+                self._pending = self._pending[self.batch_size:]
+
+            batch = [message_id for message_id in batch if message_id not in self.cache]
+            if not batch:
+                continue
+            try:
+                bodies = self.fetch_bodies(batch)
+            except Exception as e:
+                print(f"Error prefetching emails: {e}")
+                continue
+            for message_id, body in bodies.items():
+                self.cache.put(message_id, body)
@@ -0,0 +1,203 @@
+"""
+Send many emails concurrently while staying inside Gmail's sending limits.
+
+Recipients are sent in parallel on a small thread pool. Every send first takes
+a token from a per-second bucket (blocking until one is free) and one from a
+per-day bucket (which never blocks: once it is empty the remaining
+recipients are reported as deferred). The per-day bucket starts out short
+by the messages already sent in the last day, which the caller passes in,
+so the daily limit holds across calls. Rate-limit and server errors are
+retried with exponential backoff and full jitter. The sends' API calls run
+at quota.BULK priority, so the app stays responsive while a bulk job runs.
+"""
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import SEND, recorder
+from quota import BULK, scheduler
+
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+# Gmail's sending limit is per rolling day
+DAY = 86400
+
+
+class TokenBucket:
+    """
+    Classic token bucket: refills at `rate` tokens per second up to `capacity`.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        with self.lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1):
+        """
+        Block until `tokens` are available and take them.
+        """
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class SendResult:
+    """
+    Outcome for one recipient: status is "sent", "failed" or "deferred".
+    """
+
+    def __init__(self, recipient, status, message_id=None, attempts=0, error=None):
+        self.recipient = recipient
+        self.status = status
+        self.message_id = message_id
+        self.attempts = attempts
+        self.error = error
+
+    def __repr__(self):
+        return f"SendResult({self.recipient!r}, {self.status!r}, attempts={self.attempts})"
+
+
+class BulkReport:
+    """
+    Per-recipient results of a bulk send plus overall throughput.
+    """
+
+    def __init__(self, results, seconds):
+        self.results = results
+        self.seconds = seconds
+
+    def count(self, status):
+        return sum(1 for result in self.results if result.status == status)
+
+    @property
+    def sent(self):
+        return self.count('sent')
+
+    @property
+    def throughput(self):
+        """
+        Messages actually sent per second over the whole run.
+        """
+        return self.sent / self.seconds if self.seconds else 0.0
+
+    def as_dict(self):
+        return {
+            'recipients': len(self.results),
+            'sent': self.sent,
+            'failed': self.count('failed'),
+            'deferred': self.count('deferred'),
+            'retries': sum(max(result.attempts - 1, 0) for result in self.results),
+            'seconds': round(self.seconds, 3),
+            'messages_per_second': round(self.throughput, 2),
+        }
+
+
+def is_retryable(error):
+    from googleapiclient.errors import HttpError
+
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUSES
+    # Dropped connections and timeouts
+    return isinstance(error, OSError)
+
+
+def retry_after(error):
+    """
+    Seconds the server asked us to wait, if it said so.
+    """
+    from googleapiclient.errors import HttpError
+
+    if isinstance(error, HttpError):
+        value = error.resp.get('retry-after')
+        if value and value.isdigit():
+            return int(value)
+    return None
+
+
+def send_with_retries(send, message, max_retries=5, base_delay=1.0, max_delay=32.0, method=SEND):
+    """
+    Call `send(message)`, retrying transient failures. Returns (response, attempts).
+    Retries are recorded against API method `method`.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return send(message), attempt
+        except Exception as e:
+            if attempt > max_retries or not is_retryable(e):
+                e.attempts = attempt
+                raise
+            delay = retry_after(e)
+            if delay is None:
+                delay = random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+            recorder.record_retry(method)
+            time.sleep(delay)
+
+
+def send_bulk(recipients, build_message, send, per_second=10, per_day=2000, workers=8,
+              max_retries=5, base_delay=1.0, on_result=None, sent_today=0):
+    """
+    Send one message per recipient and return a BulkReport.
+
+    `build_message(recipient)` creates the message and `send(message)` sends
+    it (and is called from worker threads, so it must be thread-safe).
+    `on_result(result)` is called from the worker thread as each recipient
+    finishes. `sent_today` messages sent in the last 24 hours count against
+    `per_day`.
+    """
+    second_bucket = TokenBucket(per_second)
+    day_bucket = TokenBucket(per_day / DAY, capacity=per_day)
+    day_bucket.tokens = max(per_day - sent_today, 0)
+    start = time.perf_counter()
+
+    def throttled_send(message):
+        # Retries count against the per-second quota too
+        second_bucket.acquire()
+        return send(message)
+
+    def send_one(recipient):
+        # Bulk sends give way to everything else in the Gmail quota
+        with scheduler.priority(BULK):
+            return send_recipient(recipient)
+
+    def send_recipient(recipient):
+        if not day_bucket.try_acquire():
+            result = SendResult(recipient, 'deferred', error="Daily sending quota reached")
+        else:
+            try:
+                response, attempts = send_with_retries(
+                    throttled_send, build_message(recipient), max_retries=max_retries, base_delay=base_delay
+                )
+                result = SendResult(recipient, 'sent', message_id=response.get('id'), attempts=attempts)
+            except Exception as e:
+                result = SendResult(recipient, 'failed', attempts=getattr(e, 'attempts', 1), error=e)
+        if on_result:
+            on_result(result)
+        return result
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='gmail-bulk') as pool:
+        results = list(pool.map(send_one, recipients))
+    return BulkReport(results, time.perf_counter() - start)
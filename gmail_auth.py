@@ -0,0 +1,175 @@
+"""
+OAuth credentials and Gmail service construction shared by the GUI apps and
+the headless command line tool.
+
+The Google client libraries take a few hundred milliseconds to import, so
+they are imported inside the functions that need them. The apps call these
+on a worker thread, and their window and cached inbox appear without
+waiting for them.
+"""
+import datetime
+import functools
+import json
+import os
+import pickle
+
+from metrics import recorder
+
+# gmail.modify covers reading as well as changing labels, e.g. mark as read or archive
+SCOPES = ['https://www.googleapis.com/auth/gmail.modify', 'https://www.googleapis.com/auth/gmail.send']
+
+# Talk to another server instead of Gmail, e.g. the local fake in benchmarks/fake_gmail.py
+API_ENDPOINT = os.environ.get('GMAIL_API_ENDPOINT')
+
+# Refresh access tokens this many seconds before they expire, so no request
+# has to wait for a refresh
+REFRESH_MARGIN = 300
+
+
+class AuthError(Exception):
+    """
+    No usable credentials could be loaded or created.
+    """
+
+
+def load_credentials(token_path, credentials_path, scopes=SCOPES, interactive=True):
+    """
+    Load the saved token, refreshing it if it has expired, or run the
+    browser login flow when there is no usable token.
+
+    Returns (credentials, new_login). With `interactive=False` (no display,
+    e.g. under cron) a missing or unrefreshable token raises AuthError
+    instead of starting the browser flow. A token granted fewer than
+    `scopes` counts as missing, so asking for more scopes logs in again.
+    """
+    creds = None
+    if os.path.exists(token_path):
+        try:
+            with open(token_path, 'rb') as token:
+                creds = pickle.load(token)
+        except Exception as e:
+            print(f"Error loading {token_path}: {e}")
+            os.remove(token_path)
+            creds = None
+
+    # Tokens without recorded scopes, e.g. made by hand for tests, are taken as they are
+    if creds and creds.scopes and not creds.has_scopes(scopes):
+        print(f"{token_path} lacks some of the scopes {scopes}, logging in again")
+        creds = None
+
+    if creds and creds.valid:
+        return creds, False
+
+    new_login = False
+    if creds and creds.expired and creds.refresh_token:
+        try:
+            with recorder.phase('auth_refresh'):
+                creds.refresh(refresh_request())
+            print("Refreshed expired credentials")
+        except Exception as e:
+            print(f"Error refreshing credentials: {e}")
+            creds = None
+
+    if not creds or not creds.valid:
+        if not interactive:
+            raise AuthError(f"No valid token at {token_path}; log in once interactively to create it")
+        if not os.path.exists(credentials_path):
+            raise AuthError(f"{credentials_path} not found")
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
+        flow = InstalledAppFlow.from_client_secrets_file(credentials_path, scopes)
+        creds = flow.run_local_server(port=0)
+        new_login = True
+
+    save_credentials(creds, token_path)
+    return creds, new_login
+
+
+def save_credentials(credentials, token_path):
+    # Save what SharedCredentials wraps, not the wrapper and its lock
+    credentials = getattr(credentials, 'credentials', credentials)
+    try:
+        with open(token_path, 'wb') as token:
+            pickle.dump(credentials, token)
+    except Exception as e:
+        print(f"Error saving {token_path}: {e}")
+
+
+def refresh_credentials(credentials, token_path, margin=REFRESH_MARGIN):
+    """
+    Refresh the access token if it expires within `margin` seconds and save
+    it, so it is renewed in the background instead of by whichever request
+    first finds it expired.
+
+    Returns the number of seconds until it should be called again, or None
+    for credentials without an expiry. Raises if the refresh fails.
+    """
+    if credentials.expiry is None:
+        return None
+    remaining = (credentials.expiry - _utcnow()).total_seconds()
+    if remaining <= margin and credentials.refresh_token:
+        with recorder.phase('auth_refresh'):
+            credentials.refresh(refresh_request())
+        save_credentials(credentials, token_path)
+        print("Refreshed credentials ahead of expiry")
+        remaining = (credentials.expiry - _utcnow()).total_seconds()
+    return max(remaining - margin, 0)
+
+
+def refresh_request():
+    """
+    Transport for refreshing credentials. httplib2 is loaded for the
+    service anyway, unlike requests.
+    """
+    import google_auth_httplib2
+    import httplib2
+
+    return google_auth_httplib2.Request(httplib2.Http())
+
+
+def _utcnow():
+    # google-auth keeps expiry as a naive UTC datetime
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+@functools.lru_cache(maxsize=None)
+def discovery_document(api_endpoint=None):
+    """
+    The Gmail discovery document shipped with googleapiclient, read once per
+    process. Returned as JSON text because building a service modifies the
+    parsed document, so each build parses its own copy.
+    """
+    from googleapiclient import discovery_cache
+
+    document = discovery_cache.get_static_doc('gmail', 'v1')
+    if api_endpoint:
+        # client_options only moves the REST calls; batch and upload URLs are
+        # built from rootUrl in the discovery document, so move that instead
+        parsed = json.loads(document)
+        parsed['rootUrl'] = api_endpoint.rstrip('/') + '/'
+        document = json.dumps(parsed)
+    return document
+
+
+def build_service(credentials, api_endpoint=None, http=None):
+    """
+    Build a Gmail service, on its own authorized transport unless `http`
+    is given.
+
+    Services are not thread-safe, so every thread needs its own; threads
+    share connections by passing the same http_pool.HttpPool as `http`.
+    build_http leaves 308 responses alone, which resumable uploads rely on.
+    Every call the service makes is reported to metrics.recorder.
+    `api_endpoint` (default $GMAIL_API_ENDPOINT) points the service at
+    another server.
+    """
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.discovery import build_from_document
+    from googleapiclient.http import build_http
+
+    from instrumented_http import InstrumentedRequest
+
+    if http is None:
+        http = AuthorizedHttp(credentials, http=build_http())
+    document = discovery_document(api_endpoint or API_ENDPOINT)
+    return build_from_document(document, http=http, requestBuilder=InstrumentedRequest)
@@ -0,0 +1,312 @@
+"""
+Headless command line interface and sync daemon.
+
+Runs the same sync, outbox and bulk send code as the GUI apps without a
+display, e.g. from cron or on a server:
+
+    python gmail_cli.py login                     # one-time browser login
+    python gmail_cli.py sync --pages 5            # sync once
+    python gmail_cli.py --rules rules.json daemon # also run rules on new mail
+    python gmail_cli.py backfill --concurrency 200 # page in all older mail
+    python gmail_cli.py daemon                    # keep syncing, adaptively
+    python gmail_cli.py send --to a@b.com --subject Hi --body Hello --attach report.pdf
+    python gmail_cli.py drain                     # send whatever is queued
+    python gmail_cli.py welcome --csv signups.csv # bulk welcome emails
+
+Every command writes its stats to stdout as JSON (the daemon writes one JSON
+line per cycle and a summary on exit); progress messages go to stderr.
+Exit status is 0 on success, 1 on failure and 2 when there is no usable
+login.
+
+With --metrics-file, per-call latency, traffic and quota stats are written
+to that file on exit, and after every cycle in daemon mode: Prometheus text
+if the name ends in .prom (for node_exporter's textfile collector), JSON
+otherwise.
+"""
+import argparse
+import asyncio
+import json
+import random
+import signal
+import sys
+import threading
+import time
+
+from async_gmail import AsyncGmail
+from attachments import spool_message
+from gmail_auth import AuthError, SCOPES, build_service, load_credentials, refresh_credentials
+from gmail_fetch import find_message_by_rfc822_id
+from http_pool import HttpPool
+from mail_sync import backfill, fetch_next_page, has_more_pages, sync_mailbox
+from message_store import MessageStore
+from metrics import recorder
+from outbox import Outbox, send_item
+from rules import RULES_PATH, RuleEngine, RuleError, load_rules
+from templates import merge, read_recipients, welcome_template
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_AUTH = 2
+
+
+class HeadlessClient:
+    """
+    The Gmail state the GUI apps keep, without any widgets.
+    """
+
+    def __init__(self, credentials, store_path='messages.db', outbox_path='outbox.db', rules=None):
+        # Threads share connections and one thread-safe copy of the credentials
+        self.pool = HttpPool(credentials)
+        self.credentials = self.pool.credentials
+        self.store = MessageStore(store_path)
+        self.outbox = Outbox(outbox_path)
+        # Run on new mail by each sync; forwards and replies wait in the outbox for the next drain
+        self.rules = RuleEngine(rules, self.outbox) if rules else None
+        self.welcome_template = welcome_template()
+        self._local = threading.local()
+
+    def service(self):
+        """
+        Gmail service for the calling thread; bulk sends use several threads.
+        """
+        if not hasattr(self._local, 'service'):
+            self._local.service = build_service(self.credentials, http=self.pool)
+        return self._local.service
+
+    def send_item(self, item):
+        return send_item(self.service(), item)
+
+    def find_sent(self, rfc822_id):
+        return find_message_by_rfc822_id(self.service(), rfc822_id)
+
+    def sync(self, label='INBOX', page_size=100, pages=0):
+        """
+        Sync the store, then page in up to `pages` more pages of older mail.
+        """
+        start = time.perf_counter()
+        with recorder.phase('sync'):
+            stats = sync_mailbox(self.service(), self.store, label=label, max_results=page_size, rules=self.rules)
+        stats['pages'] = 0
+        while stats['pages'] < pages and has_more_pages(self.store):
+            with recorder.phase('page_in'):
+                stats['added'] += fetch_next_page(self.service(), self.store, label=label, max_results=page_size)
+            stats['pages'] += 1
+        stats['stored'] = self.store.count_label(label)
+        stats['seconds'] = round(time.perf_counter() - start, 3)
+        return stats
+
+    def backfill(self, label='INBOX', page_size=500, concurrency=100, max_messages=None):
+        """
+        Sync the store, then page in all older mail with up to `concurrency`
+        requests in flight from a single thread.
+        """
+        start = time.perf_counter()
+        stats = self.sync(label)
+
+        async def run():
+            async with AsyncGmail(self.credentials, max_in_flight=concurrency) as gmail:
+                with recorder.phase('backfill'):
+                    return await backfill(gmail, self.store, label, page_size, max_messages,
+                                          on_page=lambda page: print(f"Backfilled {page['added']} messages",
+                                                                     file=sys.stderr))
+
+        result = asyncio.run(run())
+        result['added'] += stats['added']
+        result['errors'] += stats['errors']
+        result['stored'] = self.store.count_label(label)
+        result['seconds'] = round(time.perf_counter() - start, 3)
+        return result
+
+    def drain(self):
+        """
+        Send everything due in the outbox.
+        """
+        results = self.outbox.drain(self.send_item, self.find_sent)
+        counts = self.outbox.counts()
+        return {
+            'sent': sum(1 for _, error in results if error is None),
+            'errors': sum(1 for _, error in results if error is not None),
+            'queued': counts.get('pending', 0) + counts.get('sending', 0),
+            'failed_total': counts.get('failed', 0),
+        }
+
+    def send(self, to, subject, body, attachments=()):
+        self.outbox.enqueue(spool_message(self.outbox.spool_dir, to, subject, body, attachments))
+        return self.drain()
+
+    def welcome(self, signups, **limits):
+        messages = merge(self.welcome_template, signups, defaults={'name': 'User'})
+        report = self.outbox.send_bulk(messages, self.send_item, self.find_sent, **limits)
+        return report.as_dict()
+
+
+class AdaptiveInterval:
+    """
+    Polling interval that stays short while the mailbox is busy and backs
+    off exponentially while nothing changes or requests keep failing.
+    """
+
+    def __init__(self, min_interval=30, max_interval=900, factor=2.0, jitter=0.1):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.jitter = jitter
+        self.interval = min_interval
+
+    def update(self, changed):
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * self.factor)
+        return self.interval
+
+    def delay(self):
+        # Spread out many daemons that started together
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+def run_daemon(client, args, emit):
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+
+    interval = AdaptiveInterval(args.min_interval, args.max_interval)
+    totals = {'cycles': 0, 'failed_cycles': 0, 'added': 0, 'removed': 0, 'relabelled': 0, 'sent': 0}
+    started = time.time()
+    while not stop.is_set():
+        cycle = {'cycle': totals['cycles'] + 1, 'time': round(time.time(), 3)}
+        try:
+            # Renew and save the token ahead of expiry instead of mid-sync
+            refresh_credentials(client.credentials, args.token)
+            stats = client.sync(args.label, args.page_size)
+            outbox = client.drain()
+            changed = bool(stats['added'] or stats['removed'] or stats['relabelled'] or outbox['sent'])
+            cycle.update(stats, outbox=outbox)
+            for key in ('added', 'removed', 'relabelled'):
+                totals[key] += stats[key]
+            totals['sent'] += outbox['sent']
+        except Exception as e:
+            changed = False
+            cycle['error'] = str(e)
+            totals['failed_cycles'] += 1
+        totals['cycles'] += 1
+        cycle['next_poll_seconds'] = round(interval.update(changed), 1)
+        if recorder.enabled:
+            cycle['quota_units'] = recorder.quota_units()
+        emit(cycle)
+        if args.metrics_file:
+            recorder.write(args.metrics_file)
+        if args.max_cycles and totals['cycles'] >= args.max_cycles:
+            break
+        stop.wait(interval.delay())
+
+    totals['uptime_seconds'] = round(time.time() - started, 1)
+    return totals
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Headless Gmail sync and send.")
+    parser.add_argument('--token', default='token.pickle', help="saved login token")
+    parser.add_argument('--credentials', default='cred1.json', help="OAuth client secrets, for login")
+    parser.add_argument('--store', default='messages.db')
+    parser.add_argument('--outbox', default='outbox.db')
+    parser.add_argument('--rules', default=RULES_PATH, help="rules to run on new mail, if the file exists")
+    parser.add_argument('--metrics-file', help="record API stats and write them here (.prom or .json)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('login', help="log in through the browser and save the token")
+
+    sync = commands.add_parser('sync', help="sync the local store once")
+    daemon = commands.add_parser('daemon', help="keep syncing and sending until stopped")
+    for command in (sync, daemon):
+        command.add_argument('--label', default='INBOX')
+        command.add_argument('--page-size', type=int, default=100)
+    sync.add_argument('--pages', type=int, default=0, help="older pages to fetch after syncing")
+
+    backfill = commands.add_parser('backfill', help="sync, then page in all older mail concurrently")
+    backfill.add_argument('--label', default='INBOX')
+    backfill.add_argument('--page-size', type=int, default=500)
+    backfill.add_argument('--concurrency', type=int, default=100, help="requests in flight at once")
+    backfill.add_argument('--max-messages', type=int, help="stop after about this many")
+    daemon.add_argument('--min-interval', type=float, default=30, help="seconds between polls while busy")
+    daemon.add_argument('--max-interval', type=float, default=900, help="longest wait while idle")
+    daemon.add_argument('--max-cycles', type=int, default=0, help="stop after this many polls")
+
+    send = commands.add_parser('send', help="queue and send one email")
+    send.add_argument('--to', required=True)
+    send.add_argument('--subject', required=True)
+    send.add_argument('--body', required=True)
+    send.add_argument('--attach', nargs='*', default=[])
+
+    commands.add_parser('drain', help="send everything due in the outbox")
+
+    welcome = commands.add_parser('welcome', help="send welcome emails to a CSV of signups")
+    welcome.add_argument('--csv', required=True, help="file with an 'email' column and optional 'name'")
+    welcome.add_argument('--per-second', type=float, default=10)
+    welcome.add_argument('--per-day', type=int, default=2000)
+    welcome.add_argument('--workers', type=int, default=8)
+    return parser.parse_args(argv)
+
+
+def run_command(client, args, emit):
+    try:
+        if args.command == 'sync':
+            result = client.sync(args.label, args.page_size, args.pages)
+        elif args.command == 'backfill':
+            result = client.backfill(args.label, args.page_size, args.concurrency, args.max_messages)
+        elif args.command == 'daemon':
+            result = run_daemon(client, args, emit)
+        elif args.command == 'send':
+            result = client.send(args.to, args.subject, args.body, args.attach)
+        elif args.command == 'drain':
+            result = client.drain()
+        else:
+            result = client.welcome(read_recipients(args.csv), per_second=args.per_second,
+                                    per_day=args.per_day, workers=args.workers)
+    except Exception as e:
+        emit({'command': args.command, 'error': str(e)})
+        return EXIT_FAILED
+
+    emit({'command': args.command, **result})
+    failed = result.get('errors') or result.get('failed')
+    return EXIT_FAILED if failed else EXIT_OK
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.metrics_file:
+        recorder.enabled = True
+
+    # Keep stdout for JSON; progress printed by the shared modules goes to stderr
+    out = sys.stdout
+    sys.stdout = sys.stderr
+
+    def emit(data):
+        out.write(json.dumps(data) + '\n')
+        out.flush()
+
+    try:
+        credentials, new_login = load_credentials(args.token, args.credentials, SCOPES,
+                                                  interactive=args.command == 'login')
+    except AuthError as e:
+        emit({'command': args.command, 'error': str(e)})
+        return EXIT_AUTH
+    if args.command == 'login':
+        emit({'command': 'login', 'new_login': new_login})
+        return EXIT_OK
+
+    try:
+        rules = load_rules(args.rules)
+    except (OSError, RuleError) as e:
+        emit({'command': args.command, 'error': f"Failed to load rules: {e}"})
+        return EXIT_FAILED
+    client = HeadlessClient(credentials, args.store, args.outbox, rules)
+    try:
+        return run_command(client, args, emit)
+    finally:
+        if args.metrics_file:
+            recorder.write(args.metrics_file)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,277 @@
+"""
+Helpers for fetching Gmail messages without one round trip per message.
+"""
+import email.utils
+import json
+import sys
+import threading
+import time
+from datetime import datetime
+
+from metrics import GET, THREAD_GET, recorder
+from quota import is_rate_limited, scheduler, units_for
+from single_flight import raise_if_cancelled
+
+# Gmail accepts up to 100 calls in one batch request, but starts rate
+# limiting much earlier, so 50 is the recommended batch size.
+BATCH_SIZE = 50
+
+# Status codes worth retrying for a single item inside a batch.
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+# The inbox view only needs these headers, so summary fetches ask Gmail for
+# metadata only and mask the response down to the fields we actually read.
+SUMMARY_HEADERS = ['From', 'Subject', 'Date']
+LIST_FIELDS = 'messages/id,nextPageToken'
+SUMMARY_FIELDS = 'id,threadId,labelIds,historyId,internalDate,sizeEstimate,snippet,payload/headers'
+THREAD_LIST_FIELDS = 'threads(id,historyId),nextPageToken'
+THREAD_FIELDS = f'id,historyId,messages({SUMMARY_FIELDS})'
+
+# Bit for each label in MessageSummary.labels. System labels get fixed bits;
+# user labels are given the next free bit the first time they are seen.
+LABEL_BITS = {label: 1 << bit for bit, label in enumerate((
+    'INBOX', 'UNREAD', 'STARRED', 'IMPORTANT', 'SENT', 'DRAFT', 'SPAM', 'TRASH', 'CHAT',
+    'CATEGORY_PERSONAL', 'CATEGORY_SOCIAL', 'CATEGORY_PROMOTIONS', 'CATEGORY_UPDATES', 'CATEGORY_FORUMS',
+))}
+_label_bits_lock = threading.Lock()
+
+
+def chunked(items, size):
+    """
+    Split a list into consecutive chunks of at most `size` items.
+    """
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def fetch_messages_batched(service, message_ids, format='full', batch_size=BATCH_SIZE, retries=2, **kwargs):
+    """
+    Fetch the given messages using Gmail batch requests.
+
+    Returns a tuple (messages, errors): `messages` maps message id to the
+    message resource, `errors` maps message id to the exception raised for
+    that item. A failing message never fails the rest of the batch; items
+    that were rate limited are retried in a follow-up batch.
+    """
+    # Building the resource costs more than building a request, so do it once
+    return _fetch_batched(service, service.users().messages(), GET, message_ids, batch_size, retries,
+                          format=format, **kwargs)
+
+
+def fetch_threads_batched(service, thread_ids, format='full', batch_size=BATCH_SIZE, retries=2, **kwargs):
+    """
+    Fetch whole threads using Gmail batch requests, one call per thread
+    however many messages it holds. Returns (threads, errors) like
+    fetch_messages_batched.
+    """
+    return _fetch_batched(service, service.users().threads(), THREAD_GET, thread_ids, batch_size, retries,
+                          format=format, **kwargs)
+
+
+def _fetch_batched(service, resource, method_id, ids, batch_size, retries, **kwargs):
+    from googleapiclient.errors import HttpError
+
+    results = {}
+    errors = {}
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            errors[request_id] = exception
+            recorder.record_call(method_id, None,
+                                 exception.resp.status if isinstance(exception, HttpError) else 'error')
+        else:
+            results[request_id] = response
+            recorder.record_call(method_id, None, 200)
+
+    pending = list(dict.fromkeys(ids))
+    for attempt in range(retries + 1):
+        for chunk in chunked(pending, batch_size):
+            # A batch is a POST, so InstrumentedRequest does not check this itself
+            raise_if_cancelled()
+            batch = service.new_batch_http_request(callback=callback)
+            for item_id in chunk:
+                batch.add(resource.get(userId='me', id=item_id, **kwargs), request_id=item_id)
+            # Each call in the batch is charged its own units
+            scheduler.acquire(units_for(method_id, len(chunk)))
+            start = time.perf_counter()
+            batch.execute()
+            recorder.record_call('batch', time.perf_counter() - start, 200)
+            if any(is_rate_limited(errors[item_id]) for item_id in chunk if item_id in errors):
+                scheduler.rate_limited()
+            else:
+                scheduler.succeeded()
+
+        # Only retry items that failed with a transient error
+        pending = [
+            item_id for item_id, error in errors.items()
+            if isinstance(error, HttpError) and error.resp.status in RETRYABLE_STATUSES
+        ]
+        if not pending or attempt == retries:
+            break
+        for item_id in pending:
+            del errors[item_id]
+        recorder.record_retry(method_id, len(pending))
+        time.sleep(2 ** attempt)
+
+    return results, errors
+
+
+def list_message_ids(service, label_ids=('INBOX',), max_results=10, page_token=None):
+    """
+    List message ids for the given labels, returning (ids, next_page_token).
+    """
+    kwargs = {'userId': 'me', 'maxResults': max_results, 'labelIds': list(label_ids), 'fields': LIST_FIELDS}
+    if page_token:
+        kwargs['pageToken'] = page_token
+    results = service.users().messages().list(**kwargs).execute()
+    return [message['id'] for message in results.get('messages', [])], results.get('nextPageToken')
+
+
+def list_thread_ids(service, label_ids=('INBOX',), max_results=10, page_token=None):
+    """
+    List the threads with messages in the given labels, newest first.
+    Returns ([(thread id, history id)], next_page_token).
+    """
+    kwargs = {'userId': 'me', 'maxResults': max_results, 'labelIds': list(label_ids), 'fields': THREAD_LIST_FIELDS}
+    if page_token:
+        kwargs['pageToken'] = page_token
+    results = service.users().threads().list(**kwargs).execute()
+    return [(thread['id'], thread['historyId']) for thread in results.get('threads', [])], results.get('nextPageToken')
+
+
+def fetch_thread_summaries(service, thread_ids, **kwargs):
+    """
+    Fetch the summary headers of every message in the given threads.
+    """
+    return fetch_threads_batched(service, thread_ids, format='metadata',
+                                 metadataHeaders=SUMMARY_HEADERS, fields=THREAD_FIELDS, **kwargs)
+
+
+def find_message_by_rfc822_id(service, rfc822_id):
+    """
+    Return the Gmail id of the message with the given Message-ID header, or None.
+    """
+    results = service.users().messages().list(
+        userId='me', q=f'rfc822msgid:{rfc822_id.strip("<>")}', maxResults=1,
+        includeSpamTrash=True, fields='messages/id'
+    ).execute()
+    messages = results.get('messages', [])
+    return messages[0]['id'] if messages else None
+
+
+def fetch_summaries(service, message_ids, summary_mode=True, headers=SUMMARY_HEADERS, fields=SUMMARY_FIELDS,
+                    **kwargs):
+    """
+    Fetch what the inbox view needs for each message.
+
+    In summary mode only the From/Subject/Date headers are downloaded, or
+    the given `headers` and `fields`; with `summary_mode=False` the full
+    message is fetched, which is useful for comparing payload sizes.
+    """
+    if not summary_mode:
+        return fetch_messages_batched(service, message_ids, format='full', **kwargs)
+    return fetch_messages_batched(
+        service, message_ids, format='metadata',
+        metadataHeaders=headers, fields=fields, **kwargs
+    )
+
+
+def payload_size(messages):
+    """
+    Approximate number of JSON bytes Gmail returned for the given messages.
+    """
+    return sum(len(json.dumps(message)) for message in messages.values())
+
+
+def label_mask(label_ids):
+    """
+    Pack label ids into a bitmask, registering any label not seen before.
+    """
+    mask = 0
+    for label in label_ids:
+        bit = LABEL_BITS.get(label)
+        if bit is None:
+            with _label_bits_lock:
+                bit = LABEL_BITS.setdefault(label, 1 << len(LABEL_BITS))
+        mask |= bit
+    return mask
+
+
+def label_names(mask):
+    """
+    The label ids set in a bitmask from `label_mask`.
+    """
+    return [label for label, bit in LABEL_BITS.items() if mask & bit]
+
+
+class MessageSummary:
+    """
+    What the store and the inbox view keep about a message: a small fixed
+    record instead of the nested API response, which for a large mailbox
+    held in memory is several times the size.
+    """
+
+    __slots__ = ('id', 'thread_id', 'history_id', 'sender', 'subject', 'timestamp', 'labels', 'size', 'snippet')
+
+    def __init__(self, id, thread_id, history_id, sender, subject, timestamp, labels=0, size=0, snippet=''):
+        self.id = id
+        self.thread_id = thread_id
+        self.history_id = history_id
+        self.sender = sender
+        self.subject = subject
+        # Seconds since the epoch, 0 when unknown
+        self.timestamp = timestamp
+        self.labels = labels
+        self.size = size
+        self.snippet = snippet
+
+    def __repr__(self):
+        return f'MessageSummary({self.id!r}, {self.sender!r}, {self.subject!r})'
+
+    @property
+    def label_ids(self):
+        return label_names(self.labels)
+
+    @property
+    def date(self):
+        if not self.timestamp:
+            return "Invalid Date"
+        return datetime.fromtimestamp(self.timestamp).strftime('%Y-%m-%d %H:%M')
+
+
+def parse_summary(msg):
+    """
+    Turn a message resource into the MessageSummary the store and the inbox
+    view use.
+    """
+    sender = subject = date = None
+    # One pass over the headers, stopping once all three have been seen
+    for header in msg.get('payload', {}).get('headers', ()):
+        name = header['name'].lower()
+        if name == 'from':
+            if sender is None:
+                sender = header['value']
+        elif name == 'subject':
+            if subject is None:
+                subject = header['value']
+        elif name == 'date':
+            if date is None:
+                date = header['value']
+        else:
+            continue
+        if sender is not None and subject is not None and date is not None:
+            break
+    if 'internalDate' in msg:
+        timestamp = int(msg['internalDate']) // 1000
+    else:
+        try:
+            timestamp = int(email.utils.parsedate_to_datetime(date).timestamp())
+        except (TypeError, ValueError):
+            timestamp = 0
+    return MessageSummary(
+        msg['id'], msg.get('threadId'), msg.get('historyId'),
+        # A few senders account for most of a mailbox, so share one copy of each
+        sys.intern(sender) if sender is not None else 'Unknown Sender',
+        subject if subject is not None else 'No Subject',
+        timestamp, label_mask(msg.get('labelIds', ())), msg.get('sizeEstimate', 0), msg.get('snippet', ''),
+    )
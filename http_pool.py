@@ -0,0 +1,136 @@
+"""
+A bounded pool of authorized HTTP clients shared by every thread that talks
+to Gmail.
+
+httplib2 clients are not thread-safe, so each thread used to get a private
+one, and every new thread (each bulk send starts its own) opened new TLS
+connections. HttpPool lends out clients one request at a time and keeps
+their connections alive in between, so any thread reuses a warm
+connection. No more than `size` requests are in flight at once, and when
+all clients are busy the next free one goes to the waiting request with
+the highest quota.scheduler priority. All clients share one
+SharedCredentials, so an expired token is refreshed once, not once per
+thread.
+
+HttpPool can be given to googleapiclient anywhere it takes an
+httplib2.Http, including batch requests and resumable uploads.
+"""
+import threading
+import time
+
+import google.auth.credentials
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.http import build_http
+
+from metrics import recorder
+from quota import PRIORITY_NAMES, scheduler
+
+# Gmail throttles a user's concurrent requests well before this
+POOL_SIZE = 10
+
+
+class SharedCredentials(google.auth.credentials.Credentials):
+    """
+    Credentials that can be used from many threads at once.
+
+    Refreshes are serialized: when several threads find the token expired,
+    or get 401s, at the same moment, the first refreshes it and the others
+    use the new token. Anything else is read from the wrapped credentials.
+    """
+
+    def __init__(self, credentials):
+        super().__init__()
+        self.credentials = credentials
+        self._lock = threading.Lock()
+        self.token = credentials.token
+        self.expiry = credentials.expiry
+
+    def __getattr__(self, name):
+        # Only called for attributes not found here, e.g. refresh_token and scopes
+        return getattr(self.__dict__['credentials'], name)
+
+    def refresh(self, request):
+        token = self.token
+        with self._lock:
+            if self.token != token and self.valid:
+                # Another thread refreshed it while this one waited
+                return
+            self.credentials.refresh(request)
+            self.token = self.credentials.token
+            self.expiry = self.credentials.expiry
+
+    def before_request(self, request, method, url, headers):
+        if not self.valid:
+            self.refresh(request)
+        self.apply(headers)
+
+    def apply(self, headers, token=None):
+        self.credentials.apply(headers, token=token or self.token)
+
+
+class HttpPool:
+    """
+    Lends out up to `size` AuthorizedHttp clients, each keeping its own
+    connections open between requests. Behaves like an httplib2.Http:
+    `request()` runs on a client from the pool, waiting for one when all
+    are busy.
+    """
+
+    def __init__(self, credentials, size=POOL_SIZE):
+        if not isinstance(credentials, SharedCredentials):
+            credentials = SharedCredentials(credentials)
+        self.credentials = credentials
+        self.size = size
+        self.created = 0
+        self._idle = []
+        self._available = threading.Condition()
+        # Requests waiting for a client, by priority
+        self._waiting = dict.fromkeys(PRIORITY_NAMES, 0)
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=httplib2.DEFAULT_MAX_REDIRECTS,
+                connection_type=None):
+        http = self._checkout()
+        try:
+            return http.request(uri, method, body=body, headers=headers, redirections=redirections,
+                                connection_type=connection_type)
+        finally:
+            self._checkin(http)
+
+    def close(self):
+        """
+        Close the idle clients' connections. Clients reconnect when next used.
+        """
+        with self._available:
+            for http in self._idle:
+                http.close()
+
+    def _checkout(self):
+        with self._available:
+            if self._idle:
+                # The most recently used client is the likeliest to still be connected
+                return self._idle.pop()
+            if self.created < self.size:
+                self.created += 1
+                # build_http leaves 308 alone, which resumable uploads rely on
+                return AuthorizedHttp(self.credentials, http=build_http())
+            start = time.perf_counter()
+            priority = scheduler.current_priority()
+            self._waiting[priority] += 1
+            try:
+                # Requests of a higher priority get the next free client first
+                while not self._idle or any(self._waiting[other] for other in self._waiting if other < priority):
+                    self._available.wait()
+            finally:
+                self._waiting[priority] -= 1
+                # Lower priorities may have been waiting on this request, not for a client
+                if self._idle:
+                    self._available.notify_all()
+            recorder.observe_phase('http_pool_wait', time.perf_counter() - start)
+            return self._idle.pop()
+
+    def _checkin(self, http):
+        with self._available:
+            self._idle.append(http)
+            # Every waiter checks whether it is next
+            self._available.notify_all()
@@ -0,0 +1,318 @@
+"""
+Windowed rendering of a mailbox label into a ttk.Treeview.
+
+The rows live in the MessageStore; the widget only ever holds a bounded
+window of them, which slides as the user scrolls. When the window reaches
+the end of what is stored locally, the next page is requested from Gmail.
+
+In threaded mode each row is a conversation, shown by its newest message,
+and expanding it lists the thread's messages from the store.
+"""
+import math
+import tkinter as tk
+
+# Fraction of the scroll range from either end that triggers loading more rows
+SCROLL_THRESHOLD = 0.1
+
+# Thread rows are keyed apart from message rows: a thread's id is also its first message's id
+THREAD_PREFIX = 'thread:'
+
+
+class InboxView:
+    """
+    Keeps at most `window_size` rows of `label` materialized in `tree`.
+
+    `on_need_more` is called when the user scrolls to the end of the stored
+    rows; the owner should fetch the next page into the store and then call
+    `extend()`. `on_window_change` is called with (first, last, total) row
+    numbers whenever the materialized window changes, and `on_viewport_change`
+    whenever the visible rows may have changed. Rows are keyed by message id,
+    or by THREAD_PREFIX and the thread id in threaded mode; `message_id()`
+    maps a row to the message it opens.
+    """
+
+    def __init__(self, tree, scrollbar, store, label='INBOX', window_size=300,
+                 on_need_more=None, on_window_change=None, on_viewport_change=None):
+        self.tree = tree
+        self.scrollbar = scrollbar
+        self.store = store
+        self.label = label
+        self.window_size = window_size
+        self.on_need_more = on_need_more
+        self.on_window_change = on_window_change
+        self.on_viewport_change = on_viewport_change
+        self.offset = 0
+        # Text being searched for; None shows the label itself
+        self.query = None
+        self._adjusting = False
+        self.threaded = False
+        # Values currently shown per row, so diffs need no round trip to Tk
+        self._values = {}
+        # Thread row -> its newest message id, or None when it holds several
+        self._thread_messages = {}
+        self.tree.configure(yscrollcommand=self._on_scroll)
+        self.tree.bind('<<TreeviewOpen>>', self._on_open, add=True)
+
+    def reload(self):
+        """
+        Re-read the current window from the store and apply only the changes.
+        """
+        self._render(self.offset)
+
+    def reset(self):
+        """
+        Jump back to the newest messages.
+        """
+        self._render(0)
+        self.tree.yview_moveto(0)
+
+    def set_threaded(self, threaded):
+        """
+        Switch between one row per message and one row per thread.
+        """
+        if threaded == self.threaded:
+            return
+        self.threaded = threaded
+        self.tree.configure(show=('tree', 'headings') if threaded else 'headings')
+        self.tree.column('#0', width=40 if threaded else 0, stretch=False)
+        self._delete(list(self.tree.get_children()))
+        self.reset()
+
+    def message_id(self, item):
+        """
+        The message a row stands for: the row itself for a message, the only
+        message of a single-message thread, and None for a longer thread.
+        """
+        if item.startswith(THREAD_PREFIX):
+            return self._thread_messages.get(item)
+        if self.tree.tag_has('placeholder', item):
+            return None
+        return item
+
+    def message_ids(self, items):
+        """
+        The messages the given rows stand for; a thread row stands for every
+        message of the thread.
+        """
+        message_ids = []
+        for item in items:
+            if item.startswith(THREAD_PREFIX):
+                message_ids += [row[0] for row in self.store.thread_messages(item[len(THREAD_PREFIX):])]
+            elif not self.tree.tag_has('placeholder', item):
+                message_ids.append(item)
+        return list(dict.fromkeys(message_ids))
+
+    def search(self, text):
+        """
+        Show the best matches for `text` from the local search index, or go
+        back to the label when `text` is empty.
+        """
+        self.query = text.strip() or None
+        self._render(0)
+        self.tree.yview_moveto(0)
+
+    def extend(self):
+        """
+        Show rows that were just added to the end of the store.
+        """
+        if self.query:
+            return
+        if len(self.tree.get_children()) < self.window_size:
+            self.reload()
+        else:
+            self._shift(self.window_size // 2)
+
+    def visible_rows(self):
+        """
+        Ids of the rows currently scrolled into view.
+        """
+        children = self.tree.get_children()
+        if not children:
+            return []
+        first, last = self.tree.yview()
+        start = int(float(first) * len(children))
+        end = int(math.ceil(float(last) * len(children)))
+        return list(children[start:end])
+
+    def _render(self, offset):
+        """
+        Bring the widget in line with the window at `offset`.
+
+        Rows are keyed on message id: rows that left the window are deleted,
+        new ones inserted and changed ones updated in place, so selection and
+        scroll position survive and an unchanged refresh costs no widget calls.
+        """
+        if self.query:
+            rows = self.store.search(self.query, limit=self.window_size)
+        elif self.threaded:
+            rows = self._thread_rows(self.store.list_threads(self.label, limit=self.window_size, offset=offset))
+        else:
+            rows = self.store.list_label(self.label, limit=self.window_size, offset=offset)
+        wanted = {row[0] for row in rows}
+        current = list(self.tree.get_children())
+        anchor = self._top_row(current)
+
+        self._adjusting = True
+        try:
+            stale = [message_id for message_id in current if message_id not in wanted]
+            if stale:
+                self._delete(stale)
+                current = [message_id for message_id in current if message_id in wanted]
+
+            for index, (message_id, sender, subject, date) in enumerate(rows):
+                values = (sender, subject, date)
+                if index < len(current) and current[index] == message_id:
+                    if self._values[message_id] != values:
+                        self._update(message_id, values)
+                elif message_id in self._values:
+                    self.tree.move(message_id, '', index)
+                    current.remove(message_id)
+                    current.insert(index, message_id)
+                    if self._values[message_id] != values:
+                        self._update(message_id, values)
+                else:
+                    self._insert(index, message_id, values)
+                    current.insert(index, message_id)
+
+            if anchor in self._values:
+                self.tree.yview_moveto(current.index(anchor) / len(current))
+        finally:
+            self._adjusting = False
+        self.offset = offset
+        self._notify()
+
+    def _top_row(self, children):
+        if not children:
+            return None
+        first, _ = self.tree.yview()
+        return children[min(round(first * len(children)), len(children) - 1)]
+
+    def _thread_rows(self, threads):
+        """
+        Turn store thread rows into (row id, sender, subject, date) rows,
+        remembering which message each thread row opens.
+        """
+        rows = []
+        for thread_id, newest_id, sender, subject, date, size in threads:
+            item = THREAD_PREFIX + thread_id
+            self._thread_messages[item] = newest_id if size == 1 else None
+            rows.append((item, f'{sender} ({size})' if size > 1 else sender, subject, date))
+        return rows
+
+    def _insert(self, index, message_id, values):
+        self.tree.insert('', index, values=values, iid=message_id)
+        self._values[message_id] = values
+        if message_id.startswith(THREAD_PREFIX) and self._thread_messages[message_id] is None:
+            self._collapse(message_id)
+
+    def _update(self, message_id, values):
+        self.tree.item(message_id, values=values)
+        self._values[message_id] = values
+        if message_id.startswith(THREAD_PREFIX):
+            # The thread changed, so its expanded messages may be out of date
+            self.tree.delete(*self.tree.get_children(message_id))
+            self.tree.item(message_id, open=False)
+            if self._thread_messages[message_id] is None:
+                self._collapse(message_id)
+
+    def _collapse(self, item):
+        # A placeholder child gives the row its expand arrow until it is opened
+        self.tree.insert(item, tk.END, values=('', '', ''), tags=('placeholder',))
+
+    def _on_open(self, event):
+        # Threads are filled from the store only when expanded
+        item = self.tree.focus()
+        children = self.tree.get_children(item)
+        if not item.startswith(THREAD_PREFIX) or not children or not self.tree.tag_has('placeholder', children[0]):
+            return
+        self.tree.delete(*children)
+        for message_id, sender, subject, date in self.store.thread_messages(item[len(THREAD_PREFIX):]):
+            if not self.tree.exists(message_id):
+                self.tree.insert(item, tk.END, iid=message_id, values=(sender, subject, date))
+
+    def _delete(self, message_ids):
+        self.tree.delete(*message_ids)
+        for message_id in message_ids:
+            del self._values[message_id]
+            self._thread_messages.pop(message_id, None)
+
+    def _shift(self, delta):
+        """
+        Slide the window by `delta` rows, keeping the visible rows in place.
+        """
+        children = self.tree.get_children()
+        if not children:
+            return False
+        if self.threaded:
+            if delta > 0:
+                rows = self.store.list_threads_older(self.label, children[-1][len(THREAD_PREFIX):], delta)
+            else:
+                rows = self.store.list_threads_newer(self.label, children[0][len(THREAD_PREFIX):], -delta)
+            rows = self._thread_rows(rows)
+        elif delta > 0:
+            rows = self.store.list_label_older(self.label, children[-1], delta)
+        else:
+            rows = self.store.list_label_newer(self.label, children[0], -delta)
+        if not rows:
+            return False
+
+        first, _ = self.tree.yview()
+        top_index = round(first * len(children))
+        overflow = max(len(children) + len(rows) - self.window_size, 0)
+
+        self._adjusting = True
+        try:
+            if delta > 0:
+                # Append older rows at the bottom and drop the same number from the top
+                if overflow:
+                    self._delete(children[:overflow])
+                for message_id, sender, subject, date in rows:
+                    self._insert(tk.END, message_id, (sender, subject, date))
+                self.offset += overflow
+                top_index -= overflow
+            else:
+                if overflow:
+                    self._delete(children[-overflow:])
+                for index, (message_id, sender, subject, date) in enumerate(rows):
+                    self._insert(index, message_id, (sender, subject, date))
+                self.offset = max(self.offset - len(rows), 0)
+                top_index += len(rows)
+            count = len(self.tree.get_children())
+            self.tree.yview_moveto(max(top_index, 0) / count)
+        finally:
+            self._adjusting = False
+        self._notify()
+        return True
+
+    def _on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        if self._adjusting:
+            return
+        children = self.tree.get_children()
+        # Search results are a fixed list; only the label view slides
+        if not self.query and children:
+            if float(last) >= 1 - SCROLL_THRESHOLD:
+                if self._has_older(children[-1]):
+                    self.tree.after_idle(self._shift, self.window_size // 2)
+                elif self.on_need_more:
+                    self.on_need_more()
+            elif float(first) <= SCROLL_THRESHOLD and self.offset > 0:
+                self.tree.after_idle(self._shift, -(self.window_size // 2))
+        if self.on_viewport_change:
+            self.on_viewport_change()
+
+    def _has_older(self, item):
+        if self.threaded:
+            return bool(self.store.list_threads_older(self.label, item[len(THREAD_PREFIX):], 1))
+        return bool(self.store.list_label_older(self.label, item, 1))
+
+    def _notify(self):
+        if self.on_window_change:
+            count = len(self.tree.get_children())
+            if self.query:
+                total = count
+            elif self.threaded:
+                total = self.store.count_threads(self.label)
+            else:
+                total = self.store.count_label(self.label)
+            self.on_window_change(self.offset + 1 if count else 0, self.offset + count, total)
@@ -1,15 +1,30 @@
+import time
+# Taken before the other imports, so startup timings include them
+STARTED = time.perf_counter()
 import tkinter as tk
-from tkinter import ttk, messagebox
-import pickle
+from tkinter import ttk, messagebox, filedialog
 import os.path
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-import base64
-import email
 import emoji
+from message_store import MessageStore
+from mail_sync import (sync_mailbox, sync_threads, fetch_next_page_async, fetch_next_thread_page, has_more_pages,
+                       has_more_threads)
+from inbox_view import InboxView
+from background import BackgroundExecutor
+from body_cache import BodyCache, Prefetcher
+from gmail_fetch import fetch_messages_batched, find_message_by_rfc822_id
+from mime_parts import extract_content
+from attachments import spool_message, save_attachment
+from outbox import Outbox, send_item
+from gmail_auth import SCOPES, load_credentials, refresh_credentials
+from mailbox_ops import (ACTIONS, FULL_SCOPE, BatchError, apply_locally, batch_delete, batch_modify, delete_locally,
+                         roll_back)
+from templates import welcome_template
+from rules import RuleEngine, RuleError, load_rules
+from metrics import recorder
+from quota import BULK, INTERACTIVE, scheduler
+from stats_view import StatsWindow
 
 
 class GmailApp:
@@ -17,12 +32,58 @@ class GmailApp:
         self.root = root
         self.root.title("Gmail Inbox Viewer")
         self.root.geometry("800x600")
-        self.SCOPES = ['https://www.googleapis.com/auth/gmail.readonly', 'https://www.googleapis.com/auth/gmail.send']
-        self.service = None
+        self.SCOPES = SCOPES
+        self.executor = BackgroundExecutor(self.root)
+        self.refresh_task = None
+        self.page_task = None
+        self.page_size = 100
+        # Only download the headers shown in the inbox; set to False to compare with full fetches
+        self.summary_mode = True
+        self.store = MessageStore('messages.db')
+        self.body_cache = BodyCache()
+        self.prefetcher = Prefetcher(self.body_cache, self.fetch_bodies)
+        self.prefetch_job = None
+        self.search_job = None
+        # Outgoing mail is queued on disk first, so nothing is lost if sending fails or the app closes
+        self.outbox = Outbox('outbox.db')
+        self.outbox_job = None
+        self.welcome_template = welcome_template()
+        self.rules = self.load_rules('rules.json')
+        self.stats_window = None
+        self.token_path = 'token.pickle'
+        self.fresh_rows_shown = False
         self.setup_gui()
+        self.inbox.reset()
+        if self.tree.get_children():
+            self.root.after_idle(self.record_startup, 'startup_cached_rows')
+        self.update_outbox()
         self.authenticate()
 
+    def load_rules(self, path):
+        try:
+            rules = load_rules(path)
+        except (OSError, RuleError) as e:
+            messagebox.showerror("Error", f"Failed to load rules: {str(e)}")
+            return None
+        return RuleEngine(rules, self.outbox) if rules else None
+
+    def record_startup(self, phase):
+        seconds = time.perf_counter() - STARTED
+        recorder.observe_phase(phase, seconds)
+        print(f"{phase}: {seconds * 1000:.0f} ms after launch")
+
     def setup_gui(self):
+        search_frame = ttk.Frame(self.root, padding=(10, 10, 10, 0))
+        search_frame.pack(fill=tk.X)
+        ttk.Label(search_frame, text="Search:").pack(side=tk.LEFT)
+        self.search_var = tk.StringVar()
+        self.search_var.trace_add('write', lambda *args: self.schedule_search())
+        search_entry = ttk.Entry(search_frame, textvariable=self.search_var)
+        search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        search_entry.bind('<Escape>', lambda event: self.search_var.set(""))
+        self.threaded_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(search_frame, text="Conversations", variable=self.threaded_var,
+                        command=self.toggle_threads).pack(side=tk.LEFT)
         self.main_frame = ttk.Frame(self.root, padding="10")
         self.main_frame.pack(fill=tk.BOTH, expand=True)
         self.tree = ttk.Treeview(self.main_frame, columns=('From', 'Subject', 'Date'), show='headings')
@@ -33,113 +94,355 @@ class GmailApp:
         self.tree.column('Subject', width=400)
         self.tree.column('Date', width=150)
         scrollbar = ttk.Scrollbar(self.main_frame, orient=tk.VERTICAL, command=self.tree.yview)
-        self.tree.configure(yscrollcommand=scrollbar.set)
+        self.inbox = InboxView(self.tree, scrollbar, self.store, on_need_more=self.load_more,
+                               on_window_change=self.update_range, on_viewport_change=self.schedule_prefetch)
         self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         refresh_btn = ttk.Button(self.root, text="Refresh", command=self.fetch_emails)
         refresh_btn.pack(pady=5)
         send_btn = ttk.Button(self.root, text="Send Email", command=self.compose_email)
         send_btn.pack(pady=5)
+        stats_btn = ttk.Button(self.root, text="Stats", command=self.show_stats)
+        stats_btn.pack(pady=5)
         self.tree.bind('<Double-1>', self.show_email_content)
+        self.tree.bind('<<TreeviewSelect>>', lambda event: self.schedule_prefetch())
+        self.actions_menu = tk.Menu(self.root, tearoff=0)
+        for name in ACTIONS:
+            self.actions_menu.add_command(label=name, command=lambda name=name: self.run_action(name))
+        self.actions_menu.add_separator()
+        self.actions_menu.add_command(label="Delete forever", command=self.delete_forever)
+        self.tree.bind('<Button-3>', self.show_actions_menu)
+        self.tree.bind('<Delete>', lambda event: self.run_action("Trash"))
+        status_frame = ttk.Frame(self.root)
+        status_frame.pack(fill=tk.X, padx=10, pady=5)
+        self.range_label = ttk.Label(status_frame, text="")
+        self.range_label.pack(side=tk.LEFT)
+        self.status_label = ttk.Label(status_frame, text="")
+        self.status_label.pack(side=tk.LEFT, padx=10)
+        self.outbox_label = ttk.Label(status_frame, text="")
+        self.outbox_label.pack(side=tk.LEFT, padx=10)
+        self.cancel_btn = ttk.Button(status_frame, text="Cancel", command=self.executor.cancel_all, state=tk.DISABLED)
+        self.cancel_btn.pack(side=tk.RIGHT)
+        self.progress = ttk.Progressbar(status_frame, mode='indeterminate', length=150)
+        self.progress.pack(side=tk.RIGHT, padx=5)
+        self.executor.on_activity = self.update_activity
 
     def authenticate(self):
-        creds = None
-        if os.path.exists('token.pickle'):
-            with open('token.pickle', 'rb') as token:
-                creds = pickle.load(token)
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file('cred1.json', self.SCOPES)
-                creds = flow.run_local_server(port=0)
-                self.service = build('gmail', 'v1', credentials=creds)
-                profile = self.service.users().getProfile(userId='me').execute()
-                user_email = profile['emailAddress']
-                self.send_welcome_email(user_email)
-            with open('token.pickle', 'wb') as token:
-                pickle.dump(creds, token)
-        self.service = build('gmail', 'v1', credentials=creds)
+        self.executor.submit(self.load_credentials, on_success=self.on_authenticated,
+                             on_error=lambda e: messagebox.showerror("Error", f"Failed to authenticate: {str(e)}"))
+
+    def load_credentials(self):
+        # Runs on a worker thread
+        creds, new_login = load_credentials(self.token_path, 'cred1.json', self.SCOPES)
+        self.executor.set_credentials(creds)
+        user_email = None
+        if new_login:
+            profile = self.executor.service().users().getProfile(userId='me', fields='emailAddress').execute()
+            user_email = profile['emailAddress']
+        return user_email
+
+    def on_authenticated(self, user_email):
+        if user_email:
+            self.send_welcome_email(user_email)
+        # Resume sending anything left in the outbox by the last session
+        self.drain_outbox()
         self.fetch_emails()
+        self.refresh_token()
+
+    def refresh_token(self):
+        # Renew the access token on a worker shortly before it expires, then schedule the next renewal
+        self.executor.submit(refresh_credentials, self.executor.credentials, self.token_path,
+                             on_success=self.schedule_token_refresh,
+                             on_error=lambda e: (print(f"Token refresh failed: {e}"), self.schedule_token_refresh(60)))
+
+    def schedule_token_refresh(self, delay):
+        if delay is not None:
+            self.root.after(int(delay * 1000), self.refresh_token)
+
+    def update_activity(self, pending):
+        if pending:
+            self.progress.start(10)
+            self.status_label.config(text=f"Working... ({pending} pending)")
+            self.cancel_btn.config(state=tk.NORMAL)
+        else:
+            self.progress.stop()
+            self.status_label.config(text="")
+            self.cancel_btn.config(state=tk.DISABLED)
+
+    def send_item(self, item):
+        # Runs on a worker thread; messages are uploaded as they are, without a base64 copy
+        return send_item(self.executor.service(), item)
+
+    def find_sent(self, rfc822_id):
+        # Runs on a worker thread
+        return find_message_by_rfc822_id(self.executor.service(), rfc822_id)
+
+    def queue_message(self, message):
+        self.outbox.enqueue(message)
+        self.update_outbox()
+        self.drain_outbox()
+
+    def drain_outbox(self):
+        if self.outbox_job is not None:
+            self.root.after_cancel(self.outbox_job)
+            self.outbox_job = None
+        if self.executor.credentials is None:
+            return
+        self.executor.submit(lambda: self.outbox.drain(self.send_item, self.find_sent),
+                             on_success=self.show_sent, on_error=lambda e: print(f"Outbox drain failed: {e}"))
+
+    def show_sent(self, results):
+        sent = [item for item, error in results if error is None]
+        for item, error in results:
+            if error is not None:
+                print(f"Failed to send email to {item.recipient}: {error}")
+                if self.outbox.status(item.id) == 'failed':
+                    messagebox.showerror("Error", f"Failed to send email to {item.recipient}: {str(error)}")
+        if len(sent) == 1:
+            messagebox.showinfo("Success", f"Email sent successfully to {sent[0].recipient}")
+        elif sent:
+            messagebox.showinfo("Success", f"{len(sent)} emails sent successfully")
+        self.update_outbox()
+        # Come back when the next retry is due
+        delay = self.outbox.next_retry_delay()
+        if delay is not None and self.outbox_job is None:
+            self.outbox_job = self.root.after(int(delay * 1000) + 100, self.drain_outbox)
+
+    def update_outbox(self):
+        counts = self.outbox.counts()
+        queued = counts.get('pending', 0) + counts.get('sending', 0)
+        self.outbox_label.config(text=f"Outbox: {queued} queued" if queued else "")
 
     def send_welcome_email(self, user_email):
         try:
-            message = MIMEMultipart()
-            message['to'] = user_email
-            message['from'] = user_email
-            message['subject'] = 'Welcome to Our Platform!'
-            html_content = """
-            <html>
-              <body>
-                <h2>Welcome to Our Platform!</h2>
-                <p>Dear User,</p>
-                <p>Thank you for signing up! We're excited to have you on board.</p>
-                <p>Here are a few things you can do to get started:</p>
-                <ul>
-                  <li>Complete your profile</li>
-                  <li>Explore our features</li>
-                  <li>Connect with other users</li>
-                </ul>
-                <p>If you have any questions, feel free to reach out to our support team.</p>
-                <p>Best regards,<br>Vaishvi (231081074) , Zoher (231080077)</p>
-              </body>
-            </html>
-            """
-            mime_text = MIMEText(html_content, 'html')
-            message.attach(mime_text)
-            raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
-            create_message = {'raw': raw_message}
-            self.service.users().messages().send(userId="me", body=create_message).execute()
-            messagebox.showinfo("Success", f"Welcome email sent to {user_email}")
+            self.queue_message(self.welcome_template.render(user_email, {'name': 'User'}))
         except Exception as e:
             messagebox.showerror("Error", f"Failed to send welcome email: {str(e)}")
 
     def fetch_emails(self):
-        for item in self.tree.get_children():
-            self.tree.delete(item)
+        # A newer refresh supersedes one that is still running
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+        self.refresh_task = self.executor.submit(
+            self.load_summaries, self.inbox.threaded, on_success=self.show_summaries,
+            on_error=lambda e: messagebox.showerror("Error", f"Failed to fetch emails: {str(e)}"))
+
+    def load_summaries(self, threaded=False):
+        # Runs on a worker thread
+        with recorder.phase('sync'):
+            if threaded:
+                return sync_threads(self.executor.service(), self.store, max_results=self.page_size,
+                                    summary_mode=self.summary_mode)
+            return sync_mailbox(self.executor.service(), self.store, max_results=self.page_size,
+                                summary_mode=self.summary_mode, rules=self.rules)
+
+    def toggle_threads(self):
+        self.inbox.set_threaded(self.threaded_var.get())
+        if self.executor.credentials is not None:
+            self.fetch_emails()
+
+    def show_summaries(self, stats):
+        print(f"Refreshed ({stats['mode']}): {stats['added']} added, {stats['removed']} removed, "
+              f"{stats['relabelled']} relabelled, {stats['payload_bytes']} payload bytes, {stats['parse_ms']:.1f} ms parse")
+        rules = stats.get('rules')
+        if rules:
+            print(f"Rules: {rules['matched']} matched, {rules['relabelled']} relabelled, "
+                  f"{rules['forwarded']} forwarded, {rules['replied']} replied")
+            if rules['forwarded'] or rules['replied']:
+                self.update_outbox()
+                self.drain_outbox()
+        with recorder.phase('render_inbox'):
+            self.inbox.reload()
+        if not self.fresh_rows_shown:
+            self.fresh_rows_shown = True
+            self.root.after_idle(self.record_startup, 'startup_fresh_rows')
+        if not self.tree.get_children():
+            messagebox.showinfo("No Emails", "No emails found in the inbox.")
+
+    def show_stats(self):
+        if self.stats_window is not None and self.stats_window.window.winfo_exists():
+            self.stats_window.window.lift()
+        else:
+            self.stats_window = StatsWindow(self.root, recorder)
+
+    def schedule_search(self):
+        if self.search_job is not None:
+            self.root.after_cancel(self.search_job)
+        self.search_job = self.root.after(150, self.search_emails)
+
+    def search_emails(self):
+        self.search_job = None
+        self.inbox.search(self.search_var.get())
+
+    def load_more(self):
+        if self.page_task is not None and self.page_task.active:
+            return
+
+        def on_loaded(added):
+            if added:
+                self.inbox.extend()
+
+        if self.inbox.threaded:
+            if has_more_threads(self.store):
+                self.page_task = self.executor.submit(
+                    lambda: fetch_next_thread_page(self.executor.service(), self.store, max_results=self.page_size,
+                                                   summary_mode=self.summary_mode),
+                    on_success=on_loaded, on_error=lambda e: print(f"Failed to load more conversations: {e}"))
+            return
+        if not has_more_pages(self.store):
+            return
+
+        # The page's messages are fetched concurrently on the asyncio loop
+        self.page_task = self.executor.submit_async(
+            lambda: fetch_next_page_async(self.executor.async_client(), self.store, max_results=self.page_size,
+                                          summary_mode=self.summary_mode),
+            on_success=on_loaded, on_error=lambda e: print(f"Failed to load more emails: {e}"))
+
+    def show_actions_menu(self, event):
+        item = self.tree.identify_row(event.y)
+        if item and item not in self.tree.selection():
+            self.tree.selection_set(item)
+        self.actions_menu.tk_popup(event.x_root, event.y_root)
+
+    def run_action(self, name):
+        message_ids = self.inbox.message_ids(self.tree.selection())
+        if not message_ids or self.executor.credentials is None:
+            return
+        add_labels, remove_labels = ACTIONS[name]
+        # Shown straight away, and undone for whatever Gmail does not accept
+        previous = apply_locally(self.store, message_ids, add_labels, remove_labels)
+        self.inbox.reload()
+        self.executor.submit(
+            lambda: batch_modify(self.executor.service(), message_ids, add_labels, remove_labels),
+            on_success=lambda count: print(f"{name}: {count} messages"),
+            on_error=lambda e: self.action_failed(name, previous, e))
+
+    def delete_forever(self):
+        message_ids = self.inbox.message_ids(self.tree.selection())
+        if not message_ids or self.executor.credentials is None:
+            return
+        if not messagebox.askyesno("Delete forever", f"Permanently delete {len(message_ids)} messages? "
+                                                     "This cannot be undone."):
+            return
+        previous = delete_locally(self.store, message_ids)
+        self.inbox.reload()
+
+        def on_error(e):
+            self.action_failed("Delete forever", previous, e)
+
+        def submit_delete():
+            self.executor.submit(self.delete_messages, message_ids,
+                                 on_success=lambda count: print(f"Deleted {count} messages"), on_error=on_error)
+
+        def on_upgraded(creds):
+            # Swapped on the Tk thread, not under the other workers
+            self.executor.set_credentials(creds)
+            submit_delete()
+
+        # Permanent deletion needs full mail access, asked for only now; the login may open a browser
+        if self.executor.credentials.has_scopes([FULL_SCOPE]):
+            submit_delete()
+        else:
+            self.executor.submit(self.load_full_access, on_success=on_upgraded, on_error=on_error)
+
+    def load_full_access(self):
+        # Runs on a worker thread
+        creds, _ = load_credentials(self.token_path, 'cred1.json', self.SCOPES + [FULL_SCOPE])
+        return creds
+
+    def delete_messages(self, message_ids):
+        # Runs on a worker thread
         try:
-            results = self.service.users().messages().list(userId='me', maxResults=10, labelIds=['INBOX']).execute()
-            messages = results.get('messages', [])
-            if not messages:
-                messagebox.showinfo("No Emails", "No emails found in the inbox.")
-            for message in messages:
-                msg = self.service.users().messages().get(userId='me', id=message['id'], format='full').execute()
-                headers = msg['payload']['headers']
-                subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), 'No Subject')
-                sender = next((h['value'] for h in headers if h['name'].lower() == 'from'), 'Unknown Sender')
-                date = next((h['value'] for h in headers if h['name'].lower() == 'date'), 'No Date')
-                parsed_date = email.utils.parsedate_to_datetime(date)
-                formatted_date = parsed_date.strftime('%Y-%m-%d %H:%M')
-                self.tree.insert('', tk.END, values=(sender, subject, formatted_date), iid=message['id'])
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to fetch emails: {str(e)}")
+            count = batch_delete(self.executor.service(), message_ids)
+        except BatchError as e:
+            self.store.delete(e.done)
+            raise
+        self.store.delete(message_ids)
+        return count
+
+    def action_failed(self, name, previous, error):
+        roll_back(self.store, previous, error)
+        self.inbox.reload()
+        messagebox.showerror("Error", f"{name} failed: {str(error)}")
+
+    def update_range(self, first, last, total):
+        self.range_label.config(text=f"Showing {first}-{last} of {total}" if total else "")
 
     def show_email_content(self, event):
-        item_id = self.tree.selection()[0]
-        try:
-            message = self.service.users().messages().get(userId='me', id=item_id, format='full').execute()
-            if 'parts' in message['payload']:
-                parts = message['payload']['parts']
-                body = ''
-                for part in parts:
-                    if part['mimeType'] == 'text/plain':
-                        if 'data' in part['body']:
-                            body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='replace')
-                            break
-            else:
-                if 'data' in message['payload']['body']:
-                    body = base64.urlsafe_b64decode(message['payload']['body']['data']).decode('utf-8', errors='replace')
-                else:
-                    body = "No text content available"
-            content_window = tk.Toplevel(self.root)
-            content_window.title("Email Content")
-            content_window.geometry("600x400")
-            text_widget = tk.Text(content_window, wrap=tk.WORD, padx=10, pady=10)
-            text_widget.pack(fill=tk.BOTH, expand=True)
-            text_widget.insert(tk.END, body)
-            text_widget.config(state=tk.DISABLED)
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to fetch email content: {str(e)}")
+        # A conversation row expands instead
+        item_id = self.inbox.message_id(self.tree.selection()[0])
+        if item_id is None:
+            return
+        content = self.body_cache.get(item_id)
+        if content is not None:
+            self.open_content_window(content)
+            return
+        self.executor.submit(
+            self.load_email_body, item_id, on_success=self.open_content_window,
+            on_error=lambda e: messagebox.showerror("Error", f"Failed to fetch email content: {str(e)}"),
+            priority=INTERACTIVE)
+
+    def load_email_body(self, item_id):
+        # Runs on a worker thread
+        message = self.executor.service().users().messages().get(userId='me', id=item_id, format='full').execute()
+        with recorder.phase('extract_body'):
+            content = extract_content(message)
+        self.body_cache.put(item_id, content)
+        self.store.index_body(item_id, content.body)
+        return content
+
+    def schedule_prefetch(self):
+        # Wait for scrolling or cursor movement to settle before prefetching
+        if self.prefetch_job is not None:
+            self.root.after_cancel(self.prefetch_job)
+        self.prefetch_job = self.root.after(200, self.prefetch_bodies)
+
+    def prefetch_bodies(self):
+        self.prefetch_job = None
+        if self.executor.credentials is None:
+            return
+        wanted = []
+        for item in self.tree.selection():
+            wanted += [item, self.tree.next(item), self.tree.prev(item)]
+        wanted += self.inbox.visible_rows()
+        wanted = [self.inbox.message_id(item) for item in wanted if item]
+        self.prefetcher.request([message_id for message_id in wanted if message_id])
+
+    def fetch_bodies(self, message_ids):
+        # Runs on the prefetch thread, behind everything else in the Gmail quota
+        with scheduler.priority(BULK):
+            fetched, _ = fetch_messages_batched(self.executor.service(), message_ids, format='full')
+        contents = {message_id: extract_content(message) for message_id, message in fetched.items()}
+        self.store.index_bodies({message_id: content.body for message_id, content in contents.items()})
+        return contents
+
+    def open_content_window(self, content):
+        content_window = tk.Toplevel(self.root)
+        content_window.title("Email Content")
+        content_window.geometry("600x400")
+        if content.attachments:
+            attachment_frame = ttk.Frame(content_window, padding=(10, 5))
+            attachment_frame.pack(side=tk.BOTTOM, fill=tk.X)
+            ttk.Label(attachment_frame, text="Attachments:").pack(side=tk.LEFT)
+            for attachment in content.attachments:
+                ttk.Button(attachment_frame, text=f"{attachment.filename} ({attachment.size // 1024} KB)",
+                           command=lambda a=attachment: self.download_attachment(a)).pack(side=tk.LEFT, padx=2)
+        text_widget = tk.Text(content_window, wrap=tk.WORD, padx=10, pady=10)
+        text_widget.pack(fill=tk.BOTH, expand=True)
+        with recorder.phase('render_email'):
+            text_widget.insert(tk.END, content.body)
+        text_widget.config(state=tk.DISABLED)
+
+    def download_attachment(self, attachment):
+        path = filedialog.asksaveasfilename(initialfile=attachment.filename)
+        if not path:
+            return
+        # Streamed to disk on a worker thread, so large files never sit in memory decoded
+        self.executor.submit(
+            lambda: save_attachment(self.executor.service(), attachment, path, self.executor.credentials),
+            on_success=lambda size: messagebox.showinfo("Saved", f"Saved {attachment.filename} ({size} bytes)"),
+            on_error=lambda e: messagebox.showerror("Error", f"Failed to save attachment: {str(e)}"),
+            priority=INTERACTIVE)
 
     def compose_email(self):
         compose_window = tk.Toplevel(self.root)
@@ -154,7 +457,16 @@ class GmailApp:
         tk.Label(compose_window, text="Body:").pack(pady=5)
         body_text = tk.Text(compose_window, width=50, height=10)
         body_text.pack(pady=5)
-        send_button = ttk.Button(compose_window, text="Send", command=lambda: self.send_email(to_entry.get(), subject_entry.get(), body_text.get("1.0", tk.END), compose_window))
+        attachments = []
+        attachments_label = tk.Label(compose_window, text="", wraplength=350)
+
+        def add_attachments():
+            attachments.extend(filedialog.askopenfilenames(parent=compose_window))
+            attachments_label.config(text=", ".join(os.path.basename(path) for path in attachments))
+
+        ttk.Button(compose_window, text="Attach Files", command=add_attachments).pack(pady=5)
+        attachments_label.pack(pady=5)
+        send_button = ttk.Button(compose_window, text="Send", command=lambda: self.send_email(to_entry.get(), subject_entry.get(), body_text.get("1.0", tk.END), compose_window, attachments))
         send_button.pack(pady=10)
        
         emoji_button = ttk.Button(compose_window, text= emoji.emojize(':thumbs_up:'), command=lambda: self.add_emoji(body_text))
@@ -173,17 +485,23 @@ class GmailApp:
     def add_emoji_heart(self, body_text):
         body_text.insert(tk.END, emoji.emojize(':red_heart:'))
 
-    def send_email(self, to, subject, body, compose_window):
+    def send_email(self, to, subject, body, compose_window, attachments=()):
         try:
+            if attachments:
+                # Written to disk a chunk at a time on a worker thread instead of built in memory
+                self.executor.submit(
+                    spool_message, self.outbox.spool_dir, to, subject, body, list(attachments),
+                    on_success=self.queue_message,
+                    on_error=lambda e: messagebox.showerror("Error", f"Failed to send email: {str(e)}"))
+                compose_window.destroy()
+                return
             message = MIMEMultipart()
             message['to'] = to
             message['subject'] = subject
             msg = MIMEText(body)
             message.attach(msg)
-            raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-            self.service.users().messages().send(userId='me', body={'raw': raw_message}).execute()
+            self.queue_message(message)
             compose_window.destroy()
-            messagebox.showinfo("Success", "Email sent successfully!")
         except Exception as e:
             messagebox.showerror("Error", f"Failed to send email: {str(e)}")
 
@@ -191,4 +509,5 @@ class GmailApp:
 if __name__ == "__main__":
     root = tk.Tk()
     app = GmailApp(root)
+    root.protocol("WM_DELETE_WINDOW", lambda: (app.prefetcher.stop(), app.executor.shutdown(), root.destroy()))
     root.mainloop()
@@ -0,0 +1,64 @@
+"""
+The HttpRequest class Gmail services are built with, reporting every call
+to metrics.recorder, spending its quota units through quota.scheduler and
+sharing identical reads in flight through single_flight.
+
+Kept apart from metrics so that modules recording phases do not have to
+import googleapiclient.http; only building a service loads it.
+"""
+import time
+
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+
+from metrics import recorder
+from quota import scheduler
+from single_flight import flights, raise_if_cancelled
+
+
+class InstrumentedRequest(HttpRequest):
+    """
+    HttpRequest that reports every call to `recorder` and waits for its
+    quota units. Passed to googleapiclient as the service's requestBuilder.
+
+    GETs are shared with identical ones already in flight on the same
+    connections, and raise single_flight.Cancelled instead of starting
+    once the work making them has been cancelled.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._postproc = self.postproc
+        self.postproc = self._measure_response
+
+    def _measure_response(self, resp, content):
+        # Also called for each response inside a batch
+        recorder.record_received(self.methodId, len(content or b''))
+        return self._postproc(resp, content)
+
+    def execute(self, http=None, num_retries=0):
+        if self.method != 'GET' or self.resumable is not None:
+            return self._execute(http, num_retries)
+        raise_if_cancelled()
+        # The URI holds everything asked for; the connections tell accounts apart
+        key = (self.methodId, self.uri, id(http or self.http))
+        return flights.do(key, lambda: self._execute(http, num_retries), self.methodId)
+
+    def _execute(self, http, num_retries):
+        # Waits for the call's quota units, and backs off on rate limits
+        with scheduler.call(self.methodId):
+            if not recorder.enabled:
+                return super().execute(http=http, num_retries=num_retries)
+            status = 200
+            start = time.perf_counter()
+            try:
+                return super().execute(http=http, num_retries=num_retries)
+            except HttpError as e:
+                status = e.resp.status
+                raise
+            except Exception:
+                status = 'network_error'
+                raise
+            finally:
+                sent = self.resumable.size() if self.resumable is not None else len(self.body or b'')
+                recorder.record_call(self.methodId, time.perf_counter() - start, status, sent or 0)
@@ -0,0 +1,333 @@
+"""
+Keep a MessageStore in step with Gmail using the mailbox history, so a
+refresh only downloads what changed since the last one.
+"""
+import asyncio
+import json
+import time
+
+from gmail_fetch import (RETRYABLE_STATUSES, list_message_ids, list_thread_ids, fetch_summaries,
+                         fetch_thread_summaries, fetch_threads_batched, parse_summary, payload_size)
+from metrics import recorder
+from single_flight import shielded
+
+HISTORY_FIELDS = (
+    'history(messagesAdded/message(id,labelIds),messagesDeleted/message/id,'
+    'labelsAdded(message/id,labelIds),labelsRemoved(message/id,labelIds)),'
+    'historyId,nextPageToken'
+)
+
+# Messages whose fetch failed with a transient error, kept for the next
+# incremental sync to fetch again: a JSON object of id -> newly arrived
+UNFETCHED_KEY = 'unfetched'
+
+
+def transient_errors(errors):
+    """
+    The ids in a fetch's `errors` that are worth fetching again; the others
+    (a 404 for a message deleted meanwhile, say) never will succeed.
+    """
+    from googleapiclient.errors import HttpError
+
+    return [message_id for message_id, error in errors.items()
+            if isinstance(error, HttpError) and error.resp.status in RETRYABLE_STATUSES]
+
+
+def sync_mailbox(service, store, label='INBOX', max_results=10, summary_mode=True, rules=None):
+    """
+    Bring the store up to date and return a dict of sync stats.
+
+    Starts from the stored historyId when there is one. Gmail only keeps
+    history for a limited time and answers 404 once a historyId is too old,
+    in which case the store is rebuilt from a full listing.
+
+    With a rules.RuleEngine, the rules are run on the messages that arrived
+    since the last sync. A full sync runs no rules, as it cannot tell new
+    mail from old.
+    """
+    from googleapiclient.errors import HttpError
+
+    history_id = store.get_history_id()
+    if history_id:
+        try:
+            return incremental_sync(service, store, history_id, label, summary_mode, rules)
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            print("Mailbox history expired, doing a full resync")
+    return full_sync(service, store, label, max_results, summary_mode)
+
+
+def full_sync(service, store, label='INBOX', max_results=10, summary_mode=True):
+    """
+    Replace the store with the newest `max_results` messages in `label`.
+    """
+    message_ids, next_page_token = list_message_ids(service, label_ids=[label], max_results=max_results)
+    fetched, errors = fetch_summaries(service, message_ids, summary_mode=summary_mode)
+    parse_start = time.perf_counter()
+    summaries = [parse_summary(fetched[message_id]) for message_id in message_ids if message_id in fetched]
+    parse_ms = (time.perf_counter() - parse_start) * 1000
+    recorder.observe_phase('parse_summaries', parse_ms / 1000)
+
+    # Record where to continue from: the newest message's historyId, or the
+    # mailbox's current one if the label is empty
+    history_ids = [int(summary.history_id) for summary in summaries if summary.history_id]
+    if history_ids:
+        history_id = max(history_ids)
+    else:
+        history_id = service.users().getProfile(userId='me', fields='historyId').execute()['historyId']
+
+    store.replace(summaries, history_id)
+    # A full listing supersedes any fetches left over from incremental syncs
+    store.set_meta(UNFETCHED_KEY, '')
+    store.set_meta('next_page_token', next_page_token or '')
+    return {'mode': 'full', 'added': len(summaries), 'removed': 0, 'relabelled': 0, 'errors': len(errors),
+            'payload_bytes': payload_size(fetched), 'parse_ms': parse_ms}
+
+
+def has_more_pages(store):
+    """
+    Whether older messages are still waiting to be paged in from Gmail.
+    """
+    return bool(store.get_meta('next_page_token'))
+
+
+def fetch_next_page(service, store, label='INBOX', max_results=100, summary_mode=True):
+    """
+    Page older messages into the store, continuing from the last page token.
+
+    Returns the number of messages added; 0 once the label is exhausted.
+    If some of the page failed to fetch, the page token stays where it was,
+    so the next call fetches the page again.
+    """
+    page_token = store.get_meta('next_page_token')
+    if not page_token:
+        return 0
+    message_ids, next_page_token = list_message_ids(
+        service, label_ids=[label], max_results=max_results, page_token=page_token
+    )
+    fetched, errors = fetch_summaries(service, message_ids, summary_mode=summary_mode)
+    store.upsert(parse_summary(message) for message in fetched.values())
+    if not transient_errors(errors):
+        store.set_meta('next_page_token', next_page_token or '')
+    return len(fetched)
+
+
+async def fetch_next_page_async(gmail, store, label='INBOX', max_results=100, summary_mode=True):
+    """
+    fetch_next_page on an async_gmail.AsyncGmail, fetching the page's
+    messages concurrently instead of in batches.
+    """
+    page_token = store.get_meta('next_page_token')
+    if not page_token:
+        return 0
+    message_ids, next_page_token = await gmail.list_message_ids([label], max_results, page_token)
+    if summary_mode:
+        fetched, errors = await gmail.fetch_summaries(message_ids)
+    else:
+        fetched, errors = await gmail.get_many(message_ids)
+    await asyncio.to_thread(store.upsert, [parse_summary(message) for message in fetched.values()])
+    if not transient_errors(errors):
+        store.set_meta('next_page_token', next_page_token or '')
+    return len(fetched)
+
+
+async def backfill(gmail, store, label='INBOX', page_size=500, max_messages=None, on_page=None):
+    """
+    Page every older message of `label` into the store, or stop after about
+    `max_messages`, with as many summary fetches in flight as `gmail`
+    allows. The next page is listed while the current one is fetched.
+
+    `on_page(stats)` is called after each page is stored. Returns stats
+    like the sync functions. A page that could not be fetched whole (after
+    async_gmail's own retries) ends the backfill there, so the next one
+    starts from that page again.
+    """
+    stats = {'mode': 'backfill', 'added': 0, 'errors': 0, 'pages': 0, 'parse_ms': 0.0}
+    page_token = store.get_meta('next_page_token')
+    if not page_token:
+        return stats
+    listing = asyncio.ensure_future(gmail.list_message_ids([label], page_size, page_token))
+    while listing is not None:
+        message_ids, page_token = await listing
+        done = max_messages is not None and stats['added'] + len(message_ids) >= max_messages
+        listing = None
+        if page_token and not done:
+            listing = asyncio.ensure_future(gmail.list_message_ids([label], page_size, page_token))
+        try:
+            fetched, errors = await gmail.fetch_summaries(message_ids)
+        except BaseException:
+            if listing is not None:
+                listing.cancel()
+            raise
+        parse_start = time.perf_counter()
+        summaries = [parse_summary(message) for message in fetched.values()]
+        parse_seconds = time.perf_counter() - parse_start
+        recorder.observe_phase('parse_summaries', parse_seconds)
+        await asyncio.to_thread(store.upsert, summaries)
+        stats['added'] += len(summaries)
+        stats['errors'] += len(errors)
+        stats['pages'] += 1
+        stats['parse_ms'] += parse_seconds * 1000
+        if transient_errors(errors):
+            if listing is not None:
+                listing.cancel()
+            if on_page:
+                on_page(stats)
+            break
+        # Only move on once the page is stored, so an interrupted backfill resumes from it
+        store.set_meta('next_page_token', page_token or '')
+        if on_page:
+            on_page(stats)
+    return stats
+
+
+def sync_threads(service, store, label='INBOX', max_results=10, summary_mode=True):
+    """
+    Bring the newest `max_results` threads in `label` up to date.
+
+    Threads whose historyId has not moved since they were stored are
+    assembled from the store; the others are fetched whole, one call per
+    thread rather than one per message.
+    """
+    threads, next_page_token = list_thread_ids(service, label_ids=[label], max_results=max_results)
+    stats = store_threads(service, store, threads, summary_mode)
+    # Paging continues from where it got to, not from the first page again
+    if store.get_meta('next_thread_page_token') is None:
+        store.set_meta('next_thread_page_token', next_page_token or '')
+    return stats
+
+
+def has_more_threads(store):
+    """
+    Whether older threads are still waiting to be paged in from Gmail.
+    """
+    return store.get_meta('next_thread_page_token') != ''
+
+
+def fetch_next_thread_page(service, store, label='INBOX', max_results=100, summary_mode=True):
+    """
+    Page older threads into the store. Returns the number of threads listed;
+    0 once the label is exhausted.
+    """
+    page_token = store.get_meta('next_thread_page_token')
+    if page_token == '':
+        return 0
+    threads, next_page_token = list_thread_ids(service, label_ids=[label], max_results=max_results,
+                                               page_token=page_token)
+    store_threads(service, store, threads, summary_mode)
+    store.set_meta('next_thread_page_token', next_page_token or '')
+    return len(threads)
+
+
+def store_threads(service, store, threads, summary_mode=True):
+    """
+    Fetch the listed (thread id, history id) threads the store does not have
+    at that history id, and store them.
+    """
+    known = store.thread_history_ids(thread_id for thread_id, _ in threads)
+    stale = [thread_id for thread_id, history_id in threads if known.get(thread_id) != str(history_id)]
+    fetched, errors = {}, {}
+    if stale and summary_mode:
+        fetched, errors = fetch_thread_summaries(service, stale)
+    elif stale:
+        fetched, errors = fetch_threads_batched(service, stale, format='full')
+    parse_start = time.perf_counter()
+    parsed = [(thread_id, thread['historyId'], [parse_summary(message) for message in thread.get('messages', [])])
+              for thread_id, thread in fetched.items()]
+    parse_ms = (time.perf_counter() - parse_start) * 1000
+    recorder.observe_phase('parse_summaries', parse_ms / 1000)
+    store.upsert_threads(parsed)
+    return {'mode': 'threads', 'added': sum(len(summaries) for _, _, summaries in parsed), 'removed': 0,
+            'relabelled': 0, 'errors': len(errors), 'threads': len(threads), 'threads_fetched': len(fetched),
+            'payload_bytes': payload_size(fetched), 'parse_ms': parse_ms}
+
+
+def incremental_sync(service, store, history_id, label='INBOX', summary_mode=True, rules=None):
+    """
+    Apply every change recorded since `history_id` to the store.
+
+    Messages that fail to fetch with a transient error are kept in the
+    store's meta and fetched again, and have their rules run, by the next
+    incremental sync.
+    """
+    unfetched = json.loads(store.get_meta(UNFETCHED_KEY) or '{}')
+    added = set(unfetched)
+    # Newly delivered, rather than moved into the label
+    arrived = {message_id for message_id, new in unfetched.items() if new}
+    removed = set()
+    label_changes = []
+    latest_history_id = history_id
+    page_token = None
+
+    while True:
+        kwargs = {'userId': 'me', 'startHistoryId': history_id, 'fields': HISTORY_FIELDS}
+        if page_token:
+            kwargs['pageToken'] = page_token
+        response = service.users().history().list(**kwargs).execute()
+
+        for record in response.get('history', []):
+            for item in record.get('messagesAdded', []):
+                message = item['message']
+                if label in message.get('labelIds', []):
+                    added.add(message['id'])
+                    arrived.add(message['id'])
+                    removed.discard(message['id'])
+            for item in record.get('messagesDeleted', []):
+                removed.add(item['message']['id'])
+                added.discard(item['message']['id'])
+                arrived.discard(item['message']['id'])
+            for item in record.get('labelsAdded', []):
+                message_id = item['message']['id']
+                if label in item['labelIds'] and not store.contains(message_id):
+                    # Newly moved into the label, so we have no summary for it yet
+                    added.add(message_id)
+                else:
+                    label_changes.append((True, message_id, item['labelIds']))
+            for item in record.get('labelsRemoved', []):
+                label_changes.append((False, item['message']['id'], item['labelIds']))
+
+        latest_history_id = response.get('historyId', latest_history_id)
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            break
+
+    fetched, errors = {}, {}
+    parse_ms = 0.0
+    if added:
+        # Rules need a few more headers than the inbox view
+        extra = {'headers': rules.headers, 'fields': rules.fields} if rules is not None else {}
+        fetched, errors = fetch_summaries(service, list(added), summary_mode=summary_mode, **extra)
+        parse_start = time.perf_counter()
+        summaries = [parse_summary(message) for message in fetched.values()]
+        parse_ms = (time.perf_counter() - parse_start) * 1000
+        recorder.observe_phase('parse_summaries', parse_ms / 1000)
+        store.upsert(summaries)
+
+    # Added messages already carry their current labels
+    relabelled = 0
+    for is_add, message_id, labels in label_changes:
+        if message_id in added or message_id in removed:
+            continue
+        if is_add:
+            store.add_labels(message_id, labels)
+        else:
+            store.remove_labels(message_id, labels)
+        relabelled += 1
+
+    if removed:
+        store.delete(removed)
+    store.set_meta(UNFETCHED_KEY, json.dumps({message_id: message_id in arrived
+                                               for message_id in transient_errors(errors)}))
+    store.set_history_id(latest_history_id)
+    stats = {'mode': 'incremental', 'added': len(added), 'removed': len(removed),
+             'relabelled': relabelled, 'errors': len(errors),
+             'payload_bytes': payload_size(fetched), 'parse_ms': parse_ms}
+    # Only once the history is recorded, so no message is acted on twice,
+    # and all the way through even if the refresh is cancelled meanwhile,
+    # as these messages will not come up again
+    if rules is not None and arrived:
+        with recorder.phase('rules'), shielded():
+            stats['rules'] = rules.run(service, store, [fetched[message_id] for message_id in fetched
+                                                        if message_id in arrived])
+    return stats
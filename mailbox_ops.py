@@ -0,0 +1,106 @@
+"""
+Actions on many messages at once: marking read or unread, starring,
+archiving, trashing and deleting.
+
+Gmail's batchModify and batchDelete take up to 1000 message ids per call,
+so acting on thousands of selected messages takes a handful of requests
+rather than one per message. The apps apply an action to the local store
+first, so the inbox updates at once, and put the old labels back for the
+messages Gmail did not accept.
+"""
+from bulk_send import send_with_retries
+from gmail_fetch import chunked
+from metrics import BATCH_DELETE, BATCH_MODIFY
+
+# Most message ids batchModify and batchDelete accept in one call
+MAX_IDS = 1000
+
+# Only needed, and only asked for, to delete messages permanently
+FULL_SCOPE = 'https://mail.google.com/'
+
+# Action name -> (labels added, labels removed)
+ACTIONS = {
+    "Mark as read": ((), ('UNREAD',)),
+    "Mark as unread": (('UNREAD',), ()),
+    "Star": (('STARRED',), ()),
+    "Unstar": ((), ('STARRED',)),
+    "Archive": ((), ('INBOX',)),
+    "Move to inbox": (('INBOX',), ()),
+    "Trash": (('TRASH',), ('INBOX',)),
+}
+
+
+class BatchError(Exception):
+    """
+    A batch operation failed part way. `done` holds the ids Gmail had
+    already applied it to.
+    """
+
+    def __init__(self, error, done):
+        super().__init__(str(error))
+        self.error = error
+        self.done = done
+
+
+def batch_modify(service, message_ids, add_labels=(), remove_labels=(), chunk_size=MAX_IDS):
+    """
+    Add and remove labels on the given messages, `chunk_size` per request.
+    Returns the number of messages changed; raises BatchError on failure.
+    """
+    body = {}
+    if add_labels:
+        body['addLabelIds'] = list(add_labels)
+    if remove_labels:
+        body['removeLabelIds'] = list(remove_labels)
+    messages = service.users().messages()
+    return _run_chunked(lambda ids: messages.batchModify(userId='me', body={**body, 'ids': ids}).execute(),
+                        message_ids, chunk_size, BATCH_MODIFY)
+
+
+def batch_delete(service, message_ids, chunk_size=MAX_IDS):
+    """
+    Permanently delete the given messages. Needs FULL_SCOPE.
+    """
+    messages = service.users().messages()
+    return _run_chunked(lambda ids: messages.batchDelete(userId='me', body={'ids': ids}).execute(),
+                        message_ids, chunk_size, BATCH_DELETE)
+
+
+def _run_chunked(call, message_ids, chunk_size, method):
+    done = []
+    for chunk in chunked(list(dict.fromkeys(message_ids)), chunk_size):
+        try:
+            # Rate limit and server errors are retried with backoff, as for sends
+            send_with_retries(call, chunk, method=method)
+        except Exception as e:
+            raise BatchError(e, done) from e
+        done += chunk
+    return len(done)
+
+
+def apply_locally(store, message_ids, add_labels=(), remove_labels=()):
+    """
+    Show an action in the store before Gmail has confirmed it. Returns the
+    messages' previous labels, for `roll_back`.
+    """
+    previous = store.labels_of(message_ids)
+    store.relabel(message_ids, add_labels, remove_labels)
+    return previous
+
+
+def delete_locally(store, message_ids):
+    """
+    Hide messages being deleted from every label until Gmail confirms.
+    Returns their previous labels, for `roll_back`.
+    """
+    previous = store.labels_of(message_ids)
+    store.restore_labels({message_id: [] for message_id in previous})
+    return previous
+
+
+def roll_back(store, previous, error):
+    """
+    Put back the labels of the messages a failed action did not reach.
+    """
+    done = set(error.done) if isinstance(error, BatchError) else set()
+    store.restore_labels({message_id: labels for message_id, labels in previous.items() if message_id not in done})
@@ -0,0 +1,453 @@
+"""
+SQLite-backed local copy of message summaries, so the inbox can be shown
+straight away and refreshed incrementally instead of re-downloaded.
+"""
+import re
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    thread_id TEXT,
+    sender TEXT,
+    subject TEXT,
+    date TEXT,
+    timestamp INTEGER
+);
+CREATE TABLE IF NOT EXISTS message_labels (
+    message_id TEXT NOT NULL,
+    label TEXT NOT NULL,
+    PRIMARY KEY (message_id, label)
+);
+CREATE INDEX IF NOT EXISTS message_labels_by_label ON message_labels (label, message_id);
+CREATE INDEX IF NOT EXISTS messages_by_time ON messages (timestamp, id);
+CREATE INDEX IF NOT EXISTS messages_by_thread ON messages (thread_id, timestamp);
+CREATE TABLE IF NOT EXISTS threads (
+    id TEXT PRIMARY KEY,
+    history_id TEXT
+);
+CREATE TABLE IF NOT EXISTS thread_labels (
+    thread_id TEXT NOT NULL,
+    label TEXT NOT NULL,
+    latest INTEGER,
+    size INTEGER,
+    newest_id TEXT,
+    PRIMARY KEY (thread_id, label)
+);
+CREATE INDEX IF NOT EXISTS thread_labels_by_time ON thread_labels (label, latest, thread_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    sender, subject, body,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3'
+);
+"""
+
+# Ranking weights for the sender, subject and body columns of messages_fts
+SEARCH_WEIGHTS = (5.0, 10.0, 1.0)
+
+# Columns of a thread row: thread_labels joined to the thread's newest message
+THREAD_ROW = (
+    "SELECT t.thread_id, t.newest_id, m.sender, m.subject, m.date, t.size FROM thread_labels t "
+    "JOIN messages m ON m.id = t.newest_id "
+)
+
+
+def fts_query(text):
+    """
+    Turn free text typed by the user into an FTS5 query: every word must
+    match, and the last one may be a prefix of a longer word.
+    """
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    terms = ['"' + word + '"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+class MessageStore:
+    """
+    Message summaries and sync state stored in a single SQLite file.
+
+    The store is shared between the Tk thread (reads) and worker threads
+    (writes during sync), so every call takes the same lock.
+    """
+
+    def __init__(self, path='messages.db'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        with self.conn:
+            # Stores created before the search index existed need it filled once
+            self.conn.execute(
+                "INSERT INTO messages_fts (rowid, sender, subject, body) "
+                "SELECT rowid, sender, subject, '' FROM messages "
+                "WHERE rowid NOT IN (SELECT rowid FROM messages_fts)"
+            )
+            # Likewise the thread index
+            if not self.conn.execute("SELECT 1 FROM thread_labels LIMIT 1").fetchone():
+                self._index_threads([row[0] for row in self.conn.execute("SELECT DISTINCT thread_id FROM messages")])
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def get_history_id(self):
+        return self.get_meta('history_id')
+
+    def set_history_id(self, history_id):
+        self.set_meta('history_id', history_id)
+
+    def upsert(self, summaries):
+        """
+        Insert or replace message summaries (gmail_fetch.MessageSummary records).
+        """
+        with self.lock, self.conn:
+            self._write_summaries(summaries)
+
+    def replace(self, summaries, history_id):
+        """
+        Replace everything in the store with a fresh full sync, in one transaction.
+        """
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM messages")
+            self.conn.execute("DELETE FROM message_labels")
+            self.conn.execute("DELETE FROM messages_fts")
+            self.conn.execute("DELETE FROM threads")
+            self.conn.execute("DELETE FROM thread_labels")
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('history_id', ?)", (str(history_id),))
+            self._write_summaries(summaries)
+
+    def _write_summaries(self, summaries):
+        thread_ids = set()
+        for summary in summaries:
+            thread_ids.add(summary.thread_id)
+            # Upsert in place so the rowid, which keys the search index, stays stable
+            rowid = self.conn.execute(
+                "INSERT INTO messages (id, thread_id, sender, subject, date, timestamp) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET thread_id = excluded.thread_id, sender = excluded.sender, "
+                "subject = excluded.subject, date = excluded.date, timestamp = excluded.timestamp "
+                "RETURNING rowid",
+                (summary.id, summary.thread_id, summary.sender, summary.subject, summary.date, summary.timestamp)
+            ).fetchone()[0]
+
+            # Until the full body has been downloaded, the snippet stands in for it
+            indexed = self.conn.execute("SELECT body FROM messages_fts WHERE rowid = ?", (rowid,)).fetchone()
+            body = indexed[0] if indexed and indexed[0] else summary.snippet
+            self.conn.execute("DELETE FROM messages_fts WHERE rowid = ?", (rowid,))
+            self.conn.execute(
+                "INSERT INTO messages_fts (rowid, sender, subject, body) VALUES (?, ?, ?, ?)",
+                (rowid, summary.sender, summary.subject, body)
+            )
+            self.conn.execute("DELETE FROM message_labels WHERE message_id = ?", (summary.id,))
+            self.conn.executemany(
+                "INSERT INTO message_labels (message_id, label) VALUES (?, ?)",
+                [(summary.id, label) for label in summary.label_ids]
+            )
+        self._index_threads(thread_ids)
+
+    def upsert_threads(self, threads):
+        """
+        Store whole threads, given as (thread id, history id, summaries):
+        their messages replace what the store had for each thread.
+        """
+        with self.lock, self.conn:
+            for thread_id, history_id, summaries in threads:
+                kept = {summary.id for summary in summaries}
+                gone = [row[0] for row in self.conn.execute("SELECT id FROM messages WHERE thread_id = ?", (thread_id,))
+                        if row[0] not in kept]
+                self._delete_messages(gone)
+                self._write_summaries(summaries)
+                self.conn.execute("INSERT OR REPLACE INTO threads (id, history_id) VALUES (?, ?)",
+                                  (thread_id, str(history_id)))
+
+    def thread_history_ids(self, thread_ids):
+        """
+        Map each of the given threads that is stored to the history id it was stored at.
+        """
+        thread_ids = list(thread_ids)
+        if not thread_ids:
+            return {}
+        with self.lock:
+            return dict(self.conn.execute(
+                f"SELECT id, history_id FROM threads WHERE id IN ({', '.join('?' * len(thread_ids))})", thread_ids
+            ).fetchall())
+
+    def delete(self, message_ids):
+        with self.lock, self.conn:
+            self._delete_messages(message_ids)
+
+    def _delete_messages(self, message_ids):
+        message_ids = list(message_ids)
+        thread_ids = self._threads_of(message_ids)
+        for message_id in message_ids:
+            self.conn.execute(
+                "DELETE FROM messages_fts WHERE rowid = (SELECT rowid FROM messages WHERE id = ?)", (message_id,)
+            )
+            self.conn.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+            self.conn.execute("DELETE FROM message_labels WHERE message_id = ?", (message_id,))
+        self._index_threads(thread_ids)
+
+    def _index_threads(self, thread_ids):
+        """
+        Recompute the thread_labels rows of the given threads: one per label
+        any of their messages has, with the thread's newest message and size,
+        so thread listings need no grouping over the whole mailbox.
+        """
+        thread_ids = [thread_id for thread_id in thread_ids if thread_id is not None]
+        for start in range(0, len(thread_ids), 500):
+            chunk = thread_ids[start:start + 500]
+            placeholders = ', '.join('?' * len(chunk))
+            self.conn.execute(f"DELETE FROM thread_labels WHERE thread_id IN ({placeholders})", chunk)
+            self.conn.execute(
+                "INSERT INTO thread_labels (thread_id, label, latest, size, newest_id) "
+                "SELECT t.thread_id, labels.label, t.latest, t.size, "
+                "(SELECT id FROM messages WHERE thread_id = t.thread_id ORDER BY timestamp DESC, id DESC LIMIT 1) "
+                "FROM (SELECT thread_id, MAX(timestamp) AS latest, COUNT(*) AS size FROM messages "
+                f"WHERE thread_id IN ({placeholders}) GROUP BY thread_id) t "
+                "JOIN (SELECT DISTINCT m.thread_id, l.label FROM messages m JOIN message_labels l ON l.message_id = m.id "
+                f"WHERE m.thread_id IN ({placeholders})) labels ON labels.thread_id = t.thread_id",
+                chunk + chunk
+            )
+
+    def add_labels(self, message_id, labels):
+        # Only for stored messages, so counts never include ones that are not
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO message_labels (message_id, label) SELECT id, ? FROM messages WHERE id = ?",
+                [(label, message_id) for label in labels]
+            )
+            self._index_threads(self._threads_of([message_id]))
+
+    def remove_labels(self, message_id, labels):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "DELETE FROM message_labels WHERE message_id = ? AND label = ?",
+                [(message_id, label) for label in labels]
+            )
+            self._index_threads(self._threads_of([message_id]))
+
+    def labels_of(self, message_ids):
+        """
+        Map each of the given messages that is stored to its labels.
+        """
+        labels = {}
+        with self.lock:
+            for message_id in message_ids:
+                if self.conn.execute("SELECT 1 FROM messages WHERE id = ?", (message_id,)).fetchone():
+                    labels[message_id] = [row[0] for row in self.conn.execute(
+                        "SELECT label FROM message_labels WHERE message_id = ?", (message_id,))]
+        return labels
+
+    def relabel(self, message_ids, add_labels=(), remove_labels=()):
+        """
+        Add and remove labels on many messages in one transaction.
+        """
+        message_ids = list(message_ids)
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "DELETE FROM message_labels WHERE message_id = ? AND label = ?",
+                [(message_id, label) for message_id in message_ids for label in remove_labels]
+            )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO message_labels (message_id, label) "
+                "SELECT id, ? FROM messages WHERE id = ?",
+                [(label, message_id) for message_id in message_ids for label in add_labels]
+            )
+            self._index_threads(self._threads_of(message_ids))
+
+    def restore_labels(self, labels):
+        """
+        Set the labels of each message in a {message id: labels} dict, as
+        returned by `labels_of`.
+        """
+        with self.lock, self.conn:
+            for message_id, message_labels in labels.items():
+                self.conn.execute("DELETE FROM message_labels WHERE message_id = ?", (message_id,))
+                self.conn.executemany(
+                    "INSERT INTO message_labels (message_id, label) VALUES (?, ?)",
+                    [(message_id, label) for label in message_labels]
+                )
+            self._index_threads(self._threads_of(labels))
+
+    def _threads_of(self, message_ids):
+        return {row[0] for message_id in message_ids
+                for row in self.conn.execute("SELECT thread_id FROM messages WHERE id = ?", (message_id,))}
+
+    def contains(self, message_id):
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM messages WHERE id = ?", (message_id,)).fetchone()
+        return row is not None
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM messages")
+            self.conn.execute("DELETE FROM message_labels")
+            self.conn.execute("DELETE FROM messages_fts")
+            self.conn.execute("DELETE FROM threads")
+            self.conn.execute("DELETE FROM thread_labels")
+            self.conn.execute("DELETE FROM meta WHERE key = 'history_id'")
+
+    def list_label(self, label='INBOX', limit=None, offset=0):
+        """
+        Return (id, sender, subject, date) rows for a label, newest first.
+        """
+        # Walking the time index and probing labels avoids sorting the whole label
+        query = (
+            "SELECT m.id, m.sender, m.subject, m.date FROM messages m "
+            "WHERE EXISTS (SELECT 1 FROM message_labels l WHERE l.message_id = m.id AND l.label = ?) "
+            "ORDER BY m.timestamp DESC, m.id DESC"
+        )
+        params = [label]
+        if limit is not None:
+            query += " LIMIT ? OFFSET ?"
+            params += [limit, offset]
+        with self.lock:
+            return self.conn.execute(query, params).fetchall()
+
+    def list_label_older(self, label, message_id, limit):
+        """
+        Return up to `limit` rows that sort after `message_id`, newest first.
+
+        Seeking from a known row keeps scrolling deep into a large label as
+        cheap as scrolling near the top, unlike LIMIT/OFFSET.
+        """
+        with self.lock:
+            return self.conn.execute(
+                "SELECT m.id, m.sender, m.subject, m.date FROM messages m "
+                "WHERE (m.timestamp, m.id) < (SELECT timestamp, id FROM messages WHERE id = ?) "
+                "AND EXISTS (SELECT 1 FROM message_labels l WHERE l.message_id = m.id AND l.label = ?) "
+                "ORDER BY m.timestamp DESC, m.id DESC LIMIT ?",
+                (message_id, label, limit)
+            ).fetchall()
+
+    def list_label_newer(self, label, message_id, limit):
+        """
+        Return up to `limit` rows that sort just before `message_id`, newest first.
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT m.id, m.sender, m.subject, m.date FROM messages m "
+                "WHERE (m.timestamp, m.id) > (SELECT timestamp, id FROM messages WHERE id = ?) "
+                "AND EXISTS (SELECT 1 FROM message_labels l WHERE l.message_id = m.id AND l.label = ?) "
+                "ORDER BY m.timestamp ASC, m.id ASC LIMIT ?",
+                (message_id, label, limit)
+            ).fetchall()
+        rows.reverse()
+        return rows
+
+    def count_label(self, label='INBOX'):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM message_labels WHERE label = ?", (label,)
+            ).fetchone()[0]
+
+    def list_threads(self, label='INBOX', limit=None, offset=0):
+        """
+        Return (thread id, newest message id, sender, subject, date, message
+        count) rows for the threads with messages in a label, newest first.
+        A thread is shown by its newest message, which may be outside the
+        label, e.g. a reply sent.
+        """
+        query = THREAD_ROW + "WHERE t.label = ? ORDER BY t.latest DESC, t.thread_id DESC"
+        params = [label]
+        if limit is not None:
+            query += " LIMIT ? OFFSET ?"
+            params += [limit, offset]
+        with self.lock:
+            return self.conn.execute(query, params).fetchall()
+
+    def list_threads_older(self, label, thread_id, limit):
+        """
+        Return up to `limit` thread rows that sort after `thread_id`, newest first.
+        """
+        with self.lock:
+            return self.conn.execute(
+                THREAD_ROW + "WHERE t.label = ? AND (t.latest, t.thread_id) < "
+                "(SELECT latest, thread_id FROM thread_labels WHERE thread_id = ? AND label = ?) "
+                "ORDER BY t.latest DESC, t.thread_id DESC LIMIT ?",
+                (label, thread_id, label, limit)
+            ).fetchall()
+
+    def list_threads_newer(self, label, thread_id, limit):
+        """
+        Return up to `limit` thread rows that sort just before `thread_id`, newest first.
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                THREAD_ROW + "WHERE t.label = ? AND (t.latest, t.thread_id) > "
+                "(SELECT latest, thread_id FROM thread_labels WHERE thread_id = ? AND label = ?) "
+                "ORDER BY t.latest ASC, t.thread_id ASC LIMIT ?",
+                (label, thread_id, label, limit)
+            ).fetchall()
+        rows.reverse()
+        return rows
+
+    def count_threads(self, label='INBOX'):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM thread_labels WHERE label = ?", (label,)).fetchone()[0]
+
+    def thread_messages(self, thread_id):
+        """
+        Return (id, sender, subject, date) rows for a stored thread, oldest first.
+        """
+        with self.lock:
+            return self.conn.execute(
+                "SELECT id, sender, subject, date FROM messages WHERE thread_id = ? ORDER BY timestamp, id",
+                (thread_id,)
+            ).fetchall()
+
+    def index_body(self, message_id, body):
+        """
+        Make a downloaded plain text body searchable.
+        """
+        self.index_bodies({message_id: body})
+
+    def index_bodies(self, bodies):
+        """
+        Index several bodies (message id -> text) in one transaction.
+        """
+        with self.lock, self.conn:
+            for message_id, body in bodies.items():
+                row = self.conn.execute(
+                    "SELECT rowid, sender, subject FROM messages WHERE id = ?", (message_id,)
+                ).fetchone()
+                if row is None:
+                    continue
+                self.conn.execute("DELETE FROM messages_fts WHERE rowid = ?", (row[0],))
+                self.conn.execute(
+                    "INSERT INTO messages_fts (rowid, sender, subject, body) VALUES (?, ?, ?, ?)",
+                    (row[0], row[1], row[2], body)
+                )
+
+    def search(self, text, limit=200):
+        """
+        Return (id, sender, subject, date) rows matching `text`, best match first.
+        """
+        query = fts_query(text)
+        if query is None:
+            return []
+        with self.lock:
+            return self.conn.execute(
+                "SELECT m.id, m.sender, m.subject, m.date FROM messages_fts f "
+                "JOIN messages m ON m.rowid = f.rowid "
+                "WHERE messages_fts MATCH ? "
+                "ORDER BY bm25(messages_fts, ?, ?, ?) LIMIT ?",
+                (query, *SEARCH_WEIGHTS, limit)
+            ).fetchall()
@@ -0,0 +1,300 @@
+"""
+Latency, traffic and quota instrumentation for Gmail API calls and app phases.
+
+Every request a service built by gmail_auth.build_service executes goes
+through instrumented_http.InstrumentedRequest, which records its latency,
+status, bytes sent and received and the Gmail quota units it used, keyed by
+API method. Batch fetches, retries and named phases of the apps (syncing,
+parsing, rendering the inbox...) are recorded by the code that runs them.
+
+Recording is off unless GMAIL_METRICS=1 is set or `recorder.enabled` is
+switched on; while off, each hook costs a single attribute check. This
+module only uses the standard library, so importing it does not slow down
+app startup.
+"""
+import bisect
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Quota units Gmail charges per call, by discovery method id
+QUOTA_UNITS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.history.list': 2,
+    'gmail.users.labels.list': 1,
+    'gmail.users.labels.get': 1,
+    'gmail.users.labels.create': 5,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.attachments.get': 5,
+    'gmail.users.messages.modify': 5,
+    'gmail.users.messages.trash': 5,
+    'gmail.users.messages.untrash': 5,
+    'gmail.users.messages.delete': 10,
+    'gmail.users.messages.insert': 25,
+    'gmail.users.messages.import': 25,
+    'gmail.users.messages.batchModify': 50,
+    'gmail.users.messages.batchDelete': 50,
+    'gmail.users.messages.send': 100,
+    'gmail.users.threads.list': 10,
+    'gmail.users.threads.get': 10,
+    'gmail.users.threads.modify': 10,
+    'gmail.users.threads.trash': 10,
+}
+
+SEND = 'gmail.users.messages.send'
+GET = 'gmail.users.messages.get'
+ATTACHMENT_GET = 'gmail.users.messages.attachments.get'
+THREAD_GET = 'gmail.users.threads.get'
+BATCH_MODIFY = 'gmail.users.messages.batchModify'
+BATCH_DELETE = 'gmail.users.messages.batchDelete'
+
+
+class Histogram:
+    """
+    Fixed-bucket latency histogram, cumulative in the Prometheus sense when
+    exported.
+    """
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q-th quantile, in seconds.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum_seconds': round(self.total, 6),
+            'p50_ms': round(self.quantile(0.5) * 1000, 1),
+            'p95_ms': round(self.quantile(0.95) * 1000, 1),
+            'max_ms': round(self.max * 1000, 1),
+        }
+
+
+class MethodStats:
+    __slots__ = ('calls', 'errors', 'statuses', 'retries', 'coalesced', 'sent', 'received', 'units', 'latency')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.statuses = {}
+        self.retries = 0
+        self.coalesced = 0
+        self.sent = 0
+        self.received = 0
+        self.units = 0
+        self.latency = Histogram()
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'statuses': {str(status): count for status, count in self.statuses.items()},
+            'retries': self.retries,
+            'coalesced': self.coalesced,
+            'bytes_sent': self.sent,
+            'bytes_received': self.received,
+            'quota_units': self.units,
+            'latency': self.latency.as_dict(),
+        }
+
+
+class Recorder:
+    """
+    Thread-safe collection of per-method and per-phase measurements.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.methods = {}
+            self.phases = {}
+            self.started = time.time()
+
+    def _method(self, method):
+        stats = self.methods.get(method)
+        if stats is None:
+            stats = self.methods[method] = MethodStats()
+        return stats
+
+    def record_call(self, method, seconds, status, sent=0, calls=1):
+        """
+        Record `calls` calls of `method` that answered with `status`. Calls
+        made inside a batch pass `seconds=None`; the batch is timed as a whole.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            stats = self._method(method)
+            stats.calls += calls
+            stats.statuses[status] = stats.statuses.get(status, 0) + calls
+            if status != 200:
+                stats.errors += calls
+            stats.sent += sent
+            stats.units += QUOTA_UNITS.get(method, 0) * calls
+            if seconds is not None:
+                stats.latency.observe(seconds)
+
+    def record_received(self, method, size):
+        if not self.enabled:
+            return
+        with self.lock:
+            self._method(method).received += size
+
+    def record_retry(self, method, count=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self._method(method).retries += count
+
+    def record_coalesced(self, method):
+        """
+        Record a call of `method` that shared another caller's identical
+        call instead of being made.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self._method(method).coalesced += 1
+
+    def observe_phase(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.phases.get(name)
+            if histogram is None:
+                histogram = self.phases[name] = Histogram()
+            histogram.observe(seconds)
+
+    def phase(self, name):
+        """
+        Context manager timing one run of a named phase.
+        """
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return _Phase(self, name)
+
+    def quota_units(self):
+        with self.lock:
+            return sum(stats.units for stats in self.methods.values())
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'uptime_seconds': round(time.time() - self.started, 1),
+                'quota_units': sum(stats.units for stats in self.methods.values()),
+                'methods': {method: stats.as_dict() for method, stats in sorted(self.methods.items())},
+                'phases': {name: histogram.as_dict() for name, histogram in sorted(self.phases.items())},
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        """
+        Render everything in the Prometheus text exposition format.
+        """
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        def histogram(name, label, value, hist):
+            cumulative = 0
+            for bound, count in zip(BUCKETS, hist.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{label}="{value}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{label}="{value}",le="+Inf"}} {hist.count}')
+            lines.append(f'{name}_sum{{{label}="{value}"}} {hist.total}')
+            lines.append(f'{name}_count{{{label}="{value}"}} {hist.count}')
+
+        with self.lock:
+            methods = sorted(self.methods.items())
+            phases = sorted(self.phases.items())
+            metric('gmail_api_calls_total', 'counter', 'Gmail API calls by method and HTTP status.')
+            for method, stats in methods:
+                for status, count in sorted(stats.statuses.items(), key=str):
+                    lines.append(f'gmail_api_calls_total{{method="{method}",status="{status}"}} {count}')
+            for name, attribute, help_text in [
+                ('gmail_api_retries_total', 'retries', 'Calls retried after a transient error.'),
+                ('gmail_api_coalesced_total', 'coalesced', 'Calls answered by an identical call already in flight.'),
+                ('gmail_api_bytes_sent_total', 'sent', 'Request body bytes sent.'),
+                ('gmail_api_bytes_received_total', 'received', 'Response body bytes received.'),
+                ('gmail_api_quota_units_total', 'units', 'Gmail quota units used.'),
+            ]:
+                metric(name, 'counter', help_text)
+                for method, stats in methods:
+                    lines.append(f'{name}{{method="{method}"}} {getattr(stats, attribute)}')
+            metric('gmail_api_call_seconds', 'histogram', 'Gmail API call latency.')
+            for method, stats in methods:
+                histogram('gmail_api_call_seconds', 'method', method, stats.latency)
+            metric('gmail_phase_seconds', 'histogram', 'Duration of app phases.')
+            for name, hist in phases:
+                histogram('gmail_phase_seconds', 'phase', name, hist)
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Write a snapshot to `path`, as Prometheus text if it ends in .prom and
+        JSON otherwise. The file is replaced atomically, so a collector never
+        reads half of it.
+        """
+        text = self.to_prometheus() if path.endswith('.prom') else self.to_json()
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.replace(temp_path, path)
+
+
+class _Phase:
+    __slots__ = ('recorder', 'name', 'start')
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.recorder.observe_phase(self.name, time.perf_counter() - self.start)
+
+
+recorder = Recorder(enabled=os.environ.get('GMAIL_METRICS', '') not in ('', '0'))
+
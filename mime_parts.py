@@ -0,0 +1,194 @@
+"""
+Walk the MIME part tree of a full-format Gmail message.
+
+Messages nest their content arbitrarily deep (multipart/mixed around
+multipart/alternative around text/plain and text/html, forwarded messages,
+and so on). The walker visits parts lazily and nothing is base64-decoded
+until a part's text is actually asked for, so picking the body to show
+decodes exactly one part and attachments stay as handles to download later.
+"""
+import base64
+import re
+import sys
+from html.parser import HTMLParser
+
+from attachments import Attachment
+
+NO_CONTENT = "No text content available"
+
+CHARSET = re.compile(r'charset\s*=\s*"?([\w.:-]+)"?', re.IGNORECASE)
+
+
+class Part:
+    """
+    One node of a message's part tree. Wraps the part resource Gmail
+    returned without copying or decoding it.
+    """
+
+    __slots__ = ('message_id', 'resource')
+
+    def __init__(self, message_id, resource):
+        self.message_id = message_id
+        self.resource = resource
+
+    @property
+    def mime_type(self):
+        return self.resource.get('mimeType', '').lower()
+
+    @property
+    def filename(self):
+        return self.resource.get('filename', '')
+
+    @property
+    def size(self):
+        return self.resource.get('body', {}).get('size', 0)
+
+    def header(self, name):
+        name = name.lower()
+        for header in self.resource.get('headers', []):
+            if header['name'].lower() == name:
+                return header['value']
+        return None
+
+    @property
+    def is_multipart(self):
+        return self.mime_type.startswith('multipart/')
+
+    @property
+    def is_attachment(self):
+        disposition = (self.header('Content-Disposition') or '').lower()
+        return bool(self.filename) or disposition.startswith('attachment')
+
+    @property
+    def children(self):
+        return (Part(self.message_id, part) for part in self.resource.get('parts', []))
+
+    def text(self):
+        """
+        Decode this part's data to a string, using the charset it declares.
+        """
+        data = self.resource.get('body', {}).get('data')
+        if not data:
+            return ''
+        raw = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+        match = CHARSET.search(self.header('Content-Type') or '')
+        try:
+            return raw.decode(match.group(1) if match else 'utf-8', errors='replace')
+        except LookupError:
+            # Unknown charset name
+            return raw.decode('utf-8', errors='replace')
+
+    def attachment(self):
+        """
+        A handle that can download this part later; nothing is decoded now.
+        """
+        body = self.resource.get('body', {})
+        return Attachment(self.message_id, self.filename or 'attachment', self.mime_type or 'application/octet-stream',
+                          body.get('size', 0), body.get('attachmentId'), body.get('data'))
+
+
+def walk(message):
+    """
+    Yield every part of a message depth first, in document order, starting
+    with the top-level payload. Children are only visited as the caller
+    keeps iterating.
+    """
+    stack = [Part(message['id'], message.get('payload', {}))]
+    while stack:
+        part = stack.pop()
+        yield part
+        stack.extend(reversed(list(part.children)))
+
+
+class _TextExtractor(HTMLParser):
+    BLOCK_TAGS = {'p', 'div', 'br', 'tr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'table', 'ul', 'ol',
+                  'blockquote', 'pre', 'hr'}
+    SKIP_TAGS = {'script', 'style', 'head', 'title'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skipping += 1
+        elif tag == 'li':
+            self.chunks.append('\n- ')
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skipping = max(self.skipping - 1, 0)
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.chunks.append(re.sub(r'\s+', ' ', data))
+
+
+def html_to_text(html):
+    """
+    Turn an HTML body into readable plain text.
+    """
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    lines = [line.strip() for line in ''.join(parser.chunks).splitlines()]
+    # Collapse runs of blank lines into one
+    text = re.sub(r'\n{3,}', '\n\n', '\n'.join(lines))
+    return text.strip()
+
+
+def find_body(message):
+    """
+    Return (part, attachments): the part to display, preferring text/plain
+    over text/html, and handles for every attachment in the message.
+    """
+    plain = html = None
+    attachments = []
+    for part in walk(message):
+        if part.is_multipart:
+            continue
+        if part.is_attachment:
+            attachments.append(part.attachment())
+        elif part.mime_type == 'text/plain' and plain is None and 'data' in part.resource.get('body', {}):
+            plain = part
+        elif part.mime_type == 'text/html' and html is None and 'data' in part.resource.get('body', {}):
+            html = part
+    return plain or html, attachments
+
+
+def body_text(part):
+    """
+    Decode the chosen body part for display, converting HTML to text.
+    """
+    if part is None:
+        return NO_CONTENT
+    text = part.text()
+    return html_to_text(text) if part.mime_type == 'text/html' else text
+
+
+class MessageContent:
+    """
+    What the content window shows for a message: the text of the one part
+    chosen for display and handles for its attachments. Sized by the memory
+    it holds, for the body cache.
+    """
+
+    def __init__(self, body, attachments=()):
+        self.body = body
+        self.attachments = list(attachments)
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sys.getsizeof(self.body) + sum(map(sys.getsizeof, self.attachments))
+
+
+def extract_content(message):
+    """
+    Pick and decode the body of a full-format message and list its attachments.
+    """
+    part, attachments = find_body(message)
+    return MessageContent(body_text(part), attachments)
@@ -0,0 +1,323 @@
+"""
+Durable outbox for outgoing mail.
+
+Composed messages are written to SQLite before anything is sent, then sent
+by a background drain. Each message carries its own Message-ID header, so a
+message whose earlier attempt may have reached Gmail (a crash or a timeout
+mid-send) is looked up in the mailbox before it is sent again, and is never
+delivered twice.
+"""
+import os
+import sqlite3
+import threading
+import time
+from email.utils import make_msgid
+
+from attachments import send_bytes, send_file
+from bulk_send import DAY, is_retryable, send_bulk
+from single_flight import shielded
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY,
+    message_id TEXT UNIQUE NOT NULL,
+    recipient TEXT,
+    subject TEXT,
+    raw BLOB NOT NULL,
+    path TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    gmail_id TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    sent_at REAL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt);
+"""
+
+# Give up on a message after this many send attempts
+MAX_ATTEMPTS = 8
+
+# Longest wait between attempts, in seconds
+MAX_RETRY_DELAY = 600
+
+
+class OutboxItem:
+    """
+    A queued message as read back from the outbox.
+    """
+
+    def __init__(self, id, message_id, recipient, subject, raw, path, attempts):
+        self.id = id
+        self.message_id = message_id
+        self.recipient = recipient
+        self.subject = subject
+        # Large messages are spooled to a file instead of stored in `raw`
+        self.raw = raw
+        self.path = path
+        self.attempts = attempts
+
+    def __repr__(self):
+        return f"OutboxItem({self.id}, {self.recipient!r})"
+
+
+class Outbox:
+    """
+    Queue of outgoing messages stored in a single SQLite file.
+
+    Statuses move from "pending" to "sending" (claimed by a drain) and then
+    to "sent", back to "pending" with a later `next_attempt` after a
+    transient error, or to "failed" after a permanent one.
+    """
+
+    def __init__(self, path='outbox.db'):
+        self.path = path
+        # Messages with attachments are written here and only referenced from the database
+        self.spool_dir = os.path.splitext(path)[0] + '_spool'
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(outbox)")]
+        if 'path' not in columns:
+            self.conn.execute("ALTER TABLE outbox ADD COLUMN path TEXT")
+        if 'sent_at' not in columns:
+            self.conn.execute("ALTER TABLE outbox ADD COLUMN sent_at REAL")
+        with self.conn:
+            # Messages that were being sent when the app last stopped go back
+            # in the queue; their attempt count makes the next drain check
+            # Gmail before sending them again.
+            self.conn.execute("UPDATE outbox SET status = 'pending' WHERE status = 'sending'")
+        self._drain_state = threading.Lock()
+        self._draining = False
+        self._again = False
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def enqueue(self, message):
+        """
+        Store a message for sending and return its outbox id. Messages
+        spooled to a file (with a `path` attribute) are stored by reference.
+        """
+        return self.enqueue_many([message])[0]
+
+    def enqueue_many(self, messages):
+        """
+        Store several messages in one transaction and return their outbox ids.
+        """
+        ids = []
+        now = time.time()
+        with self.lock, self.conn:
+            for message in messages:
+                if message['Message-ID'] is None:
+                    message['Message-ID'] = make_msgid()
+                path = getattr(message, 'path', None)
+                ids.append(self.conn.execute(
+                    "INSERT INTO outbox (message_id, recipient, subject, raw, path, created) VALUES (?, ?, ?, ?, ?, ?)",
+                    (message['Message-ID'], message['to'], message['subject'],
+                     b'' if path else message.as_bytes(), path, now)
+                ).lastrowid)
+        return ids
+
+    def claim(self, ids):
+        """
+        Mark the given pending messages as being sent and return them.
+        """
+        items = []
+        ids = list(ids)
+        # Stay well under SQLite's limit on bound parameters
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            items += self._claim("id IN (%s)" % ','.join('?' * len(chunk)), chunk)
+        return items
+
+    def claim_due(self, limit=50):
+        """
+        Mark up to `limit` messages that are due for sending and return them.
+        """
+        return self._claim(
+            "id IN (SELECT id FROM outbox WHERE status = 'pending' AND next_attempt <= ? ORDER BY id LIMIT ?)",
+            [time.time(), limit]
+        )
+
+    def _claim(self, where, params):
+        with self.lock, self.conn:
+            rows = self.conn.execute(
+                "UPDATE outbox SET status = 'sending' WHERE status = 'pending' AND " + where +
+                " RETURNING id, message_id, recipient, subject, raw, path, attempts",
+                params
+            ).fetchall()
+        return [OutboxItem(*row) for row in sorted(rows)]
+
+    def deliver(self, item, send, find_sent=None, record_errors=True):
+        """
+        Send a claimed message with `send(item)` and record the outcome.
+
+        If an earlier attempt may already have reached Gmail, `find_sent`
+        is asked for the Gmail id of a message with the same Message-ID
+        first. Errors from either are recorded (the message is retried
+        later or failed) and then re-raised; with `record_errors=False`
+        they are only re-raised, and the message stays claimed for the
+        caller to retry or record.
+        """
+        try:
+            if item.attempts and find_sent is not None:
+                # A claimed message must not be left half-handled by a cancelled drain
+                with shielded():
+                    gmail_id = find_sent(item.message_id)
+                if gmail_id:
+                    self.mark_sent(item, gmail_id)
+                    return {'id': gmail_id}
+
+            item.attempts += 1
+            with self.lock, self.conn:
+                self.conn.execute("UPDATE outbox SET attempts = ? WHERE id = ?", (item.attempts, item.id))
+            response = send(item)
+        except Exception as e:
+            if record_errors:
+                self.record_error(item, e)
+            raise
+        self.mark_sent(item, response.get('id'))
+        return response
+
+    def mark_sent(self, item, gmail_id):
+        """
+        Record a successful send and drop its spool file. Safe to call more than once.
+        """
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE outbox SET status = 'sent', gmail_id = ?, error = NULL, sent_at = ? "
+                "WHERE id = ? AND status != 'sent'",
+                (gmail_id, time.time(), item.id)
+            )
+        if item.path and os.path.exists(item.path):
+            os.remove(item.path)
+
+    def record_error(self, item, error):
+        """
+        Schedule a retry after a transient error, or fail the message.
+        """
+        if is_retryable(error) and item.attempts < MAX_ATTEMPTS:
+            self.retry_later(item.id, min(MAX_RETRY_DELAY, 5 * 2 ** item.attempts), error)
+        else:
+            with self.lock, self.conn:
+                self.conn.execute(
+                    "UPDATE outbox SET status = 'failed', error = ? WHERE id = ? AND status != 'sent'",
+                    (str(error), item.id)
+                )
+
+    def retry_later(self, item_id, delay, error=None):
+        """
+        Put a claimed message back in the queue, due in `delay` seconds.
+        """
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE outbox SET status = 'pending', next_attempt = ?, error = ? WHERE id = ? AND status != 'sent'",
+                (time.time() + delay, str(error) if error else None, item_id)
+            )
+
+    def drain(self, send, find_sent=None, batch_size=50):
+        """
+        Send every message that is due, one at a time. Runs on a worker thread.
+
+        Returns a list of (item, error) pairs, where `error` is None for
+        messages that were sent. If a drain is already running it picks up
+        newly queued messages instead, and this call returns straight away.
+        """
+        with self._drain_state:
+            if self._draining:
+                self._again = True
+                return []
+            self._draining = True
+
+        results = []
+        try:
+            while True:
+                items = self.claim_due(batch_size)
+                for item in items:
+                    try:
+                        self.deliver(item, send, find_sent)
+                        results.append((item, None))
+                    except Exception as e:
+                        results.append((item, e))
+                with self._drain_state:
+                    if not items and not self._again:
+                        self._draining = False
+                        return results
+                    self._again = False
+        except BaseException:
+            with self._drain_state:
+                self._draining = False
+            raise
+
+    def send_bulk(self, messages, send, find_sent=None, on_result=None, **limits):
+        """
+        Queue `messages` and send them concurrently with bulk_send.send_bulk.
+
+        Everything is stored before the first send, so a crash mid-batch
+        loses nothing and the next drain resumes without duplicates.
+        Recipients held back by the daily quota stay queued for an hour.
+        Messages sent in the last day, by earlier bulk sends or drains,
+        count against the daily quota.
+        `limits` are passed on to send_bulk (per_second, per_day, workers...).
+        Results carry the OutboxItem as their recipient.
+
+        send_bulk retries transient errors itself, so a message's error is
+        only recorded here once those retries have run out.
+        """
+        items = self.claim(self.enqueue_many(messages))
+
+        def handle_result(result):
+            if result.status == 'deferred':
+                self.retry_later(result.recipient.id, 3600, result.error)
+            elif result.status == 'failed':
+                self.record_error(result.recipient, result.error)
+            if on_result:
+                on_result(result)
+
+        return send_bulk(items, lambda item: item,
+                         lambda item: self.deliver(item, send, find_sent, record_errors=False),
+                         on_result=handle_result, sent_today=self.sent_since(time.time() - DAY), **limits)
+
+    def sent_since(self, since):
+        """
+        Number of messages sent since the time `since`.
+        """
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM outbox WHERE status = 'sent' AND sent_at >= ?", (since,)
+            ).fetchone()[0]
+
+    def status(self, item_id):
+        with self.lock:
+            row = self.conn.execute("SELECT status FROM outbox WHERE id = ?", (item_id,)).fetchone()
+        return row[0] if row else None
+
+    def counts(self):
+        """
+        Number of messages in each status.
+        """
+        with self.lock:
+            return dict(self.conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+
+    def next_retry_delay(self):
+        """
+        Seconds until the next queued message is due, or None if none are queued.
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT MIN(next_attempt) FROM outbox WHERE status = 'pending'").fetchone()
+        if row[0] is None:
+            return None
+        return max(row[0] - time.time(), 0)
+
+
+def send_item(service, item):
+    """
+    Send an outbox item through the media upload endpoint, streaming it from
+    its spool file if it has one.
+    """
+    if item.path:
+        return send_file(service, item.path)
+    return send_bytes(service, item.raw)
@@ -0,0 +1,265 @@
+"""
+One budget for the Gmail quota units every API call spends.
+
+Gmail allows each user 250 quota units a second, as a moving average that
+allows short bursts, and charges each method differently: a message get
+is 5 units, a send 100 (metrics.QUOTA_UNITS). Syncing, prefetching, bulk
+sends and opening messages used to spend from it without knowing about
+each other, so a bulk job ran into 429s, and a message opened while it ran
+waited behind the retries.
+
+Every call now takes its units from `scheduler` before it goes out: calls
+made by services from gmail_auth.build_service, batch fetches, attachment
+downloads and the asyncio client. The budget is a token bucket refilling at
+the per-user rate, which is what Gmail's moving average amounts to.
+
+Work has one of three priorities, set for the calling thread or asyncio
+task with `scheduler.priority()`:
+
+    INTERACTIVE   what the user is waiting on, such as opening a message
+    BACKGROUND    syncing and paging (the default)
+    BULK          bulk sends and prefetching
+
+Lower priorities must leave part of the bucket unspent (RESERVE), so a
+message opened while a bulk job runs finds units waiting for it, and when
+calls have to wait the highest priority goes first. Large requests, like a
+batch of 100 gets, take their units in pieces, so they queue behind
+interactive calls instead of draining the bucket in one go.
+
+A 429, or a 403 for a rate limit, pauses every call for the Retry-After
+time, or for an exponential backoff, and halves the rate; the rate climbs
+back as calls succeed.
+
+Set GMAIL_QUOTA_PER_SECOND to change the rate, or to 0 to turn scheduling
+off. This module only uses the standard library.
+"""
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+
+from metrics import QUOTA_UNITS, recorder
+
+INTERACTIVE = 0
+BACKGROUND = 1
+BULK = 2
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BACKGROUND: 'background', BULK: 'bulk'}
+
+# Share of the bucket each priority has to leave for the ones above it
+RESERVE = {INTERACTIVE: 0.0, BACKGROUND: 0.2, BULK: 0.4}
+
+# Gmail's per-user limit
+UNITS_PER_SECOND = float(os.environ.get('GMAIL_QUOTA_PER_SECOND', 250))
+# Seconds of the rate that may be spent at once. Gmail allows a second's
+# worth, but calls reach it later than they take their units, and not
+# always in the same order, so keep a margin
+BURST_SECONDS = 0.5
+
+# Charged for methods missing from metrics.QUOTA_UNITS
+DEFAULT_UNITS = 5
+
+# Backoff after a rate limit response without Retry-After, doubling up to MAX_BACKOFF
+BASE_BACKOFF = 1.0
+MAX_BACKOFF = 32.0
+# The rate is never cut below this share of UNITS_PER_SECOND, and each
+# successful call wins back this share
+MIN_RATE_SHARE = 0.1
+RECOVERY_SHARE = 0.05
+
+# How often an asyncio task waiting behind other callers checks again
+ASYNC_POLL_INTERVAL = 0.05
+
+RATE_LIMIT_REASONS = (b'rateLimitExceeded', b'userRateLimitExceeded')
+
+_priority = contextvars.ContextVar('gmail_priority', default=BACKGROUND)
+
+
+def units_for(method_id, count=1):
+    return QUOTA_UNITS.get(method_id, DEFAULT_UNITS) * count
+
+
+def is_rate_limited(error):
+    """
+    Whether an HttpError says the user is over their quota.
+    """
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    if status == 429:
+        return True
+    return status == 403 and any(reason in (getattr(error, 'content', b'') or b'') for reason in RATE_LIMIT_REASONS)
+
+
+def _retry_after(error):
+    value = error.resp.get('retry-after')
+    return int(value) if value and value.isdigit() else None
+
+
+class QuotaScheduler:
+    """
+    Hands out quota units to API calls, by priority. Thread-safe; asyncio
+    code uses `acquire_async`.
+    """
+
+    def __init__(self, units_per_second=UNITS_PER_SECOND, burst_seconds=BURST_SECONDS):
+        self._condition = threading.Condition()
+        # Threads waiting for units: a heap of (priority, arrival)
+        self._waiting = []
+        self._arrivals = itertools.count()
+        self.configure(units_per_second, burst_seconds)
+
+    def configure(self, units_per_second=UNITS_PER_SECOND, burst_seconds=BURST_SECONDS):
+        """
+        Set the per-user rate, and how many seconds of it may be spent at
+        once. A rate of 0 or None turns scheduling off.
+        """
+        with self._condition:
+            self.units_per_second = units_per_second or 0
+            self.rate = self.units_per_second
+            self.capacity = self.units_per_second * burst_seconds
+            self.tokens = self.capacity
+            self.updated = time.monotonic()
+            self.paused_until = 0.0
+            self.strikes = 0
+            self._condition.notify_all()
+
+    @property
+    def enabled(self):
+        return self.units_per_second > 0
+
+    @staticmethod
+    @contextlib.contextmanager
+    def priority(priority):
+        """
+        Context manager running the calls made inside it at `priority`.
+        """
+        token = _priority.set(priority)
+        try:
+            yield
+        finally:
+            _priority.reset(token)
+
+    @staticmethod
+    def current_priority():
+        return _priority.get()
+
+    def acquire(self, units, priority=None):
+        """
+        Block until `units` can be spent at `priority` (default: the
+        caller's) and spend them.
+        """
+        if not self.enabled:
+            return
+        priority = _priority.get() if priority is None else priority
+        ticket = (priority, next(self._arrivals))
+        start = time.perf_counter()
+        with self._condition:
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while units > 0:
+                    taken, wait = self._take(priority, units) if self._waiting[0] == ticket else (0, None)
+                    units -= taken
+                    if not taken:
+                        self._condition.wait(wait)
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+        waited = time.perf_counter() - start
+        if waited > 0.001:
+            recorder.observe_phase(f'quota_wait_{PRIORITY_NAMES[priority]}', waited)
+
+    async def acquire_async(self, units, priority=None):
+        """
+        `acquire` for asyncio tasks, which wait without blocking the loop.
+        """
+        if not self.enabled:
+            return
+        priority = _priority.get() if priority is None else priority
+        start = time.perf_counter()
+        while units > 0:
+            with self._condition:
+                if any(ticket[0] <= priority for ticket in self._waiting):
+                    # Threads of the same or higher priority were first
+                    taken, wait = 0, ASYNC_POLL_INTERVAL
+                else:
+                    taken, wait = self._take(priority, units)
+            units -= taken
+            if not taken:
+                await asyncio.sleep(wait)
+        waited = time.perf_counter() - start
+        if waited > 0.001:
+            recorder.observe_phase(f'quota_wait_{PRIORITY_NAMES[priority]}', waited)
+
+    def _take(self, priority, units):
+        """
+        Spend what can be spent now towards `units`, at most one piece.
+        Returns (units spent, seconds until more can be). Called with the
+        lock held.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.paused_until:
+            return 0, self.paused_until - now
+        reserve = self.capacity * RESERVE[priority]
+        piece = min(units, self.capacity - reserve)
+        if self.tokens - piece >= reserve:
+            self.tokens -= piece
+            return piece, 0
+        return 0, (piece + reserve - self.tokens) / self.rate
+
+    @contextlib.contextmanager
+    def call(self, method_id, count=1):
+        """
+        Context manager around `count` calls of an API method: waits for
+        their units, and backs off if Gmail answers with a rate limit.
+        """
+        self.acquire(units_for(method_id, count))
+        try:
+            yield
+        except Exception as e:
+            if is_rate_limited(e):
+                self.rate_limited(_retry_after(e))
+            raise
+        self.succeeded()
+
+    def rate_limited(self, retry_after=None):
+        """
+        Pause all calls and halve the rate after a rate limit response.
+        """
+        if not self.enabled:
+            return
+        with self._condition:
+            self.strikes += 1
+            if retry_after is None:
+                retry_after = random.uniform(0.5, 1) * min(MAX_BACKOFF, BASE_BACKOFF * 2 ** (self.strikes - 1))
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            self.rate = max(self.units_per_second * MIN_RATE_SHARE, self.rate / 2)
+            # Units spent before the limit hit still count against it
+            self.tokens = min(self.tokens, 0)
+            self._condition.notify_all()
+
+    def succeeded(self):
+        # Read without the lock first: nearly every call finds nothing to do
+        if self.strikes or self.rate < self.units_per_second:
+            with self._condition:
+                self.strikes = 0
+                self.rate = min(self.units_per_second, self.rate + self.units_per_second * RECOVERY_SHARE)
+
+    def snapshot(self):
+        with self._condition:
+            return {
+                'units_per_second': self.units_per_second,
+                'rate': round(self.rate, 1),
+                'tokens': round(self.tokens, 1),
+                'paused_seconds': round(max(self.paused_until - time.monotonic(), 0), 3),
+                'waiting': {PRIORITY_NAMES[priority]: sum(1 for ticket in self._waiting if ticket[0] == priority)
+                            for priority in PRIORITY_NAMES},
+            }
+
+
+scheduler = QuotaScheduler()
@@ -0,0 +1,478 @@
+"""
+Rules that act on newly arrived mail, like Gmail's own filters: they add or
+remove labels, forward messages or send a templated auto-reply.
+
+Rules are kept in a JSON file, a list of objects such as
+
+    [
+      {"name": "Invoices", "from_domain": "billing.example.com", "subject": "invoice|receipt",
+       "add_labels": ["Finance"], "archive": true},
+      {"name": "Big attachments", "has_attachment": true, "larger_than": 5000000,
+       "forward": "archive@example.com"},
+      {"name": "Support", "to": "support@example\\.com", "headers": {"X-Priority": "^1"},
+       "reply": {"subject": "Re: {{ subject }}", "text": "Hi {{ name }}, we got your message."}}
+    ]
+
+A rule matches when all of its conditions hold:
+
+    from, to, subject   regular expressions, searched case-insensitively
+                        (`to` also searches Cc)
+    headers             {header name: regular expression}
+    from_domain         the sender's domain, or any subdomain of it
+    larger_than,
+    smaller_than        Gmail's size estimate, in bytes
+    has_attachment      true or false
+
+and then does any of:
+
+    add_labels, remove_labels   label names; user labels that do not exist yet are created
+    mark_read, star, archive, trash
+    forward             an address; the text of the message is forwarded, without attachments
+    reply               {"subject", "text" and/or "html"}: a template with {{ name }},
+                        {{ email }} and {{ subject }} fields. Each sender gets at most one
+                        reply per rule every `reply_days` (default 4), and mailing lists and
+                        automatic mail get none.
+
+All the rules are compiled into one matching pass. Sender domains are kept
+in a dict, looked up once per level of the sender's domain. Every regex is
+indexed by trigrams that any match of it must contain, so a header is only
+tested against the patterns sharing a trigram with it; patterns with no
+such trigram (like `^\d+$`) are tested against every message. Matching a
+message costs about the same with 10 rules as with 1000, apart from the work
+for the rules it does match (see benchmarks/bench_rules.py).
+
+The label changes of all the messages matched in a sync are grouped by
+change and applied with one batchModify per group, and forwards and replies
+go through the outbox.
+"""
+import json
+import os
+import re
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict
+from email.utils import parseaddr
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+from attachments import spool_message
+from gmail_fetch import SUMMARY_FIELDS, SUMMARY_HEADERS, fetch_messages_batched
+from mailbox_ops import ACTIONS, BatchError, batch_modify
+from mime_parts import extract_content
+from templates import EmailTemplate
+
+RULES_PATH = 'rules.json'
+
+# The summary fetch, plus the top-level MIME type to tell if there are attachments
+RULE_FIELDS = SUMMARY_FIELDS + ',payload/mimeType'
+
+# Headers looked at before auto-replying, and to thread the reply (RFC 3834)
+REPLY_HEADERS = ['Reply-To', 'Message-ID', 'References', 'Auto-Submitted', 'Precedence', 'List-Id']
+
+# Shortcut actions -> mailbox_ops.ACTIONS
+FLAGS = {'mark_read': "Mark as read", 'star': "Star", 'archive': "Archive", 'trash': "Trash"}
+
+CONDITIONS = {'from', 'to', 'subject', 'headers', 'from_domain', 'larger_than', 'smaller_than', 'has_attachment'}
+ACTION_KEYS = {'add_labels', 'remove_labels', 'forward', 'reply', 'reply_days', *FLAGS}
+
+SYSTEM_LABELS = {'INBOX', 'UNREAD', 'STARRED', 'IMPORTANT', 'SPAM', 'TRASH', 'SENT', 'DRAFT'}
+
+# Senders never to auto-reply to
+AUTOMATED_SENDERS = re.compile(r'^(mailer-daemon|postmaster|no-?reply|do-?not-?reply)\b', re.IGNORECASE)
+
+_REPEATS = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, 'POSSESSIVE_REPEAT', None)}
+
+
+class RuleError(ValueError):
+    """
+    A rules file that cannot be used, with the rule at fault.
+    """
+
+
+def required_trigrams(pattern):
+    """
+    Return a set of lowercase trigrams at least one of which is in every
+    string `pattern` matches (case-insensitively), or None if there is none.
+    """
+    return _required(sre_parse.parse(pattern, re.IGNORECASE))
+
+
+def _required(items):
+    best = None
+    run = []
+
+    def consider(trigrams):
+        nonlocal best
+        if trigrams is not None and (best is None or len(trigrams) < len(best)):
+            best = trigrams
+
+    for op, value in list(items) + [(None, None)]:
+        # ASCII only, so the literal is still in the casefolded text
+        if op is sre_parse.LITERAL and value < 128:
+            run.append(chr(value))
+            continue
+        if op is sre_parse.AT:
+            # Anchors take no characters, so the literals either side stay adjacent
+            continue
+        if len(run) >= 3:
+            consider({''.join(run).casefold()[:3]})
+        run = []
+        if op is sre_parse.BRANCH:
+            alternatives = [_required(alternative) for alternative in value[1]]
+            if all(trigrams is not None for trigrams in alternatives):
+                consider(set().union(*alternatives))
+        elif op is sre_parse.SUBPATTERN:
+            consider(_required(value[-1]))
+        elif op in _REPEATS and value[0] >= 1:
+            consider(_required(value[2]))
+    return best
+
+
+class _PatternIndex:
+    """
+    The regexes of every rule over one header.
+    """
+
+    def __init__(self):
+        self.by_trigram = defaultdict(list)
+        self.unindexed = []
+
+    def add(self, pattern, condition):
+        entry = (re.compile(pattern, re.IGNORECASE), condition)
+        trigrams = required_trigrams(pattern)
+        if trigrams is None:
+            self.unindexed.append(entry)
+        else:
+            for trigram in trigrams:
+                self.by_trigram[trigram].append(entry)
+
+    def matches(self, text):
+        """
+        Yield the conditions whose pattern is found in `text`.
+        """
+        candidates = set(self.unindexed)
+        if self.by_trigram:
+            folded = text.casefold()
+            by_trigram = self.by_trigram
+            for start in range(len(folded) - 2):
+                entries = by_trigram.get(folded[start:start + 3])
+                if entries:
+                    candidates.update(entries)
+        for pattern, condition in candidates:
+            if pattern.search(text):
+                yield condition
+
+
+class Rule:
+    """
+    One rule from the rules file: its conditions and what it does.
+    """
+
+    def __init__(self, spec, position):
+        self.name = spec.get('name') or f"Rule {position + 1}"
+        unknown = set(spec) - CONDITIONS - ACTION_KEYS - {'name'}
+        if unknown:
+            raise RuleError(f"{self.name}: unknown keys {', '.join(sorted(unknown))}")
+        self.spec = spec
+        add = list(spec.get('add_labels', []))
+        remove = list(spec.get('remove_labels', []))
+        for flag, action in FLAGS.items():
+            if spec.get(flag):
+                add += ACTIONS[action][0]
+                remove += ACTIONS[action][1]
+        self.add_labels = tuple(dict.fromkeys(add))
+        self.remove_labels = tuple(dict.fromkeys(remove))
+        self.forward = spec.get('forward')
+        self.reply = None
+        if spec.get('reply'):
+            reply = spec['reply']
+            self.reply = EmailTemplate(reply.get('subject', 'Re: {{ subject }}'), text=reply.get('text'),
+                                       html=reply.get('html'))
+        self.reply_seconds = float(spec.get('reply_days', 4)) * 86400
+        if not (self.add_labels or self.remove_labels or self.forward or self.reply):
+            raise RuleError(f"{self.name}: the rule does nothing")
+
+    def __repr__(self):
+        return f"Rule({self.name!r})"
+
+
+def message_headers(message):
+    """
+    Map lowercase header names to values; repeated headers are joined.
+    """
+    headers = {}
+    for header in message.get('payload', {}).get('headers', []):
+        name = header['name'].lower()
+        headers[name] = f"{headers[name]}, {header['value']}" if name in headers else header['value']
+    return headers
+
+
+def has_attachment(message):
+    payload = message.get('payload', {})
+    if 'parts' not in payload:
+        # Metadata format only has the top-level type
+        return payload.get('mimeType') == 'multipart/mixed'
+    parts = list(payload['parts'])
+    while parts:
+        part = parts.pop()
+        if part.get('filename'):
+            return True
+        parts += part.get('parts', [])
+    return False
+
+
+class RuleSet:
+    """
+    Rules compiled for matching many messages.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        # Condition number -> rule number, and the number of conditions per rule
+        self._rule_of = []
+        self._needed = []
+        self._patterns = defaultdict(_PatternIndex)
+        # Lowercase header name -> as first written, to ask Gmail for
+        self._names = {}
+        self._domains = defaultdict(list)
+        self._larger = []
+        self._smaller = []
+        self._attachment = {True: [], False: []}
+        self.headers = list(SUMMARY_HEADERS)
+
+        for number, rule in enumerate(self.rules):
+            conditions = 0
+
+            def condition():
+                nonlocal conditions
+                conditions += 1
+                self._rule_of.append(number)
+                return len(self._rule_of) - 1
+
+            spec = rule.spec
+            patterns = [('From', spec.get('from')), ('Subject', spec.get('subject'))]
+            if spec.get('to') is not None:
+                to = condition()
+                for name in ('To', 'Cc'):
+                    self._add_pattern(rule, name, spec['to'], to)
+            for name, pattern in list(spec.get('headers', {}).items()) + patterns:
+                if pattern is not None:
+                    self._add_pattern(rule, name, pattern, condition())
+            if spec.get('from_domain'):
+                self._domains[spec['from_domain'].lower().lstrip('@.')].append(condition())
+            for key, sizes in (('larger_than', self._larger), ('smaller_than', self._smaller)):
+                if spec.get(key) is not None:
+                    sizes.append((int(spec[key]), condition()))
+            if spec.get('has_attachment') is not None:
+                self._attachment[bool(spec['has_attachment'])].append(condition())
+            if not conditions:
+                raise RuleError(f"{rule.name}: the rule has no conditions")
+            self._needed.append(conditions)
+
+        self._larger.sort()
+        self._smaller.sort()
+        self._larger_sizes = [size for size, _ in self._larger]
+        self._smaller_sizes = [size for size, _ in self._smaller]
+        wanted = list(self._names.values()) + (REPLY_HEADERS if any(rule.reply for rule in self.rules) else [])
+        for name in wanted:
+            if name.lower() not in {header.lower() for header in self.headers}:
+                self.headers.append(name)
+
+    def _add_pattern(self, rule, header, pattern, condition):
+        self._names.setdefault(header.lower(), header)
+        try:
+            self._patterns[header.lower()].add(pattern, condition)
+        except re.error as e:
+            raise RuleError(f"{rule.name}: bad pattern {pattern!r}: {e}") from e
+
+    def match(self, message):
+        """
+        Return the rules a metadata or full format message matches, in order.
+        """
+        headers = message_headers(message)
+        satisfied = []
+        for name, index in self._patterns.items():
+            value = headers.get(name)
+            if value is not None:
+                satisfied += index.matches(value)
+        if self._domains:
+            domain = parseaddr(headers.get('from', ''))[1].rpartition('@')[2].lower()
+            labels = domain.split('.')
+            for level in range(len(labels)):
+                satisfied += self._domains.get('.'.join(labels[level:]), ())
+        size = int(message.get('sizeEstimate', 0))
+        satisfied += [condition for _, condition in self._larger[:bisect_left(self._larger_sizes, size)]]
+        satisfied += [condition for _, condition in self._smaller[bisect_right(self._smaller_sizes, size):]]
+        if self._attachment[True] or self._attachment[False]:
+            satisfied += self._attachment[has_attachment(message)]
+        counts = Counter(self._rule_of[condition] for condition in set(satisfied))
+        return [self.rules[number] for number in sorted(counts) if counts[number] == self._needed[number]]
+
+
+def load_rules(path=RULES_PATH):
+    """
+    Compile the rules in a JSON file. Returns None if there is no such file.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        try:
+            specs = json.load(f)
+        except json.JSONDecodeError as e:
+            raise RuleError(f"{path}: {e}") from e
+    if not isinstance(specs, list):
+        raise RuleError(f"{path}: expected a list of rules")
+    return RuleSet(Rule(spec, position) for position, spec in enumerate(specs))
+
+
+class RuleEngine:
+    """
+    Runs a RuleSet on newly synced messages and carries out what it matched.
+    Safe to use from worker threads.
+    """
+
+    def __init__(self, rules, outbox):
+        self.rules = rules
+        self.outbox = outbox
+        self.headers = rules.headers
+        self.fields = RULE_FIELDS
+        self._lock = threading.Lock()
+        self._label_ids = None
+        self._address = None
+
+    def run(self, service, store, messages):
+        """
+        Match `messages` (metadata format, fetched with `headers` and
+        `fields`) and act on them. Returns a dict of stats; failures are
+        counted and printed rather than raised, as the messages are already
+        stored.
+        """
+        stats = {'matched': 0, 'relabelled': 0, 'forwarded': 0, 'replied': 0, 'errors': 0}
+        changes = defaultdict(list)
+        forwards = []
+        replies = []
+        for message in messages:
+            matched = self.rules.match(message)
+            if not matched:
+                continue
+            stats['matched'] += 1
+            add, remove = {}, {}
+            for rule in matched:
+                add.update(dict.fromkeys(rule.add_labels))
+                remove.update(dict.fromkeys(rule.remove_labels))
+                if rule.forward:
+                    forwards.append((message['id'], rule.forward))
+                if rule.reply:
+                    replies.append((message, rule))
+            add = tuple(add)
+            remove = tuple(label for label in remove if label not in add)
+            if add or remove:
+                changes[(add, remove)].append(message['id'])
+
+        for (add, remove), message_ids in changes.items():
+            try:
+                label_ids = self._resolve(service, add + remove)
+                add_ids = [label_ids[label] for label in add]
+                remove_ids = [label_ids[label] for label in remove]
+                stats['relabelled'] += batch_modify(service, message_ids, add_ids, remove_ids)
+                store.relabel(message_ids, add_ids, remove_ids)
+            except BatchError as e:
+                store.relabel(e.done, add_ids, remove_ids)
+                stats['relabelled'] += len(e.done)
+                stats['errors'] += 1
+                print(f"Rules could not relabel {len(message_ids) - len(e.done)} messages: {e}")
+            except Exception as e:
+                stats['errors'] += 1
+                print(f"Rules could not relabel {len(message_ids)} messages: {e}")
+
+        outgoing = []
+        if forwards:
+            try:
+                outgoing += self._forwards(service, forwards)
+                stats['forwarded'] = len(outgoing)
+            except Exception as e:
+                stats['errors'] += 1
+                print(f"Rules could not forward messages: {e}")
+        if replies:
+            try:
+                queued = self._replies(service, store, replies)
+                outgoing += queued
+                stats['replied'] = len(queued)
+            except Exception as e:
+                stats['errors'] += 1
+                print(f"Rules could not reply to messages: {e}")
+        if outgoing:
+            self.outbox.enqueue_many(outgoing)
+        return stats
+
+    def _resolve(self, service, names):
+        """
+        Map label names to ids, creating user labels that do not exist.
+        """
+        with self._lock:
+            if self._label_ids is None and any(name not in SYSTEM_LABELS for name in names):
+                response = service.users().labels().list(userId='me', fields='labels(id,name)').execute()
+                self._label_ids = {label['name']: label['id'] for label in response.get('labels', [])}
+            ids = {}
+            for name in names:
+                if name in SYSTEM_LABELS or name.startswith('CATEGORY_'):
+                    ids[name] = name
+                    continue
+                if name not in self._label_ids:
+                    created = service.users().labels().create(userId='me', body={'name': name}).execute()
+                    self._label_ids[name] = created['id']
+                ids[name] = self._label_ids[name]
+            return ids
+
+    def _forwards(self, service, forwards):
+        fetched, errors = fetch_messages_batched(service, list(dict.fromkeys(mid for mid, _ in forwards)))
+        if errors:
+            print(f"Rules could not fetch {len(errors)} messages to forward")
+        messages = []
+        for message_id, address in forwards:
+            if message_id not in fetched:
+                continue
+            message = fetched[message_id]
+            headers = message_headers(message)
+            quoted = '\n'.join(f"{name.title()}: {headers[name]}" for name in ('from', 'date', 'subject', 'to')
+                               if name in headers)
+            body = f"---------- Forwarded message ---------\n{quoted}\n\n{extract_content(message).body}"
+            messages.append(spool_message(self.outbox.spool_dir, address,
+                                          f"Fwd: {headers.get('subject', '')}", body))
+        return messages
+
+    def _replies(self, service, store, replies):
+        with self._lock:
+            if self._address is None:
+                profile = service.users().getProfile(userId='me', fields='emailAddress').execute()
+                self._address = profile['emailAddress'].lower()
+        messages = []
+        now = time.time()
+        for message, rule in replies:
+            headers = message_headers(message)
+            name, address = parseaddr(headers.get('reply-to') or headers.get('from', ''))
+            if not address or address.lower() == self._address or AUTOMATED_SENDERS.match(address):
+                continue
+            # Never answer mailing lists, bulk mail or other automatic replies
+            if headers.get('auto-submitted', 'no').lower() != 'no' or 'list-id' in headers:
+                continue
+            if headers.get('precedence', '').lower() in ('bulk', 'junk', 'list'):
+                continue
+            key = f"rule_reply:{rule.name}:{address.lower()}"
+            last = store.get_meta(key)
+            if last is not None and now - float(last) < rule.reply_seconds:
+                continue
+            threading_headers = {'Auto-Submitted': 'auto-replied'}
+            if headers.get('message-id'):
+                threading_headers['In-Reply-To'] = headers['message-id']
+                threading_headers['References'] = ' '.join(
+                    filter(None, [headers.get('references'), headers['message-id']]))
+            values = {'name': name or address.split('@')[0], 'email': address,
+                      'subject': headers.get('subject', '')}
+            messages.append(rule.reply.render(address, values, headers=threading_headers))
+            store.set_meta(key, now)
+        return messages
@@ -0,0 +1,120 @@
+"""
+Share identical Gmail reads that are in flight at the same time, and stop
+reading for work that has been superseded.
+
+Double-clicking a row, or pressing Refresh again before the last refresh
+finished, used to send the same calls twice, each paying the full round
+trip and its quota units. Every GET a service built by
+gmail_auth.build_service executes now goes through `flights`, keyed on the
+API method and the request URI, which holds the message id, format and
+fields asked for. A call arriving while an identical one is in flight
+waits for it and gets the same result (or error) instead of making its
+own. Results are shared, not copied, so callers must not modify them.
+Writes are never shared.
+
+Work run by background.BackgroundExecutor can be cancelled, as fetch_emails
+does with a refresh still running when a newer one starts. Cancelling used
+to only drop the result once the old refresh finished; now its next read
+raises Cancelled, so it stops calling Gmail. Writes that have started
+always go through, and code that must not stop halfway through its reads
+runs them inside `shielded()`.
+
+This module only uses the standard library.
+"""
+import contextlib
+import contextvars
+import threading
+
+from metrics import recorder
+
+
+class Cancelled(Exception):
+    """
+    Raised at the next read of work that has been cancelled.
+    """
+
+
+# Returns whether the calling thread's or task's work has been cancelled
+_is_cancelled = contextvars.ContextVar('gmail_is_cancelled', default=None)
+
+
+@contextlib.contextmanager
+def cancellable(is_cancelled):
+    """
+    Context manager making reads inside it raise Cancelled once
+    `is_cancelled()` returns true.
+    """
+    token = _is_cancelled.set(is_cancelled)
+    try:
+        yield
+    finally:
+        _is_cancelled.reset(token)
+
+
+def shielded():
+    """
+    Context manager letting the reads inside it run even if the work has
+    been cancelled.
+    """
+    return cancellable(None)
+
+
+def raise_if_cancelled():
+    is_cancelled = _is_cancelled.get()
+    if is_cancelled is not None and is_cancelled():
+        raise Cancelled()
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time; callers arriving while it runs
+    share its outcome. Thread-safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, method=None):
+        """
+        Return `func()`, or the result of the call for `key` already in
+        flight. `method` names the API method for metrics.recorder.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            recorder.record_coalesced(method)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+flights = SingleFlight()
@@ -0,0 +1,112 @@
+"""
+Window showing the API call and phase statistics collected by metrics.recorder.
+"""
+import tkinter as tk
+from tkinter import ttk
+
+# How often the open window re-reads the recorder, in milliseconds
+REFRESH_MS = 1000
+
+COLUMNS = (
+    ('calls', "Calls", 60), ('errors', "Errors", 60), ('retries', "Retries", 60), ('coalesced', "Shared", 60),
+    ('p50', "p50 ms", 70), ('p95', "p95 ms", 70), ('max', "Max ms", 70),
+    ('sent', "Sent KB", 80), ('received', "Recv KB", 80), ('quota', "Quota", 70),
+)
+
+
+class StatsWindow:
+    """
+    A Toplevel listing latency, traffic, retries, shared calls and quota
+    per Gmail API method, and timings for each app phase. Recording can be switched on and
+    off from the window; it refreshes itself while open.
+    """
+
+    def __init__(self, root, recorder):
+        self.recorder = recorder
+        self.window = tk.Toplevel(root)
+        self.window.title("API Stats")
+        self.window.geometry("960x400")
+        self.job = None
+
+        top = ttk.Frame(self.window, padding=(10, 10, 10, 0))
+        top.pack(fill=tk.X)
+        self.enabled_var = tk.BooleanVar(value=recorder.enabled)
+        ttk.Checkbutton(top, text="Record stats", variable=self.enabled_var,
+                        command=self.toggle).pack(side=tk.LEFT)
+        ttk.Button(top, text="Reset", command=self.reset).pack(side=tk.LEFT, padx=5)
+        ttk.Button(top, text="Copy JSON", command=self.copy_json).pack(side=tk.LEFT)
+        self.summary_label = ttk.Label(top, text="")
+        self.summary_label.pack(side=tk.RIGHT)
+
+        frame = ttk.Frame(self.window, padding=10)
+        frame.pack(fill=tk.BOTH, expand=True)
+        self.tree = ttk.Treeview(frame, columns=[name for name, _, _ in COLUMNS])
+        self.tree.heading('#0', text="Method / phase")
+        self.tree.column('#0', width=280)
+        for name, heading, width in COLUMNS:
+            self.tree.heading(name, text=heading)
+            self.tree.column(name, width=width, anchor=tk.E)
+        scrollbar = ttk.Scrollbar(frame, orient=tk.VERTICAL, command=self.tree.yview)
+        self.tree.configure(yscrollcommand=scrollbar.set)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.methods_node = self.tree.insert('', tk.END, text="API calls", open=True)
+        self.phases_node = self.tree.insert('', tk.END, text="Phases", open=True)
+
+        self.window.bind('<Destroy>', self.on_destroy)
+        self.refresh()
+
+    def toggle(self):
+        self.recorder.enabled = self.enabled_var.get()
+        self.refresh()
+
+    def reset(self):
+        self.recorder.reset()
+        self.refresh()
+
+    def copy_json(self):
+        self.window.clipboard_clear()
+        self.window.clipboard_append(self.recorder.to_json())
+
+    def refresh(self):
+        self.job = None
+        snapshot = self.recorder.snapshot()
+        rows = {}
+        for method, stats in snapshot['methods'].items():
+            latency = stats['latency']
+            rows[('m', method)] = (self.methods_node, method.replace('gmail.users.', ''), (
+                stats['calls'], stats['errors'], stats['retries'], stats['coalesced'],
+                latency['p50_ms'], latency['p95_ms'], latency['max_ms'],
+                round(stats['bytes_sent'] / 1024, 1), round(stats['bytes_received'] / 1024, 1),
+                stats['quota_units'],
+            ))
+        for name, latency in snapshot['phases'].items():
+            rows[('p', name)] = (self.phases_node, name, (
+                latency['count'], '', '', '', latency['p50_ms'], latency['p95_ms'], latency['max_ms'], '', '', '',
+            ))
+        self._update_rows(rows)
+
+        if snapshot['enabled']:
+            self.summary_label.config(
+                text=f"{snapshot['quota_units']} quota units in {snapshot['uptime_seconds']:.0f} s")
+        else:
+            self.summary_label.config(text="Recording is off")
+        self.job = self.window.after(REFRESH_MS, self.refresh)
+
+    def _update_rows(self, rows):
+        # Rows are keyed by kind and name, so refreshing keeps the selection
+        for parent in (self.methods_node, self.phases_node):
+            for item in self.tree.get_children(parent):
+                if tuple(item.split(':', 1)) not in rows:
+                    self.tree.delete(item)
+        for (kind, name), (parent, text, values) in rows.items():
+            item = f'{kind}:{name}'
+            if self.tree.exists(item):
+                self.tree.item(item, values=values)
+            else:
+                self.tree.insert(parent, tk.END, iid=item, text=text, values=values)
+
+    def on_destroy(self, event):
+        if event.widget is self.window and self.job is not None:
+            self.window.after_cancel(self.job)
+            self.job = None
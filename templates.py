@@ -0,0 +1,254 @@
+"""
+Precompiled email templates and mail merge.
+
+A template is parsed once into a format string, and everything about the
+MIME message that does not depend on the recipient (part headers, boundary,
+bodies without merge fields) is serialized once. Rendering a message then
+only formats the personalized fields and base64-encodes the bodies that
+contain them, instead of building and serializing a new MIMEMultipart tree
+per recipient.
+
+Templates use `{{ field }}` placeholders, e.g. "Dear {{ name }},".
+"""
+import base64
+import csv
+import html
+import re
+import socket
+import uuid
+from email.header import Header
+from email.utils import formataddr, make_msgid, parseaddr
+
+FIELD = re.compile(r'{{\s*(\w+)\s*}}')
+
+WELCOME_SUBJECT = 'Welcome to Our Platform!'
+
+WELCOME_HTML = """
+<html>
+  <body>
+    <h2>Welcome to Our Platform!</h2>
+    <p>Dear {{ name }},</p>
+    <p>Thank you for signing up! We're excited to have you on board.</p>
+    <p>Here are a few things you can do to get started:</p>
+    <ul>
+      <li>Complete your profile</li>
+      <li>Explore our features</li>
+      <li>Connect with other users</li>
+    </ul>
+    <p>If you have any questions, feel free to reach out to our support team.</p>
+    <p>Best regards,<br>Vaishvi (231081074) , Zoher (231080077)</p>
+  </body>
+</html>
+"""
+
+WELCOME_TEXT = """Dear {{ name }},
+
+Thank you for signing up! We're excited to have you on board.
+
+Here are a few things you can do to get started:
+- Complete your profile
+- Explore our features
+- Connect with other users
+
+If you have any questions, feel free to reach out to our support team.
+
+Best regards,
+Vaishvi (231081074) , Zoher (231080077)
+"""
+
+
+class TextTemplate:
+    """
+    A string with `{{ field }}` placeholders, compiled to a format string.
+    """
+
+    def __init__(self, source, escape=False):
+        self.source = source
+        self.escape = escape
+        self.fields = FIELD.findall(source)
+        pieces = []
+        last = 0
+        for match in FIELD.finditer(source):
+            pieces.append(source[last:match.start()].replace('{', '{{').replace('}', '}}'))
+            pieces.append('{' + match.group(1) + '}')
+            last = match.end()
+        pieces.append(source[last:].replace('{', '{{').replace('}', '}}'))
+        self._format = ''.join(pieces)
+
+    @property
+    def static(self):
+        return not self.fields
+
+    def render(self, values):
+        if self.static:
+            return self.source
+        if self.escape:
+            values = {field: html.escape(str(values.get(field, ''))) for field in self.fields}
+        else:
+            values = {field: values.get(field, '') for field in self.fields}
+        return self._format.format_map(values)
+
+
+class RenderedMessage:
+    """
+    A fully serialized message. Supports the parts of the email.message API
+    the outbox uses: header lookup for To, Subject and Message-ID, and as_bytes().
+    """
+
+    __slots__ = ('headers', 'raw')
+
+    def __init__(self, headers, raw):
+        self.headers = headers
+        self.raw = raw
+
+    def __getitem__(self, name):
+        return self.headers.get(name.lower())
+
+    def as_bytes(self):
+        return self.raw
+
+
+def _check_header(value):
+    # A line break would end the header and let the rest of the value add headers of its own
+    if '\r' in value or '\n' in value:
+        raise ValueError(f"Header value may not contain line breaks: {value!r}")
+
+
+def _encode_header(value):
+    _check_header(value)
+    if value.isascii():
+        return value
+    return Header(value, 'utf-8').encode()
+
+
+def _encode_address(value):
+    _check_header(value)
+    if value.isascii():
+        return value
+    # Only the display name may be encoded; the address itself must stay as is
+    return formataddr(parseaddr(value), 'utf-8')
+
+
+def _encode_body(text):
+    """
+    Return (Content-Transfer-Encoding, encoded body) for a text part.
+    """
+    # Plain ASCII with short lines can go as is, which keeps it a third smaller than base64
+    if text.isascii() and all(len(line) <= 998 for line in text.splitlines()):
+        return '7bit', text.encode('ascii') + (b'' if text.endswith('\n') else b'\n')
+    return 'base64', base64.encodebytes(text.encode('utf-8'))
+
+
+class EmailTemplate:
+    """
+    A compiled email with a subject and a plain text and/or HTML body.
+
+    With both bodies the message is multipart/alternative, so clients that
+    do not show HTML get the plain text version.
+    """
+
+    def __init__(self, subject, text=None, html=None, sender=None):
+        if text is None and html is None:
+            raise ValueError("A template needs a text or an HTML body")
+        self.subject = TextTemplate(subject)
+        self.sender = sender
+        self.bodies = []
+        if text is not None:
+            self.bodies.append(('plain', TextTemplate(text)))
+        if html is not None:
+            self.bodies.append(('html', TextTemplate(html, escape=True)))
+        self.fields = set(self.subject.fields)
+        for _, body in self.bodies:
+            self.fields.update(body.fields)
+
+        # Serialize everything that is the same for every recipient once
+        self._domain = socket.getfqdn()
+        self._static_subject = _encode_header(subject) if self.subject.static else None
+        self._parts = []
+        for subtype, body in self.bodies:
+            headers = {
+                encoding: (
+                    f'Content-Type: text/{subtype}; charset="utf-8"\n'
+                    f'Content-Transfer-Encoding: {encoding}\n\n'
+                ).encode()
+                for encoding in ('7bit', 'base64')
+            }
+            self._parts.append((headers, body, self._encode_part(headers, body.source) if body.static else None))
+
+        if len(self.bodies) == 1:
+            self._top = b'MIME-Version: 1.0\n'
+            self._boundary = None
+        else:
+            self._boundary = f'=============={uuid.uuid4().hex}=='.encode()
+            self._top = (
+                b'MIME-Version: 1.0\n'
+                b'Content-Type: multipart/alternative; boundary="' + self._boundary + b'"\n'
+            )
+        self._sender = f'From: {_encode_address(sender)}\n'.encode() if sender else b''
+
+    @staticmethod
+    def _encode_part(headers, text):
+        encoding, data = _encode_body(text)
+        return headers[encoding] + data
+
+    def render(self, recipient, values=None, headers=None):
+        """
+        Build the message for one recipient, filling fields from `values`.
+        `headers` adds more headers, such as In-Reply-To for a reply.
+        Raises ValueError if the recipient, the subject or a header has a
+        line break in it.
+        """
+        values = values or {}
+        subject = self._static_subject or _encode_header(self.subject.render(values))
+        message_id = make_msgid(domain=self._domain)
+        chunks = [
+            self._top,
+            self._sender,
+            f'To: {_encode_address(recipient)}\nSubject: {subject}\nMessage-ID: {message_id}\n'.encode(),
+        ]
+        if headers:
+            chunks.append(''.join(f'{name}: {_encode_header(value)}\n' for name, value in headers.items()).encode())
+        if self._boundary is None:
+            part_headers, body, encoded = self._parts[0]
+            chunks.append(encoded or self._encode_part(part_headers, body.render(values)))
+        else:
+            chunks.append(b'\n')
+            for part_headers, body, encoded in self._parts:
+                chunks += [b'--', self._boundary, b'\n',
+                           encoded or self._encode_part(part_headers, body.render(values))]
+            chunks += [b'--', self._boundary, b'--\n']
+        return RenderedMessage({'to': recipient, 'subject': subject, 'message-id': message_id}, b''.join(chunks))
+
+
+def welcome_template(sender=None):
+    return EmailTemplate(WELCOME_SUBJECT, text=WELCOME_TEXT, html=WELCOME_HTML, sender=sender)
+
+
+def read_recipients(path, email_field='email'):
+    """
+    Yield one dict of merge fields per row of a CSV file with a header row.
+    """
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        if email_field not in (reader.fieldnames or []):
+            raise ValueError(f"{path} has no '{email_field}' column")
+        for row in reader:
+            if row[email_field]:
+                yield row
+
+
+def merge(template, recipients, email_field='email', defaults=None):
+    """
+    Render `template` for each recipient.
+
+    `recipients` is an iterable of email addresses or of dicts of merge
+    fields that include `email_field` (such as the rows from read_recipients).
+    Fields a recipient does not have fall back to `defaults`, then to "".
+    """
+    defaults = defaults or {}
+    for recipient in recipients:
+        if isinstance(recipient, str):
+            yield template.render(recipient, defaults)
+        else:
+            values = {**defaults, **recipient}
+            yield template.render(values[email_field], values)
@@ -5,11 +5,10 @@ import os.path
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
-from datetime import datetime
 import base64
-import email
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from gmail_fetch import fetch_messages_batched, parse_summary
 
 class GmailApp:
     def __init__(self, root):
@@ -97,24 +96,22 @@ class GmailApp:
             ).execute()
             messages = results.get('messages', [])
             
-            for message in messages:
-                msg = self.service.users().messages().get(
-                    userId='me', id=message['id'], format='full'
-                ).execute()
-                
-                # Extract email details
-                headers = msg['payload']['headers']
-                subject = next(h['value'] for h in headers if h['name'] == 'Subject')
-                sender = next(h['value'] for h in headers if h['name'] == 'From')
-                date = next(h['value'] for h in headers if h['name'] == 'Date')
+            # Fetch all messages in batch requests instead of one call each
+            message_ids = [message['id'] for message in messages]
+            fetched, errors = fetch_messages_batched(self.service, message_ids, format='full')
+            
+            for message_id in message_ids:
+                if message_id in errors:
+                    print(f"Error fetching message {message_id}: {errors[message_id]}")
+                    continue
+                msg = fetched[message_id]
                 
-                # Parse date to more readable format
-                parsed_date = email.utils.parsedate_to_datetime(date)
-                formatted_date = parsed_date.strftime('%Y-%m-%d %H:%M')
+                # Extract email details in one pass over the headers
+                summary = parse_summary(msg)
                 
                 # Insert into treeview
-                self.tree.insert('', tk.END, values=(sender, subject, formatted_date), 
-                                iid=message['id'])
+                self.tree.insert('', tk.END, values=(summary.sender, summary.subject, summary.date), 
+                                iid=message_id)
                 
         except Exception as e:
             messagebox.showerror("Error", f"Failed to fetch emails: {str(e)}")